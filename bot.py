@@ -1,14 +1,20 @@
 import os, json, base64
+import csv, gzip, io, tempfile
+import contextlib, contextvars, threading, time
 from datetime import datetime, timedelta, timezone, date
-from typing import Optional, List, Tuple
+from typing import Optional, List, Tuple, Dict, Iterator, Iterable, Set
+from collections import OrderedDict, deque
 import discord
 from discord.ext import commands
-from discord import ui
+from discord import app_commands, ui
 from dotenv import load_dotenv
-import gspread
-from google.oauth2.service_account import Credentials
-from gspread_formatting import format_cell_range, CellFormat, TextFormat, Color, set_frozen
 import re
+import sys
+import asyncio
+import bisect
+import heapq
+import unicodedata
+import uuid
 
 # ========= 環境変数 =========
 load_dotenv()
@@ -20,6 +26,8 @@ ADMIN_ROLE_NAME = os.getenv("ADMIN_ROLE_NAME")
 
 # ========= Google 認証 =========
 def get_gspread_client():
+    import gspread
+    from google.oauth2.service_account import Credentials
     scopes = [
         "https://www.googleapis.com/auth/spreadsheets",
         "https://www.googleapis.com/auth/drive",
@@ -33,25 +41,43 @@ def get_gspread_client():
         raise RuntimeError("サービスアカウント情報が見つかりません。")
     return gspread.authorize(creds)
 
-gc = get_gspread_client()
-sh = gc.open_by_key(SHEET_KEY)
+_sheets_client = None
+_sheets_client_lock = threading.Lock()
+
+def sheets_client():
+    """全テナント共有の gspread クライアント（初回利用時に認証する）"""
+    global _sheets_client
+    if _sheets_client is None:
+        with _sheets_client_lock:
+            if _sheets_client is None:
+                _sheets_client = get_gspread_client()
+    return _sheets_client
+
+def set_sheets_client(client):
+    """open_by_key を持つ任意のバックエンドに差し替える（テスト・ベンチマーク・オフライン用）"""
+    global _sheets_client
+    _sheets_client = client
 
 # ========= 定数 =========
 CAMPUS_CHOICES = ["小白川キャンパス", "飯田キャンパス", "米沢キャンパス", "鶴岡キャンパス", "その他"]
 
 REQ_HEADERS = [
     "記録時刻", "ユーザーID", "ユーザー名", "所属キャンパス",
-    "操作", "機材ID", "機材名", "返却予定日", "用途/状態", "コメント", "申請ステータス"
+    "操作", "機材ID", "機材名", "返却予定日", "用途/状態", "コメント", "申請ステータス", "申請ID"
 ]
 INV_HEADERS = [
     "機材ID", "機材名", "カテゴリ", "備考",
-    "ステータス", "借用者", "返却予定日"
+    "ステータス", "借用者", "返却予定日", "保管キャンパス", "現在キャンパス"
 ]
+INV_CURRENT_CAMPUS_COL = INV_HEADERS.index("現在キャンパス") + 1
+CAMPUS_UNSET = "未設定"  # キャンパス列が空の機材（導入前の行など）
 CFG_HEADERS = ["キー", "値"]
 BLK_HEADERS = ["種別", "名前", "開始", "終了", "モード", "有効"]  # 種別, 名前, 開始, 終了, モード(recurring/once), 有効(TRUE/FALSE)
 PROJ_HEADERS = ["プロジェクト名", "説明"]
+RES_HEADERS = ["予約ID", "機材ID", "ユーザーID", "ユーザー名", "開始", "終了", "用途", "ステータス", "記録時刻"]
 
-def get_or_create_ws(title: str, headers: List[str]):
+def get_or_create_ws(sh, title: str, headers: List[str]):
+    import gspread
     try:
         ws = sh.worksheet(title)
     except gspread.WorksheetNotFound:
@@ -65,13 +91,9 @@ def get_or_create_ws(title: str, headers: List[str]):
             ws.update([headers], f"A1:{end_col}1")
     return ws
 
-req_ws = get_or_create_ws("requests", REQ_HEADERS)
-inv_ws = get_or_create_ws("inventory", INV_HEADERS)
-cfg_ws = get_or_create_ws("config", CFG_HEADERS)
-blk_ws = get_or_create_ws("blackouts", BLK_HEADERS)
-proj_ws = get_or_create_ws("projects", PROJ_HEADERS)
-
 def style_headers(ws, headers: List[str]):
+    # gspread_formatting は重いので書式設定が必要になった時点で読み込む
+    from gspread_formatting import format_cell_range, CellFormat, TextFormat, Color, set_frozen
     end_col = chr(ord("A") + len(headers) - 1)
     ws.update([headers], f"A1:{end_col}1")
     set_frozen(ws, rows=1)
@@ -80,11 +102,727 @@ def style_headers(ws, headers: List[str]):
         textFormat=TextFormat(bold=True),
     ))
 
-style_headers(req_ws, REQ_HEADERS)
-style_headers(inv_ws, INV_HEADERS)
-style_headers(cfg_ws, CFG_HEADERS)
-style_headers(blk_ws, BLK_HEADERS)
-style_headers(proj_ws, PROJ_HEADERS)
+SHEET_SPECS = {
+    "requests": REQ_HEADERS,
+    "inventory": INV_HEADERS,
+    "config": CFG_HEADERS,
+    "blackouts": BLK_HEADERS,
+    "projects": PROJ_HEADERS,
+    "reservations": RES_HEADERS,
+}
+
+# ========= テナント（ギルド → スプレッドシート） =========
+# GUILD_SHEET_KEYS='{"<guild_id>": "<sheet_key>", ...}'
+# 未登録のギルドは GOOGLE_SHEET_KEY（既定テナント）を使う。既定も無ければ利用不可。
+GUILD_SHEET_KEYS = {int(k): v for k, v in json.loads(os.getenv("GUILD_SHEET_KEYS") or "{}").items()}
+SHEETS_READS_PER_MIN = float(os.getenv("SHEETS_READS_PER_MIN", "60"))
+SHEETS_WRITES_PER_MIN = float(os.getenv("SHEETS_WRITES_PER_MIN", "60"))
+SHEETS_MAX_WAIT_SEC = 30.0
+SHEETS_QUOTA_RETRIES = 3  # 429（クォータ超過）を待ってやり直す回数
+
+WRITE_METHODS = {
+    "update_cell", "update", "append_row", "append_rows", "delete_rows",
+    "batch_update", "insert_row", "insert_rows", "clear", "batch_clear",
+}
+
+class TenantNotConfigured(RuntimeError):
+    pass
+
+class TokenBucket:
+    """1 分あたり rate 回、最大 rate 回まで溜められるトークンバケット（スレッドセーフ）"""
+
+    def __init__(self, per_min: float):
+        self.rate = per_min / 60.0
+        self.capacity = per_min
+        self.tokens = per_min
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, n: float = 1) -> float:
+        """n トークン消費し、足りない場合は待つべき秒数を返す"""
+        with self.lock:
+            self._refill()
+            self.tokens -= n
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def peek(self, n: float = 1) -> float:
+        """消費せずに、n トークン揃うまでの秒数を返す"""
+        with self.lock:
+            self._refill()
+            return 0.0 if self.tokens >= n else (n - self.tokens) / self.rate
+
+    def drain(self, seconds: float):
+        """Google 側でクォータを超えたと言われたら、手元の残りを捨てて seconds 秒ぶん借りた状態にする"""
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+def on_event_loop() -> bool:
+    """イベントループのスレッドから呼ばれているか"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+class Tenant:
+    """
+    1 つのスプレッドシート（= 1 クラブ）ぶんの状態。
+    ワークシートは初回アクセス時に開いて保持し、キャッシュ類とクォータもテナントごとに持つ。
+    gspread クライアントは全テナントで共有する。
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self._sh = None
+        self._ws: Dict[str, object] = {}
+        self.lock = threading.RLock()
+        self.reads = TokenBucket(SHEETS_READS_PER_MIN)
+        self.writes = TokenBucket(SHEETS_WRITES_PER_MIN)
+        self.stats: Dict[str, float] = {"reads": 0, "writes": 0, "throttled": 0, "waited_sec": 0.0, "on_loop": 0,
+                                       "quota_retries": 0}
+        root, ext = os.path.splitext(INVENTORY_CHECKPOINT_PATH)
+        self.engine = InventoryEngine(f"{root}_{key[:16]}{ext or '.json'}", key)
+        self.due = DueScheduler()
+        self.started = False
+        self.starting = False
+        self.start_requested = False
+        self.cache = SheetCache(key)
+        self.cache.load_snapshot()
+        self.degraded = False
+        self.down_since = 0.0
+        self.last_failure = 0.0
+        self.board = StatusBoard(self)
+        self.panels = PanelScheduler(self)
+        self.mutations = MutationQueue(self)
+        self.req_index = RequestIndex()
+        self.postings = RequestPostings()
+        self.idempotency = IdempotencyCache()
+        self.limiter = RateLimiter()
+        self.columns: Dict[str, List[str]] = {}  # 列を絞った読み取り用の見出し行
+        self.refreshing: Set[str] = set()  # refresh_soon で取り直し中のシート
+        self.anomalies: List["Anomaly"] = []  # 最後に検出した不整合
+        self.reconciled_at = ""
+
+    @property
+    def sh(self):
+        if self._sh is None:
+            with self.lock:
+                if self._sh is None:
+                    self._sh = sheets_client().open_by_key(self.key)
+        return self._sh
+
+    def ws(self, title: str):
+        ws = self._ws.get(title)
+        if ws is None:
+            with self.lock:
+                ws = self._ws.get(title)
+                if ws is None:
+                    headers = SHEET_SPECS[title]
+                    ws = get_or_create_ws(self.sh, title, headers)
+                    style_headers(ws, headers)
+                    self._ws[title] = ws
+        return ws
+
+    def throttle(self, write: bool):
+        """
+        クォータの空きを待つ（ワーカーのスレッド側だけ）。
+        イベントループ上で眠ると全テナントの応答が止まるので、そこでは待たずに呼び出しを数えるだけにする。
+        先取りした分のトークンは後続のワーカー側の呼び出しが待って返す。
+        """
+        bucket = self.writes if write else self.reads
+        self.stats["writes" if write else "reads"] += 1
+        wait = bucket.reserve()
+        if wait > 0:
+            wait = min(wait, SHEETS_MAX_WAIT_SEC)
+            self.stats["throttled"] += 1
+            if on_event_loop():
+                self.stats["on_loop"] += 1
+                return
+            self.stats["waited_sec"] += wait
+            time.sleep(wait)
+
+    # ---- Sheets 呼び出し（クォータ・縮退判定・キャッシュ反映） ----
+    def _mark_down(self):
+        now = time.monotonic()
+        if not self.degraded:
+            self.degraded = True
+            self.down_since = now
+            print(f"[tenant] Sheets に接続できません。読み取り専用モードに移行 ({self.key})")
+        self.last_failure = now
+
+    def _mark_up(self):
+        if self.degraded:
+            self.degraded = False
+            print(f"[tenant] Sheets に再接続しました ({self.key})")
+
+    def call(self, title: str, name: str, args: tuple = (), kwargs: Optional[dict] = None, force: bool = False):
+        kwargs = kwargs or {}
+        if self.degraded and not force and time.monotonic() - self.last_failure < RETRY_INTERVAL_SEC:
+            raise SheetsUnavailable()
+        write = name in WRITE_METHODS
+        for attempt in range(SHEETS_QUOTA_RETRIES + 1):
+            self.throttle(write)
+            try:
+                result = getattr(self.ws(title), name)(*args, **kwargs)
+                break
+            except Exception as e:
+                if is_outage(e):
+                    self._mark_down()
+                    raise SheetsUnavailable() from e
+                if not is_quota_exceeded(e):
+                    raise
+                if attempt == SHEETS_QUOTA_RETRIES or on_event_loop():
+                    raise Overloaded() from e
+                # 接続は生きているので縮退させず、バケットを空けて次の throttle で待ってからやり直す
+                (self.writes if write else self.reads).drain(2 ** attempt)
+                self.stats["quota_retries"] += 1
+        self._mark_up()
+        if write and title in CACHED_SHEETS:
+            self.cache.apply_write(title, name, args, kwargs)
+        if write and title in BOARD_SHEETS:
+            self.board.schedule()
+        if write and title == "blackouts":
+            self.panels.reschedule()
+        return result
+
+    def cached_read(self, title: str, name: str, *args):
+        """get_all_values / row_values / col_values をキャッシュから返す（古ければ取り直す）"""
+        return self.cache.read(self.rows(title), name, args)
+
+    def records(self, title: str, build):
+        """キャッシュ対象シートを build（行の一覧 → レコード）で変換したもの"""
+        return self.cache.parsed(title, self.rows(title), build)
+
+    def peek_records(self, title: str, build):
+        """records と同じだが、古くてもシートは読まずに手元の値から作る（まだ無ければ空のシートとして）"""
+        return self.cache.parsed(title, self.cache.get(title) or [], build)
+
+    def refresh_soon(self, title: str):
+        """古くなっていればスレッドで取り直しておく（ループから呼ぶ。結果は待たない）"""
+        if self.cache.fresh(title) or title in self.refreshing:
+            return
+        self.refreshing.add(title)
+
+        def work():
+            try:
+                self.rows(title)
+            except Exception:
+                pass  # 縮退中などは手元の値のまま
+            finally:
+                self.refreshing.discard(title)
+
+        task = asyncio.ensure_future(asyncio.to_thread(work))
+        task.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+    def rows(self, title: str) -> List[List[str]]:
+        """キャッシュしている行の一覧そのもの（呼び出し側で書き換えないこと）"""
+        rows = self.cache.get(title)
+        if rows is None or not self.cache.fresh(title):
+            try:
+                fetched = self.call(title, "get_all_values")
+                if title in BOARD_SHEETS and rows is not None and fetched != rows:
+                    self.board.schedule()  # シートが直接編集されていた
+                    if title == "blackouts":
+                        self.panels.reschedule()
+                self.cache.put(title, fetched)
+                rows = self.cache.get(title)
+            except SheetsUnavailable:
+                if rows is None:
+                    raise
+        return rows
+
+    def load(self) -> bool:
+        """キャッシュ対象シートの読み込みと在庫状態の再生（ワーカーのスレッドで呼ぶ）。Sheets に繋がれば True"""
+        with tenant_scope(self):
+            try:
+                for title in CACHED_SHEETS:
+                    self.cached_read(title, "get_all_values")
+                self.engine.load()
+            except SheetsUnavailable:
+                self.engine.load_offline()
+                return False
+        return True
+
+    async def start(self):
+        """
+        在庫状態の構築と期限スケジューラの起動（テナントごとに 1 回）。
+        シート全体の読み込みとログの再生はスレッドで行い、大きなテナントがゲートウェイの処理を止めないようにする。
+        Sheets に繋がらない場合はチェックポイントとスナップショットで読み取り専用のまま起動し、
+        health_loop が再接続できた時点で改めて start する。
+        """
+        if self.started or self.starting:
+            return
+        self.start_requested = True
+        self.starting = True
+        try:
+            self.board.attach(asyncio.get_running_loop())
+            online = await asyncio.to_thread(self.load)
+        finally:
+            self.starting = False
+        with tenant_scope(self):
+            try:
+                self.due.start()
+            except SheetsUnavailable:
+                # Sheets にもスナップショットにも在庫が無い初回起動。health_loop が再接続したら start し直す
+                print(f"[tenant] 在庫を読めないため起動を保留します ({self.key})")
+                return
+            if not online:
+                return
+            self.panels.start()
+            self.mutations.post(IndexRequests())
+        self.started = True
+        self.board.schedule()
+
+class TenantRegistry:
+    def __init__(self, default_key: Optional[str], guild_keys: Dict[int, str]):
+        self.default_key = default_key
+        self.guild_keys = guild_keys
+        self.by_key: Dict[str, Tenant] = {}
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> Tenant:
+        t = self.by_key.get(key)
+        if t is None:
+            with self.lock:
+                t = self.by_key.setdefault(key, Tenant(key))
+        return t
+
+    def for_guild(self, guild_id: Optional[int]) -> Tenant:
+        key = self.guild_keys.get(guild_id) if guild_id is not None else None
+        key = key or self.default_key
+        if not key:
+            raise TenantNotConfigured("このサーバーに対応するスプレッドシートが設定されていません。")
+        return self.get(key)
+
+    def all(self) -> List[Tenant]:
+        return list(self.by_key.values())
+
+tenants = TenantRegistry(SHEET_KEY, GUILD_SHEET_KEYS)
+_tenant_var: contextvars.ContextVar[Optional[Tenant]] = contextvars.ContextVar("loanlink_tenant", default=None)
+
+def current_tenant() -> Tenant:
+    t = _tenant_var.get()
+    return t if t is not None else tenants.for_guild(None)
+
+def bind_tenant(guild: Optional[discord.abc.Snowflake]) -> Tenant:
+    """現在のタスク（とそこから派生するスレッド/タスク）をギルドのテナントに結び付ける"""
+    t = tenants.for_guild(guild.id if guild else None)
+    _tenant_var.set(t)
+    return t
+
+@contextlib.contextmanager
+def tenant_scope(t: Tenant):
+    token = _tenant_var.set(t)
+    try:
+        yield t
+    finally:
+        _tenant_var.reset(token)
+
+class SheetProxy:
+    """
+    req_ws などのモジュール変数の実体。呼び出し時のテナントのワークシートへ委譲する。
+    キャッシュ対象シートの読み取りはテナントのキャッシュから返す。
+    """
+
+    def __init__(self, title: str):
+        self.title = title
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        t = current_tenant()
+        if self.title in CACHED_SHEETS and name in ("get_all_values", "row_values", "col_values"):
+            return lambda *args: t.cached_read(self.title, name, *args)
+        return lambda *args, **kwargs: t.call(self.title, name, args, kwargs)
+
+req_ws = SheetProxy("requests")
+inv_ws = SheetProxy("inventory")
+cfg_ws = SheetProxy("config")
+blk_ws = SheetProxy("blackouts")
+proj_ws = SheetProxy("projects")
+res_ws = SheetProxy("reservations")
+
+# ========= シートキャッシュ / スナップショット / 縮退運転 =========
+# inventory / config / blackouts / projects / reservations は全体をメモリに保持して読み取りを返す。
+# 書き込みはキャッシュにも反映し、変更はローカルのスナップショットに保存する。
+# 起動時はスナップショットから復元するので、Sheets に繋がらなくても読み取りは続けられる。
+CACHED_SHEETS = ("inventory", "config", "blackouts", "projects", "reservations")
+BOARD_SHEETS = ("inventory", "blackouts")  # 在庫ボードの表示に関わるシート
+SHEET_CACHE_TTL = float(os.getenv("SHEET_CACHE_TTL", "60"))
+STATE_DIR = os.getenv("LOANLINK_STATE_DIR", ".")
+RETRY_INTERVAL_SEC = 30
+SNAPSHOT_FLUSH_SEC = 5
+
+class SheetsUnavailable(RuntimeError):
+    def __init__(self, msg: str = "Google スプレッドシートに接続できないため、現在は読み取り専用モードです"
+                                  "（在庫状況・停止期間の確認のみ可能）。しばらくしてから再度お試しください。"):
+        super().__init__(msg)
+
+def api_status(e: Exception) -> int:
+    """gspread の APIError の HTTP ステータス（それ以外は 0）"""
+    from gspread.exceptions import APIError
+    if not isinstance(e, APIError):
+        return 0
+    return getattr(e, "code", None) or getattr(getattr(e, "response", None), "status_code", 0) or 0
+
+def is_outage(e: Exception) -> bool:
+    """ネットワーク断・Google 側の障害とみなす例外か（429 のクォータ超過は含めない）"""
+    import requests
+    from google.auth.exceptions import TransportError
+    if isinstance(e, (OSError, requests.exceptions.RequestException, TransportError)):
+        return True
+    return api_status(e) >= 500
+
+def is_quota_exceeded(e: Exception) -> bool:
+    return api_status(e) == 429
+
+def a1_start(a1: str) -> Tuple[int, int]:
+    """'E2:G10' → (2, 5)"""
+    m = re.match(r"([A-Z]+)(\d+)", a1.split("!")[-1])
+    if not m:
+        return 1, 1
+    col = 0
+    for ch in m.group(1):
+        col = col * 26 + ord(ch) - ord("A") + 1
+    return int(m.group(2)), col
+
+class SheetCache:
+    """テナントのシート値キャッシュと、そのスナップショットファイル"""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.path = os.path.join(STATE_DIR, f"snapshot_{key[:16]}.json.gz")
+        self.values: Dict[str, List[List[str]]] = {}
+        self.fetched: Dict[str, float] = {}
+        self.pending: Dict[str, List[Tuple[int, List[str]]]] = {}
+        self.records: Dict[str, tuple] = {}  # title -> (世代, パース済みレコード)
+        self.gen: Dict[str, int] = {}        # シートの値が変わるたびに進む
+        self.saved_at = ""
+        self.dirty = False
+        self.lock = threading.RLock()
+
+    def load_snapshot(self):
+        try:
+            with gzip.open(self.path, "rt", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("sheet") != self.key:
+            return
+        with self.lock:
+            self.values = {k: v for k, v in data.get("values", {}).items() if k in CACHED_SHEETS}
+            self.pending = {k: [(int(i), r) for i, r in v] for k, v in data.get("pending", {}).items()}
+            self.saved_at = data.get("saved", "")
+            self.fetched = {}  # 復元直後は古い扱い（繋がれば取り直す）
+            for title in self.values:
+                self._changed(title)
+
+    def save_snapshot(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            data = {
+                "sheet": self.key,
+                "saved": now_jst_str(),
+                "values": self.values,
+                "pending": self.pending,
+            }
+            self.dirty = False
+        os.makedirs(STATE_DIR, exist_ok=True)
+        tmp = self.path + ".tmp"
+        with gzip.open(tmp, "wt", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp, self.path)
+        self.saved_at = data["saved"]
+
+    def fresh(self, title: str) -> bool:
+        return time.monotonic() - self.fetched.get(title, -1e9) < SHEET_CACHE_TTL
+
+    def expire(self, title: str):
+        """次の読み取りでシートから取り直させる（値はそのまま縮退時の代わりに残す）"""
+        self.fetched.pop(title, None)
+
+    def get(self, title: str) -> Optional[List[List[str]]]:
+        return self.values.get(title)
+
+    def put(self, title: str, rows: List[List[str]]):
+        with self.lock:
+            self.values[title] = [list(r) for r in rows]
+            self.fetched[title] = time.monotonic()
+            self.dirty = True
+            self._changed(title)
+
+    def _changed(self, title: str):
+        self.gen[title] = self.gen.get(title, 0) + 1
+        self.records.pop(title, None)
+
+    def parsed(self, title: str, rows: List[List[str]], build):
+        """rows を build でレコードにしたもの（シートが変わるまで同じものを返す）"""
+        with self.lock:
+            gen = self.gen.get(title, 0)
+            hit = self.records.get(title)
+            if hit is not None and hit[0] == gen:
+                return hit[1]
+            recs = build(rows)
+            self.records[title] = (gen, recs)
+            return recs
+
+    def put_pending(self, op: str, rows: List[Tuple[int, List[str]]]):
+        with self.lock:
+            self.pending[op] = rows
+            self.dirty = True
+
+    def _set(self, rows: List[List[str]], r: int, c: int, v):
+        while len(rows) < r:
+            rows.append([])
+        row = rows[r - 1]
+        while len(row) < c:
+            row.append("")
+        row[c - 1] = str(v)
+
+    def apply_write(self, title: str, method: str, args: tuple, kwargs: dict):
+        """書き込みをキャッシュにも反映（再現できない操作はキャッシュを古い扱いにする）"""
+        with self.lock:
+            rows = self.values.get(title)
+            if rows is None:
+                return
+            self.dirty = True
+            self._changed(title)
+            if method == "update_cell":
+                r, c, v = args[:3]
+                self._set(rows, r, c, v)
+            elif method == "append_row":
+                rows.append([str(x) for x in (args[0] if args else kwargs["values"])])
+            elif method == "append_rows":
+                rows.extend([str(x) for x in r] for r in (args[0] if args else kwargs["values"]))
+            elif method == "update":
+                values = args[0] if args else kwargs.get("values")
+                rng = args[1] if len(args) > 1 else kwargs.get("range_name")
+                if isinstance(values, str):
+                    values, rng = rng, values
+                r0, c0 = a1_start(rng or "A1")
+                for i, row in enumerate(values or []):
+                    for j, v in enumerate(row):
+                        self._set(rows, r0 + i, c0 + j, v)
+            elif method == "batch_update":
+                for d in (args[0] if args else kwargs["data"]):
+                    r0, c0 = a1_start(d["range"])
+                    for i, row in enumerate(d["values"]):
+                        for j, v in enumerate(row):
+                            self._set(rows, r0 + i, c0 + j, v)
+            elif method == "delete_rows":
+                start = args[0]
+                end = args[1] if len(args) > 1 else start
+                del rows[start - 1:end]
+            else:
+                self.fetched.pop(title, None)
+
+    def read(self, rows: List[List[str]], name: str, args: tuple):
+        if name == "get_all_values":
+            return [list(r) for r in rows]
+        if name == "row_values":
+            i = args[0]
+            r = list(rows[i - 1]) if 0 < i <= len(rows) else []
+            while r and r[-1] == "":
+                r.pop()
+            return r
+        c = args[0]
+        col = [r[c - 1] if c - 1 < len(r) else "" for r in rows]
+        while col and col[-1] == "":
+            col.pop()
+        return col
+
+async def snapshot_loop():
+    """変更のあったテナントのスナップショットを数秒おきに書き出す"""
+    while True:
+        await asyncio.sleep(SNAPSHOT_FLUSH_SEC)
+        for t in tenants.all():
+            if t.cache.dirty:
+                try:
+                    await asyncio.to_thread(t.cache.save_snapshot)
+                except Exception as e:
+                    print(f"[snapshot] 保存失敗 ({t.key}): {e}")
+
+async def health_loop():
+    """縮退中・起動未完了のテナントを定期的に再接続する"""
+    while True:
+        await asyncio.sleep(RETRY_INTERVAL_SEC)
+        for t in tenants.all():
+            if t.started and not t.degraded:
+                continue
+            if not t.started and not t.start_requested:
+                continue
+            try:
+                await asyncio.to_thread(t.call, "config", "row_values", (1,), None, True)
+                if not t.started:
+                    await t.start()
+            except SheetsUnavailable:
+                pass
+            except Exception as e:
+                print(f"[health] 再接続失敗 ({t.key}): {e}")
+
+# ========= レコード型 =========
+# シートの 1 行を表す軽量な型。列の位置はヘッダー行から一度だけ解決し、
+# キャッシュしているシートはシートが変わるまで同じレコード列を使い回す。
+# ステータス・カテゴリなど同じ値が繰り返し出てくる列は intern して文字列を共有する。
+def column_positions(header: List[str], names: List[str]) -> List[int]:
+    """names の各列がヘッダーの何列目か（見つからない列は既定の並びの位置）"""
+    pos = {h: i for i, h in enumerate(header)}
+    return [pos.get(n, i) for i, n in enumerate(names)]
+
+def pick(row: List[str], positions: List[int]) -> List[str]:
+    return [row[p] if p < len(row) else "" for p in positions]
+
+class Item:
+    """inventory の 1 行（row はシートの行番号）"""
+    __slots__ = ("row", "item_id", "name", "category", "note", "status", "borrower", "due",
+                 "home_campus", "current_campus")
+
+    def __init__(self, row: int, item_id: str, name: str, category: str, note: str,
+                 status: str, borrower: str, due: str, home_campus: str = "", current_campus: str = ""):
+        self.row = row
+        self.item_id = item_id
+        self.name = name
+        self.category = sys.intern(category)
+        self.note = note
+        self.status = sys.intern(status)
+        self.borrower = borrower
+        self.due = due
+        self.home_campus = sys.intern(home_campus)
+        self.current_campus = sys.intern(current_campus)
+
+    @property
+    def available(self) -> bool:
+        return self.status in ("貸出可", "")
+
+    @property
+    def campus(self) -> str:
+        """いま機材がある（はずの）キャンパス。現在キャンパスが空なら保管キャンパス"""
+        return self.current_campus or self.home_campus or CAMPUS_UNSET
+
+class ItemTable:
+    """
+    inventory 全体（行順の一覧 + 機材ID → 機材 + (キャンパス, カテゴリ) → 貸出可の機材）。
+    inventory が変わるたびに読み込み済みの行から作り直すので、索引はステータスの変更に常に追従する。
+    """
+    __slots__ = ("items", "by_id", "available")
+
+    def __init__(self, rows: List[List[str]]):
+        self.items: List[Item] = []
+        self.by_id: Dict[str, Item] = {}
+        self.available: Dict[Tuple[str, str], List[Item]] = {}
+        if not rows:
+            return
+        pos = column_positions(rows[0], INV_HEADERS)
+        for i, r in enumerate(rows[1:], start=2):
+            it = Item(i, *pick(r, pos))
+            self.items.append(it)
+            if it.item_id:
+                self.by_id.setdefault(it.item_id, it)
+                if it.available:
+                    self.available.setdefault((it.campus, it.category), []).append(it)
+
+    def available_in(self, cat: str, campus: Optional[str] = None) -> List[Item]:
+        """カテゴリの貸出可の機材（campus を渡せばそのキャンパスにあるものだけ、行順）"""
+        if campus is not None:
+            return list(self.available.get((campus, cat), []))
+        found = [it for (_, c), items in self.available.items() if c == cat for it in items]
+        return sorted(found, key=lambda it: it.row)
+
+    def categories_at(self, campus: str) -> List[str]:
+        """campus に貸出可の機材があるカテゴリ"""
+        return sorted(c for (p, c), items in self.available.items() if p == campus and items)
+
+    def campus_counts(self) -> Dict[str, int]:
+        """キャンパス → 貸出可の台数"""
+        out: Dict[str, int] = {}
+        for (p, _), items in self.available.items():
+            out[p] = out.get(p, 0) + len(items)
+        return out
+
+class RequestRecord:
+    """requests の 1 行。属性の並びは REQ_HEADERS と同じ（row はシートの行番号、不明なら 0）"""
+    __slots__ = ("ts", "user_id", "user_name", "campus", "op", "item_id", "item_name",
+                 "due", "purpose", "comment", "status", "req_id", "row")
+    FIELDS = __slots__[:-1]
+
+    def __init__(self, ts: str = "", user_id: str = "", user_name: str = "", campus: str = "", op: str = "",
+                 item_id: str = "", item_name: str = "", due: str = "", purpose: str = "", comment: str = "",
+                 status: str = "", req_id: str = "", row: int = 0):
+        self.ts = ts
+        self.user_id = str(user_id)
+        self.user_name = user_name
+        self.campus = sys.intern(campus)
+        self.op = sys.intern(op)
+        self.item_id = item_id
+        self.item_name = item_name
+        self.due = due
+        self.purpose = purpose
+        self.comment = comment
+        self.status = sys.intern(status)
+        self.req_id = req_id
+        self.row = row
+
+    @classmethod
+    def from_row(cls, r: List[str], row: int = 0) -> "RequestRecord":
+        """シートの行から（requests のヘッダーは開くときに REQ_HEADERS に揃えている）"""
+        return cls(*(list(r) + [""] * len(cls.FIELDS))[:len(cls.FIELDS)], row=row)
+
+    def to_row(self) -> List[str]:
+        return [getattr(self, f) for f in self.FIELDS]
+
+    def with_status(self, status: str) -> "RequestRecord":
+        rec = RequestRecord(*self.to_row(), row=self.row)
+        rec.status = sys.intern(status)
+        return rec
+
+class Blackout:
+    __slots__ = ("row", "kind", "name", "start", "end", "mode", "active")
+
+    def __init__(self, row: int, kind: str, name: str, start: str, end: str, mode: str, active: bool):
+        self.row = row
+        self.kind = sys.intern(kind)
+        self.name = name
+        self.start = start
+        self.end = end
+        self.mode = sys.intern(mode)
+        self.active = active
+
+def parse_blackouts(rows: List[List[str]]) -> List[Blackout]:
+    if not rows:
+        return []
+    pos = column_positions(rows[0], BLK_HEADERS)
+    res = []
+    for i, r in enumerate(rows[1:], start=2):
+        if not r:
+            continue
+        kind, name, start, end, mode, active = (v.strip() for v in pick(r, pos))
+        res.append(Blackout(i, kind, name, start, end, mode, (active or "TRUE").upper() in ("TRUE", "1", "YES", "ON")))
+    return res
+
+class Project:
+    __slots__ = ("name", "desc")
+
+    def __init__(self, name: str, desc: str):
+        self.name = name
+        self.desc = desc
+
+def parse_projects(rows: List[List[str]]) -> List[Project]:
+    if not rows:
+        return []
+    pos = column_positions(rows[0], PROJ_HEADERS)
+    res = []
+    for r in rows[1:]:
+        name, desc = (v.strip() for v in pick(r, pos)[:2])
+        if name:
+            res.append(Project(name, desc))
+    return res
 
 # ========= 日付ユーティリティ =========
 JST = timezone(timedelta(hours=9))
@@ -99,22 +837,27 @@ def parse_md(md: str) -> Tuple[int, int]:
     m, d = map(int, md.split("-"))
     return m, d
 
-def within_md(y: int, m: int, d: int, start_md: str, end_md: str) -> bool:
+def overlaps_md(first: date, last: date, start_md: str, end_md: str) -> bool:
+    """毎年の MM-DD〜MM-DD の期間が first〜last にかかるか"""
     sm, sd = parse_md(start_md)
     em, ed = parse_md(end_md)
-    start = date(y, sm, sd)
-    end = date(y, em, ed)
-    return start <= date(y, m, d) <= end
+    return any(date(y, sm, sd) <= last and first <= date(y, em, ed) for y in range(first.year, last.year + 1))
 
 # ========= config / blackout シート =========
+def parse_config(rows: List[List[str]]) -> Dict[str, str]:
+    """キー → 値（同じキーが複数あれば上の行を使う）"""
+    out: Dict[str, str] = {}
+    for r in rows[1:]:
+        if r and r[0]:
+            out.setdefault(r[0], r[1] if len(r) > 1 else "")
+    return out
+
 def cfg_get(key: str) -> Optional[str]:
-    vals = cfg_ws.get_all_values()
-    for r in vals[1:]:
-        if r and r[0] == key:
-            return r[1] if len(r) > 1 else ""
-    return None
+    return current_tenant().records("config", parse_config).get(key)
 
 def cfg_set(key: str, value: str):
+    if key in DEST_KEYS:
+        invalidate_destinations()
     vals = cfg_ws.get_all_values()
     for i, r in enumerate(vals[1:], start=2):
         if r and r[0] == key:
@@ -122,150 +865,155 @@ def cfg_set(key: str, value: str):
             return
     cfg_ws.append_row([key, str(value)])
 
-def blk_list() -> List[dict]:
-    vals = blk_ws.get_all_values()
-    res = []
-    for r in vals[1:]:
-        if not r:
-            continue
-        t = (r[0] if len(r) > 0 else "").strip()
-        name = (r[1] if len(r) > 1 else "").strip()
-        start = (r[2] if len(r) > 2 else "").strip()
-        end = (r[3] if len(r) > 3 else "").strip()
-        mode = (r[4] if len(r) > 4 else "").strip()
-        active = (r[5] if len(r) > 5 else "TRUE").strip().upper() in ["TRUE", "1", "YES", "ON"]
-        res.append({"種別": t, "名前": name, "開始": start, "終了": end, "モード": mode, "有効": active})
-    return res
+def blk_list() -> List[Blackout]:
+    return current_tenant().records("blackouts", parse_blackouts)
 
 def blk_add(t: str, name: str, start: str, end: str, mode: str, active: bool = True):
     blk_ws.append_row([t, name, start, end, mode, "TRUE" if active else "FALSE"])
 
+def blk_replace(t: str, name: str, start: str, end: str):
+    """毎年の期間（文化祭・新歓）を差し替える（同じ種別の既存の行は無効にする）"""
+    for b in blk_list():
+        if b.kind == t:
+            blk_toggle(b.name, False)
+    blk_add(t, name, start, end, "recurring", True)
+
 def blk_toggle(name: str, active: bool) -> bool:
-    vals = blk_ws.get_all_values()
-    for i, r in enumerate(vals[1:], start=2):
-        if len(r) > 1 and r[1] == name:
-            blk_ws.update_cell(i, 6, "TRUE" if active else "FALSE")
+    for b in blk_list():
+        if b.name == name:
+            blk_ws.update_cell(b.row, 6, "TRUE" if active else "FALSE")
             return True
     return False
 
 def blk_delete(name: str) -> bool:
-    vals = blk_ws.get_all_values()
-    for i, r in enumerate(vals[1:], start=2):
-        if len(r) > 1 and r[1] == name:
-            blk_ws.delete_rows(i)
+    for b in blk_list():
+        if b.name == name:
+            blk_ws.delete_rows(b.row)
             return True
     return False
 
-def human_period(b: dict) -> str:
-    if b["モード"] == "recurring":
-        return f"{b['開始']}〜{b['終了']}（毎年）"
-    return f"{b['開始']}〜{b['終了']}"
+def human_period(b: Blackout) -> str:
+    if b.mode == "recurring":
+        return f"{b.start}〜{b.end}（毎年）"
+    return f"{b.start}〜{b.end}"
 
-def calc_is_blackout(today: Optional[date] = None) -> Tuple[bool, str, str]:
+def calc_is_blackout(today: Optional[date] = None, until: Optional[date] = None) -> Tuple[bool, str, str]:
+    """today（until を渡せば today〜until の期間）が停止期間にかかるか"""
     if today is None:
         today = today_jst()
-    y, m, d = today.year, today.month, today.day
+    until = until or today
     for b in blk_list():
-        if not b["有効"]:
+        if not b.active:
             continue
-        if b["種別"] in ["festival", "recruit"] and b["モード"] == "recurring":
-            if within_md(y, m, d, b["開始"], b["終了"]):
-                label = "文化祭" if b["種別"] == "festival" else "新歓"
-                return True, label, f"{b['開始']}〜{b['終了']}"
-        elif b["種別"] == "custom" and b["モード"] == "once":
+        if b.kind in ["festival", "recruit"] and b.mode == "recurring":
+            if overlaps_md(today, until, b.start, b.end):
+                label = "文化祭" if b.kind == "festival" else "新歓"
+                return True, label, f"{b.start}〜{b.end}"
+        elif b.kind == "custom" and b.mode == "once":
             try:
-                s = date.fromisoformat(b["開始"])
-                e = date.fromisoformat(b["終了"])
-                if s <= today <= e:
-                    return True, b["名前"] or "運営都合", f"{b['開始']}〜{b['終了']}"
+                s = date.fromisoformat(b.start)
+                e = date.fromisoformat(b.end)
+                if s <= until and today <= e:
+                    return True, b.name or "運営都合", f"{b.start}〜{b.end}"
             except Exception:
                 continue
     return False, "", ""
 
+def next_blackout_transition(today: Optional[date] = None) -> Optional[date]:
+    """今日より後で、停止期間の開始日 / 終了翌日が来る最も近い日付"""
+    if today is None:
+        today = today_jst()
+    cands = []
+    for b in blk_list():
+        if not b.active:
+            continue
+        try:
+            if b.mode == "recurring":
+                sm, sd = parse_md(b.start)
+                em, ed = parse_md(b.end)
+                for y in (today.year, today.year + 1):
+                    cands.append(date(y, sm, sd))
+                    cands.append(date(y, em, ed) + timedelta(days=1))
+            elif b.mode == "once":
+                cands.append(date.fromisoformat(b.start))
+                cands.append(date.fromisoformat(b.end) + timedelta(days=1))
+        except ValueError:
+            continue
+    future = [c for c in cands if c > today]
+    return min(future) if future else None
+
 # ========= 共通ユーティリティ =========
 def is_admin(member: discord.Member) -> bool:
     if ADMIN_ROLE_NAME and any(r.name == ADMIN_ROLE_NAME for r in member.roles):
         return True
     return member.guild_permissions.administrator
 
-def inv_all() -> List[dict]:
-    vals = inv_ws.get_all_values()
-    if len(vals) < 2:
-        return []
-    res = []
-    for r in vals[1:]:
-        padded = (r + [""] * len(INV_HEADERS))[:len(INV_HEADERS)]
-        res.append({
-            "機材ID": padded[0],
-            "機材名": padded[1],
-            "カテゴリ": padded[2],
-            "備考": padded[3],
-            "ステータス": padded[4],
-            "借用者": padded[5],
-            "返却予定日": padded[6],
-        })
-    return res
+def inv_table() -> ItemTable:
+    return current_tenant().records("inventory", ItemTable)
+
+def inv_all() -> List[Item]:
+    return inv_table().items
 
 def inv_categories() -> List[str]:
-    return sorted(set(r["カテゴリ"] for r in inv_all() if r["カテゴリ"]))
+    return sorted(set(r.category for r in inv_all() if r.category))
+
+def inv_get(item_id: str) -> Optional[Item]:
+    return inv_table().by_id.get(item_id)
 
 def inv_find_row(item_id: str) -> Optional[int]:
-    col = inv_ws.col_values(1)
-    try:
-        return col.index(item_id) + 1
-    except ValueError:
-        return None
+    it = inv_get(item_id)
+    return it.row if it else None
 
-def inv_available(cat: str) -> List[dict]:
-    return [
-        r for r in inv_all()
-        if r["カテゴリ"] == cat and (r["ステータス"] in ["貸出可", ""] or r["ステータス"] is None)
-    ]
+def inv_available(cat: str, campus: Optional[str] = None) -> List[Item]:
+    return inv_table().available_in(cat, campus)
 
-def inv_borrowed_by(user_name: str) -> List[dict]:
-    return [
-        r for r in inv_all()
-        if r["借用者"] == user_name and r["ステータス"] in ["貸出中", "貸出申請中"]
-    ]
+def inv_categories_at(campus: Optional[str]) -> List[str]:
+    """campus に貸出可の機材があるカテゴリ（None なら全カテゴリ）"""
+    return inv_table().categories_at(campus) if campus else inv_categories()
+
+def inv_campus_counts() -> Optional[Dict[str, int]]:
+    """キャンパス → 貸出可台数。カテゴリが 1 つも無ければ None"""
+    return inv_table().campus_counts() if inv_categories() else None
+
+def campus_order(campuses: Iterable[str]) -> List[str]:
+    """CAMPUS_CHOICES の並び → それ以外（手入力の名前）→ 未設定"""
+    rank = {c: i for i, c in enumerate(CAMPUS_CHOICES)}
+    return sorted(campuses, key=lambda c: (c == CAMPUS_UNSET, rank.get(c, len(rank)), c))
+
+def campus_summary_lines() -> List[str]:
+    """キャンパス別の貸出可台数（索引から数える）"""
+    counts = inv_table().campus_counts()
+    return [f"- {c}: 貸出可 {counts[c]}" for c in campus_order(counts)]
 
 def make_prefix(category: str) -> str:
     p = "".join(ch for ch in category if ch.isalnum()).upper()
     return p[:8] if p else "CAT"
 
-def generate_item_id(category: str) -> str:
+def generate_item_id(category: str, pending: Iterable[str] = ()) -> str:
+    """pending: まだシートに送っていない採番済みID"""
     pref = make_prefix(category)
-    existing = inv_ws.col_values(1)[1:]
+    existing = inv_ws.col_values(1)[1:] + list(pending)
     max_n = 0
     for s in existing:
         if s.startswith(pref + "-") and s[len(pref) + 1:].isdigit():
             max_n = max(max_n, int(s[len(pref) + 1:]))
     return f"{pref}-{max_n + 1:03d}"
 
-def proj_all() -> List[dict]:
+def proj_all() -> List[Project]:
     """projects シートからプロジェクト一覧を取得"""
-    vals = proj_ws.get_all_values()
-    if len(vals) < 2:
-        return []
-    res = []
-    for r in vals[1:]:
-        name = (r[0].strip() if len(r) > 0 else "")
-        desc = (r[1].strip() if len(r) > 1 else "")
-        if name:
-            res.append({"name": name, "desc": desc})
-    return res
+    return current_tenant().records("projects", parse_projects)
 
 async def maybe_announce(current_channel: discord.abc.Messageable, text: str):
-    ch_id = cfg_get("ANNOUNCE_CHANNEL_ID")
     if isinstance(current_channel, discord.Interaction):
         guild = current_channel.guild
     else:
         guild = getattr(current_channel, "guild", None)
 
-    if ch_id and guild:
+    if guild:
         try:
-            ch = guild.get_channel(int(ch_id))
-            if ch:
-                await ch.send(f"📢 {text}")
+            dest = await resolve_destination(guild)
+            if dest.channel:
+                await dest.channel.send(f"📢 {text}")
                 return
         except Exception:
             pass
@@ -283,6 +1031,8 @@ async def notify_request(source, text: str):
       - user:<id>
     を元にメンションを付けて ANNOUNCE_CHANNEL_ID へ送信。
     無ければ現在のチャンネルにそのまま送信。
+    送信先とメンションは resolve_destination でキャッシュされるため、
+    通常は送信の 1 回だけが Discord API 呼び出しになる。
     """
     guild = None
     channel = None
@@ -294,8 +1044,229 @@ async def notify_request(source, text: str):
         channel = source.channel
 
     mention = ""
-    target = cfg_get("LOAN_NOTIFY_TARGET")
-    if target and guild:
+    if guild:
+        dest = await resolve_destination(guild)
+        mention = dest.mention
+        # 送信先チャンネル（admin用に ANNOUNCE_CHANNEL_ID を優先）
+        if dest.channel:
+            channel = dest.channel
+
+    if channel:
+        msg = f"{mention} {text}" if mention else text
+        await channel.send(msg)
+
+# ========= メンバー / ロール検索インデックス =========
+def norm_name(s: str) -> str:
+    """検索用の正規化（全角半角の統一 + 大文字小文字無視）"""
+    return unicodedata.normalize("NFKC", s or "").casefold().strip()
+
+class MemberIndex:
+    """
+    ギルドごとの検索インデックス。
+      - ID → メンバー
+      - 表示名 / ユーザー名（正規化済み）→ メンバー
+      - ロール名（正規化済み）→ ロール
+    members インテントを使わないので全メンバーは持たない。操作したメンバーと、
+    ID の fetch / 名前の query_members で取得したメンバーだけが入る。ロールはイベントで差分更新する。
+    """
+
+    def __init__(self, guild: discord.Guild):
+        self.guild_id = guild.id
+        self.by_id: Dict[int, discord.Member] = {}
+        self.by_name: Dict[str, Dict[int, discord.Member]] = {}
+        self.roles_by_name: Dict[str, Dict[int, discord.Role]] = {}
+        self._member_keys: Dict[int, Tuple[str, ...]] = {}
+        self._role_keys: Dict[int, str] = {}
+        self._sorted: Optional[List[Tuple[str, str]]] = None  # (正規化名, 種別) 前方一致用
+        for m in guild.members:
+            self.add_member(m)
+        for r in guild.roles:
+            if not r.is_default():
+                self.add_role(r)
+
+    # ---- メンバー ----
+    def add_member(self, member: discord.Member):
+        self.remove_member(member.id)
+        keys = tuple({norm_name(member.display_name), norm_name(member.name)} - {""})
+        self.by_id[member.id] = member
+        self._member_keys[member.id] = keys
+        for k in keys:
+            self.by_name.setdefault(k, {})[member.id] = member
+        self._sorted = None
+
+    def remove_member(self, member_id: int):
+        self.by_id.pop(member_id, None)
+        for k in self._member_keys.pop(member_id, ()):
+            bucket = self.by_name.get(k)
+            if bucket is not None:
+                bucket.pop(member_id, None)
+                if not bucket:
+                    del self.by_name[k]
+        self._sorted = None
+
+    def get_member(self, member_id: int) -> Optional[discord.Member]:
+        return self.by_id.get(member_id)
+
+    def note_member(self, member: discord.Member):
+        """操作したメンバーを取り込む（名前が変わっていなければ何もしない）"""
+        keys = self._member_keys.get(member.id)
+        if keys is None or set(keys) != {norm_name(member.display_name), norm_name(member.name)} - {""}:
+            self.add_member(member)
+        else:
+            self.by_id[member.id] = member
+
+    def find_member(self, name: str) -> Optional[discord.Member]:
+        bucket = self.by_name.get(norm_name(name))
+        if not bucket:
+            return None
+        return next(iter(bucket.values()))
+
+    # ---- ロール ----
+    def add_role(self, role: discord.Role):
+        self.remove_role(role.id)
+        k = norm_name(role.name)
+        if not k:
+            return
+        self.roles_by_name.setdefault(k, {})[role.id] = role
+        self._role_keys[role.id] = k
+        self._sorted = None
+
+    def remove_role(self, role_id: int):
+        k = self._role_keys.pop(role_id, None)
+        if k is None:
+            return
+        bucket = self.roles_by_name.get(k)
+        if bucket is not None:
+            bucket.pop(role_id, None)
+            if not bucket:
+                del self.roles_by_name[k]
+        self._sorted = None
+
+    def find_role(self, name: str) -> Optional[discord.Role]:
+        bucket = self.roles_by_name.get(norm_name(name))
+        if not bucket:
+            return None
+        return next(iter(bucket.values()))
+
+    # ---- 前方一致（候補表示用） ----
+    def suggest(self, prefix: str, limit: int = 5) -> List[str]:
+        """正規化した前方一致で候補名を返す（ロールは @ 付き）"""
+        p = norm_name(prefix)
+        if not p:
+            return []
+        if self._sorted is None:
+            keys = [(k, "member") for k in self.by_name] + [(k, "role") for k in self.roles_by_name]
+            self._sorted = sorted(keys)
+        out: List[str] = []
+        i = bisect.bisect_left(self._sorted, (p, ""))
+        while i < len(self._sorted) and len(out) < limit:
+            k, kind = self._sorted[i]
+            if not k.startswith(p):
+                break
+            if kind == "role":
+                role = self.find_role(k)
+                if role and f"@{role.name}" not in out:
+                    out.append(f"@{role.name}")
+            else:
+                for m in self.by_name.get(k, {}).values():
+                    if m.display_name not in out:
+                        out.append(m.display_name)
+            i += 1
+        return out[:limit]
+
+_member_indexes: Dict[int, MemberIndex] = {}
+
+def member_index(guild: discord.Guild) -> MemberIndex:
+    """ギルドの検索インデックスを取得（初回のみキャッシュ済みの guild.members から構築）"""
+    idx = _member_indexes.get(guild.id)
+    if idx is None:
+        idx = MemberIndex(guild)
+        _member_indexes[guild.id] = idx
+    return idx
+
+async def resolve_member_id(guild: discord.Guild, user_id: int) -> Optional[discord.Member]:
+    """インデックス → キャッシュ → fetch_member の順で ID からメンバーを取得"""
+    idx = member_index(guild)
+    member = idx.get_member(user_id) or guild.get_member(user_id)
+    if member is None:
+        try:
+            member = await guild.fetch_member(user_id)
+        except Exception:
+            member = None
+    if member is not None:
+        idx.add_member(member)
+    return member
+
+MEMBER_QUERY_LIMIT = 20
+
+async def find_member_by_name(guild: discord.Guild, name: str) -> Optional[discord.Member]:
+    """
+    インデックス → query_members（表示名/ユーザー名の前方一致をゲートウェイに問い合わせ）の順で探す。
+    問い合わせ結果はインデックスに入るので、見つからなかった場合の候補表示にも使われる。
+    """
+    idx = member_index(guild)
+    member = idx.find_member(name)
+    if member is not None or not norm_name(name):
+        return member
+    try:
+        found = await guild.query_members(query=name, limit=MEMBER_QUERY_LIMIT, cache=False)
+    except (asyncio.TimeoutError, discord.HTTPException):
+        return None
+    for m in found:
+        idx.add_member(m)
+    return idx.find_member(name)
+
+def suggest_text(guild: discord.Guild, raw: str) -> str:
+    cands = member_index(guild).suggest(raw)
+    if not cands:
+        return ""
+    return "\n\nもしかして: " + " / ".join(cands)
+
+# ========= 通知先キャッシュ =========
+DEST_KEYS = ("ANNOUNCE_CHANNEL_ID", "LOAN_NOTIFY_TARGET")
+
+DEST_MISS_TTL_SEC = 60  # 設定はあるのに見つからなかったチャンネル/ロールを引き直すまでの秒数
+
+class Destination:
+    """解決済みの通知先（お知らせチャンネル + メンション文字列）。expires は引き直す時刻（0 なら破棄されるまで有効）"""
+    __slots__ = ("channel", "mention", "target_kind", "target_id", "expires")
+
+    def __init__(self, channel, mention: str, target_kind: str, target_id: Optional[int], expires: float = 0.0):
+        self.channel = channel
+        self.mention = mention
+        self.target_kind = target_kind
+        self.target_id = target_id
+        self.expires = expires
+
+_dest_cache: Dict[int, Destination] = {}
+
+def invalidate_destinations(guild_id: Optional[int] = None):
+    if guild_id is None:
+        _dest_cache.clear()
+    else:
+        _dest_cache.pop(guild_id, None)
+
+async def resolve_destination(guild: discord.Guild) -> Destination:
+    """
+    ANNOUNCE_CHANNEL_ID と LOAN_NOTIFY_TARGET を解決してギルド単位でキャッシュ。
+    cfg_set でのキー変更、対象ロール/チャンネルの削除で破棄される。
+    設定があるのにギルドのキャッシュに見つからなかった場合は、DEST_MISS_TTL_SEC 後に引き直す。
+    """
+    dest = _dest_cache.get(guild.id)
+    if dest is not None and not (dest.expires and dest.expires < time.monotonic()):
+        return dest
+
+    ch_id, target = await asyncio.to_thread(destination_config)
+    channel = None
+    if ch_id:
+        try:
+            channel = guild.get_channel(int(ch_id))
+        except Exception:
+            channel = None
+
+    mention = ""
+    kind, target_id = "", None
+    if target:
         kind, _, id_str = target.partition(":")
         try:
             target_id = int(id_str)
@@ -307,34 +1278,288 @@ async def notify_request(source, text: str):
                 if role:
                     mention = role.mention
             elif kind == "user":
-                member = guild.get_member(target_id)
-                if member is None:
-                    try:
-                        member = await guild.fetch_member(target_id)
-                    except Exception:
-                        member = None
+                member = await resolve_member_id(guild, target_id)
                 if member:
                     mention = member.mention
 
-    # 送信先チャンネル（admin用に ANNOUNCE_CHANNEL_ID を優先）
-    ch_id = cfg_get("ANNOUNCE_CHANNEL_ID")
-    if guild and ch_id:
-        c = guild.get_channel(int(ch_id))
-        if c:
-            channel = c
+    missed = (ch_id and channel is None) or (target and not mention)
+    dest = Destination(channel, mention, kind, target_id, time.monotonic() + DEST_MISS_TTL_SEC if missed else 0.0)
+    _dest_cache[guild.id] = dest
+    return dest
 
-    if channel:
-        msg = f"{mention} {text}" if mention else text
-        await channel.send(msg)
+def destination_config() -> Tuple[Optional[str], Optional[str]]:
+    return cfg_get("ANNOUNCE_CHANNEL_ID"), cfg_get("LOAN_NOTIFY_TARGET")
+
+def tenant_guilds(t: "Tenant") -> List[discord.Guild]:
+    """テナントに対応する参加中のギルド"""
+    out = []
+    for guild in bot.guilds:
+        try:
+            if tenants.for_guild(guild.id) is t:
+                out.append(guild)
+        except TenantNotConfigured:
+            continue
+    return out
+
+async def announce_channel():
+    """
+    現在のテナントのお知らせチャンネル（無ければ None）。
+    ギルドに紐付かない定期処理（延滞通知・不整合チェック）用で、resolve_destination のキャッシュを通す
+    """
+    for guild in tenant_guilds(current_tenant()):
+        dest = await resolve_destination(guild)
+        if dest.channel is not None:
+            return dest.channel
+    return None
+
+def _drop_destination_if(guild_id: int, kind: str, target_id: int):
+    dest = _dest_cache.get(guild_id)
+    if dest is None:
+        return
+    if kind == "channel":
+        if dest.channel is not None and dest.channel.id == target_id:
+            invalidate_destinations(guild_id)
+    elif dest.target_kind == kind and dest.target_id == target_id:
+        invalidate_destinations(guild_id)
+
+# ========= 操作のレート制限 =========
+# 1 人が在庫状況や貸出メニューを連打すると、共有の Sheets 読み取りクォータを使い切って全員が遅くなる。
+# 操作を「読み取り（メニュー・一覧）」と「書き込み（申請の送信）」に分け、
+# ユーザーごと・ギルドごとのトークンバケットで回数を抑える。管理者は対象外。
+# 上限（回/分、0 で無制限）は config シートの次のキーで変えられる。
+RATE_LIMIT_DEFAULTS = {
+    ("read", "user"): ("RATE_READ_PER_MIN_USER", 20.0),
+    ("write", "user"): ("RATE_WRITE_PER_MIN_USER", 6.0),
+    ("read", "guild"): ("RATE_READ_PER_MIN_GUILD", 300.0),
+    ("write", "guild"): ("RATE_WRITE_PER_MIN_GUILD", 60.0),
+}
+RATE_LIMIT_MAX_DELAY_SEC = 1.0  # これ以内で空くなら断らずに待たせる（3 秒の応答期限に収まる範囲）
+RATE_LIMIT_MAX_BUCKETS = 4096
+RATE_WRITE_COMPONENTS = {"sel_items_reserve", "sel_res_cancel"}  # モーダル以外で書き込みになる部品
+
+def rate_limits() -> Dict[Tuple[str, str], float]:
+    """
+    (種類, 範囲) → 1 分あたりの上限（config シートの値、無ければ既定値）。
+    操作のたびに呼ばれるので、最後に読んだ config を使うだけで Sheets は読まない
+    （取り直しは admit_interaction が裏で頼む。cfg_set の書き込みはキャッシュにすぐ反映される）
+    """
+    cfg = current_tenant().peek_records("config", parse_config)
+    out = {}
+    for key, (cfg_key, default) in RATE_LIMIT_DEFAULTS.items():
+        try:
+            out[key] = float(cfg.get(cfg_key) or default)
+        except ValueError:
+            out[key] = default
+    return out
+
+class RateLimiter:
+    """テナント内の (種類, 範囲, ユーザーID/ギルドID) ごとのトークンバケット（ループ上でのみ使う）"""
+
+    def __init__(self):
+        self.buckets: Dict[Tuple[str, str, int], TokenBucket] = {}
+        self.stats = {"allowed": 0, "delayed": 0, "rejected": 0, "rejected_read": 0, "rejected_write": 0}
+
+    def bucket(self, kind: str, scope: str, owner: int, per_min: float) -> TokenBucket:
+        key = (kind, scope, owner)
+        bk = self.buckets.get(key)
+        if bk is None or bk.capacity != per_min:  # config で上限が変わったら作り直す
+            if len(self.buckets) >= RATE_LIMIT_MAX_BUCKETS:
+                self.prune()
+            bk = self.buckets[key] = TokenBucket(per_min)
+        return bk
+
+    def prune(self):
+        """満タンに戻った（しばらく使われていない）バケットを捨てる"""
+        for key in [k for k, bk in self.buckets.items() if bk.peek(bk.capacity) == 0]:
+            del self.buckets[key]
+
+    def acquire(self, kind: str, user_id: int, guild_id: Optional[int]) -> Optional[float]:
+        """1 回分を取る。戻り値は待つべき秒数（0 ならすぐ）、上限を超えていて取れなければ None"""
+        limits = rate_limits()
+        owners = [("user", user_id)] + ([("guild", guild_id)] if guild_id is not None else [])
+        buckets = [self.bucket(kind, scope, owner, limits[(kind, scope)])
+                   for scope, owner in owners if limits[(kind, scope)] > 0]
+        wait = max((bk.peek() for bk in buckets), default=0.0)
+        if wait > RATE_LIMIT_MAX_DELAY_SEC:
+            self.stats["rejected"] += 1
+            self.stats[f"rejected_{kind}"] += 1
+            return None
+        for bk in buckets:
+            bk.reserve()
+        self.stats["delayed" if wait > 0 else "allowed"] += 1
+        return wait
+
+def rate_limit_summary() -> str:
+    limits = rate_limits()
+
+    def fmt(v: float) -> str:
+        return f"{v:g}" if v > 0 else "無制限"
+
+    return (f"ユーザー 読み取り {fmt(limits[('read', 'user')])}・書き込み {fmt(limits[('write', 'user')])} /分、"
+            f"ギルド 読み取り {fmt(limits[('read', 'guild')])}・書き込み {fmt(limits[('write', 'guild')])} /分")
+
+def rate_exempt(user) -> bool:
+    return hasattr(user, "roles") and is_admin(user)
+
+async def admit_interaction(itx: discord.Interaction, kind: str) -> bool:
+    """レート制限。少し待てば空くなら待ってから通し、超えていれば案内を返して弾く"""
+    if rate_exempt(itx.user):
+        return True
+    t = current_tenant()
+    t.refresh_soon("config")
+    wait = t.limiter.acquire(kind, itx.user.id, itx.guild.id if itx.guild else None)
+    if wait is None:
+        await itx.response.send_message(
+            "⏳ 操作が続いているため、少し時間をおいてからもう一度お試しください。", ephemeral=True,
+        )
+        return False
+    if wait > 0:
+        await asyncio.sleep(wait)
+    return True
+
+def component_kind(itx: discord.Interaction) -> str:
+    custom_id = (itx.data or {}).get("custom_id", "")
+    return "write" if custom_id in RATE_WRITE_COMPONENTS else "read"
 
 # ========= Discord Bot =========
-intents = discord.Intents.default()
-intents.message_content = True
-intents.members = True  # メンバー取得に必要
-bot = commands.Bot(command_prefix="!", intents=intents)
+async def bind_interaction(itx: discord.Interaction) -> bool:
+    try:
+        bind_tenant(itx.guild)
+    except TenantNotConfigured as e:
+        await itx.response.send_message(str(e), ephemeral=True)
+        return False
+    if itx.guild is not None and isinstance(itx.user, discord.Member):
+        member_index(itx.guild).note_member(itx.user)
+    return True
+
+async def reply_error(itx: discord.Interaction, text: str):
+    if itx.response.is_done():
+        await itx.followup.send(text, ephemeral=True)
+    else:
+        await itx.response.send_message(text, ephemeral=True)
+
+class LoanLinkView(ui.View):
+    """全 View の基底。操作されたギルドのテナントをコールバックのタスクに結び付ける"""
+
+    async def interaction_check(self, itx: discord.Interaction) -> bool:
+        return await bind_interaction(itx) and await admit_interaction(itx, component_kind(itx))
+
+    async def on_error(self, itx: discord.Interaction, error: Exception, item: ui.Item):
+        if isinstance(error, (SheetsUnavailable, Overloaded, MutationRejected)):
+            return await reply_error(itx, str(error))
+        await super().on_error(itx, error, item)
+
+class LoanLinkModal(ui.Modal):
+    """全 Modal の基底（LoanLinkView と同じくテナントを結び付ける）"""
+
+    async def interaction_check(self, itx: discord.Interaction) -> bool:
+        return await bind_interaction(itx) and await admit_interaction(itx, "write")
+
+    async def on_error(self, itx: discord.Interaction, error: Exception):
+        if isinstance(error, (SheetsUnavailable, Overloaded, MutationRejected)):
+            return await reply_error(itx, str(error))
+        await super().on_error(itx, error)
+
+bot: Optional[commands.Bot] = None  # create_app() で生成
+
+# ========= インタラクションのワーカー =========
+# Discord には 3 秒以内に応答しないといけない。Sheets を触るハンドラは先に defer して、
+# 重い処理（同期関数）はここのワーカーで実行し、結果は followup か元メッセージの編集で返す。
+INTERACTION_WORKERS = int(os.getenv("INTERACTION_WORKERS", "4"))
+WORK_QUEUE_LIMIT = 64    # 全体で待たせる最大件数
+WORK_PER_USER_LIMIT = 3  # 1 ユーザーが積める最大件数
+
+class Overloaded(RuntimeError):
+    def __init__(self, msg: str = "現在処理が混み合っています。少し時間をおいてからもう一度お試しください。"):
+        super().__init__(msg)
+
+class WorkPool:
+    """
+    重い処理を workers 本のワーカーで順に実行する。
+    待ち行列はユーザーごとに持ち、ワーカーはユーザーを順番に回って 1 件ずつ取り出すので、
+    1 人が連打しても他のユーザーの処理は後回しにならない。上限を超えたら Overloaded。
+    """
+
+    def __init__(self, workers: int, limit: int, per_user: int):
+        self.workers = workers
+        self.limit = limit
+        self.per_user = per_user
+        self.queues: Dict[int, deque] = {}
+        self.turns: deque = deque()  # 待ちのあるユーザー（ラウンドロビン）
+        self.depth = 0
+        self.running = 0
+        self.stats = {"done": 0, "failed": 0, "rejected": 0, "max_depth": 0}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._ready: Optional[asyncio.Semaphore] = None
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        self._loop = loop
+        self._ready = asyncio.Semaphore(self.depth)
+        for _ in range(self.workers):
+            loop.create_task(self._worker())
+
+    def submit(self, user_id: int, work, *args) -> asyncio.Future:
+        """work(*args) を積む。呼び出し時のテナントはそのままワーカー側に引き継ぐ"""
+        self.start()
+        q = self.queues.get(user_id)
+        if self.depth >= self.limit or (q is not None and len(q) >= self.per_user):
+            self.stats["rejected"] += 1
+            raise Overloaded()
+        fut = self._loop.create_future()
+        if q is None:
+            q = self.queues[user_id] = deque()
+            self.turns.append(user_id)
+        q.append((_tenant_var.get(), work, args, fut))
+        self.depth += 1
+        self.stats["max_depth"] = max(self.stats["max_depth"], self.depth)
+        self._ready.release()
+        return fut
+
+    def _next(self):
+        uid = self.turns.popleft()
+        q = self.queues[uid]
+        job = q.popleft()
+        if q:
+            self.turns.append(uid)
+        else:
+            del self.queues[uid]
+        self.depth -= 1
+        return job
+
+    async def _worker(self):
+        while True:
+            await self._ready.acquire()
+            tenant, work, args, fut = self._next()
+            if fut.cancelled():
+                continue
+            self.running += 1
+            try:
+                with tenant_scope(tenant):
+                    result = await asyncio.to_thread(work, *args)
+            except Exception as e:
+                self.stats["failed"] += 1
+                if not fut.cancelled():
+                    fut.set_exception(e)
+            else:
+                self.stats["done"] += 1
+                if not fut.cancelled():
+                    fut.set_result(result)
+            finally:
+                self.running -= 1
+
+work_pool = WorkPool(INTERACTION_WORKERS, WORK_QUEUE_LIMIT, WORK_PER_USER_LIMIT)
+
+async def run_deferred(itx: discord.Interaction, work, *args, thinking: bool = False):
+    """先に応答を保留（defer）してから work(*args) をワーカーで実行し、戻り値を返す"""
+    if not itx.response.is_done():
+        await itx.response.defer(ephemeral=True, thinking=thinking)
+    return await work_pool.submit(itx.user.id, work, *args)
 
 # ========= 停止期間 Admin UI =========
-class BlackoutAdminView(ui.View):
+class BlackoutAdminView(LoanLinkView):
     def __init__(self):
         super().__init__(timeout=120)
         self.add_item(SetFestivalButton())
@@ -379,19 +1604,19 @@ class ToggleCustomBlackoutButton(ui.Button):
     async def callback(self, itx: discord.Interaction):
         if not is_admin(itx.user):
             return await itx.response.send_message("権限がありません。", ephemeral=True)
-        customs = [b for b in blk_list() if b["種別"] == "custom"]
+        customs = [b for b in await run_deferred(itx, blk_list) if b.kind == "custom"]
         if not customs:
-            return await itx.response.send_message("カスタム停止は未登録です。", ephemeral=True)
+            return await itx.followup.send("カスタム停止は未登録です。", ephemeral=True)
         opts = [
             discord.SelectOption(
-                label=f"{b['名前']}（{human_period(b)}）{'✅' if b['有効'] else '⛔'}",
-                value=b["名前"],
+                label=f"{b.name}（{human_period(b)}）{'✅' if b.active else '⛔'}",
+                value=b.name,
             )
             for b in customs[:25]
         ]
-        view = ui.View(timeout=60)
+        view = LoanLinkView(timeout=60)
         view.add_item(ToggleCustomSelect(opts))
-        await itx.response.send_message("有効/無効を切り替える項目を選択：", view=view, ephemeral=True)
+        await itx.followup.send("有効/無効を切り替える項目を選択：", view=view, ephemeral=True)
 
 class ToggleCustomSelect(ui.Select):
     def __init__(self, opts):
@@ -399,12 +1624,18 @@ class ToggleCustomSelect(ui.Select):
 
     async def callback(self, itx: discord.Interaction):
         name = self.values[0]
-        items = [b for b in blk_list() if b["名前"] == name]
-        if not items:
-            return await itx.response.send_message("対象が見つかりませんでした。", ephemeral=True)
-        new_state = not items[0]["有効"]
-        blk_toggle(name, new_state)
-        await itx.response.send_message(f"「{name}」を{'有効化' if new_state else '無効化'}しました。", ephemeral=True)
+
+        def toggle() -> Optional[bool]:
+            items = [b for b in blk_list() if b.name == name]
+            if not items:
+                return None
+            blk_toggle(name, not items[0].active)
+            return not items[0].active
+
+        new_state = await run_deferred(itx, toggle)
+        if new_state is None:
+            return await itx.followup.send("対象が見つかりませんでした。", ephemeral=True)
+        await itx.followup.send(f"「{name}」を{'有効化' if new_state else '無効化'}しました。", ephemeral=True)
         await maybe_announce(itx, f"停止期間「{name}」を{'有効化' if new_state else '無効化'}しました。")
 
 class DeleteBlackoutButton(ui.Button):
@@ -414,19 +1645,19 @@ class DeleteBlackoutButton(ui.Button):
     async def callback(self, itx: discord.Interaction):
         if not is_admin(itx.user):
             return await itx.response.send_message("権限がありません。", ephemeral=True)
-        items = blk_list()
+        items = await run_deferred(itx, blk_list)
         if not items:
-            return await itx.response.send_message("停止期間は未設定です。", ephemeral=True)
+            return await itx.followup.send("停止期間は未設定です。", ephemeral=True)
         opts = [
             discord.SelectOption(
-                label=f"[{b['種別']}] {b['名前']}（{human_period(b)}）",
-                value=b["名前"],
+                label=f"[{b.kind}] {b.name}（{human_period(b)}）",
+                value=b.name,
             )
             for b in items[:25]
         ]
-        view = ui.View(timeout=60)
+        view = LoanLinkView(timeout=60)
         view.add_item(DeleteBlackoutSelect(opts))
-        await itx.response.send_message("削除する停止期間を選択：", view=view, ephemeral=True)
+        await itx.followup.send("削除する停止期間を選択：", view=view, ephemeral=True)
 
 class DeleteBlackoutSelect(ui.Select):
     def __init__(self, opts):
@@ -434,12 +1665,12 @@ class DeleteBlackoutSelect(ui.Select):
 
     async def callback(self, itx: discord.Interaction):
         name = self.values[0]
-        ok = blk_delete(name)
+        ok = await run_deferred(itx, blk_delete, name)
         if ok:
-            await itx.response.send_message(f"停止期間「{name}」を削除しました。", ephemeral=True)
+            await itx.followup.send(f"停止期間「{name}」を削除しました。", ephemeral=True)
             await maybe_announce(itx, f"停止期間「{name}」を削除しました。")
         else:
-            await itx.response.send_message("削除対象が見つかりませんでした。", ephemeral=True)
+            await itx.followup.send("削除対象が見つかりませんでした。", ephemeral=True)
 
 class SetAnnounceHereButton(ui.Button):
     def __init__(self):
@@ -448,70 +1679,71 @@ class SetAnnounceHereButton(ui.Button):
     async def callback(self, itx: discord.Interaction):
         if not is_admin(itx.user):
             return await itx.response.send_message("権限がありません。", ephemeral=True)
-        cfg_set("ANNOUNCE_CHANNEL_ID", str(itx.channel.id))
-        await itx.response.send_message("このチャンネルをお知らせ先に設定しました。", ephemeral=True)
+        await run_deferred(itx, cfg_set, "ANNOUNCE_CHANNEL_ID", str(itx.channel.id))
+        await itx.followup.send("このチャンネルをお知らせ先に設定しました。", ephemeral=True)
 
 class ListBlackoutsButton(ui.Button):
     def __init__(self):
         super().__init__(label="現在の停止設定を表示", style=discord.ButtonStyle.secondary, custom_id="blk_list")
 
     async def callback(self, itx: discord.Interaction):
-        blks = blk_list()
+        blks = await run_deferred(itx, blk_list)
         if not blks:
-            return await itx.response.send_message("停止期間は未設定です。", ephemeral=True)
+            return await itx.followup.send("停止期間は未設定です。", ephemeral=True)
         lines = ["**停止期間一覧**"]
         for b in blks:
-            mk = "✅" if b["有効"] else "⛔"
-            lines.append(f"- {mk} [{b['種別']}] {b['名前'] or '(無題)'}: {human_period(b)}")
-        await itx.response.send_message("\n".join(lines), ephemeral=True)
+            mk = "✅" if b.active else "⛔"
+            lines.append(f"- {mk} [{b.kind}] {b.name or '(無題)'}: {human_period(b)}")
+        await itx.followup.send("\n".join(lines), ephemeral=True)
 
-class FestivalModal(ui.Modal, title="文化祭 期間設定（毎年）"):
+class FestivalModal(LoanLinkModal, title="文化祭 期間設定（毎年）"):
     start = ui.TextInput(label="開始（MM-DD）", placeholder="例: 09-20", required=True, max_length=5)
     end = ui.TextInput(label="終了（MM-DD）", placeholder="例: 11-05", required=True, max_length=5)
 
     async def on_submit(self, itx: discord.Interaction):
-        for b in blk_list():
-            if b["種別"] == "festival":
-                blk_toggle(b["名前"], False)
-        blk_add("festival", "文化祭", str(self.start), str(self.end), "recurring", True)
-        await itx.response.send_message(f"文化祭: {self.start}〜{self.end} を設定しました。", ephemeral=True)
+        await run_deferred(itx, blk_replace, "festival", "文化祭", str(self.start), str(self.end))
+        await itx.followup.send(f"文化祭: {self.start}〜{self.end} を設定しました。", ephemeral=True)
         await maybe_announce(itx, f"文化祭期間を **{self.start}〜{self.end}** に設定しました。")
 
-class RecruitModal(ui.Modal, title="新歓 期間設定（毎年）"):
+class RecruitModal(LoanLinkModal, title="新歓 期間設定（毎年）"):
     start = ui.TextInput(label="開始（MM-DD）", placeholder="例: 04-01", required=True, max_length=5)
     end = ui.TextInput(label="終了（MM-DD）", placeholder="例: 05-15", required=True, max_length=5)
 
     async def on_submit(self, itx: discord.Interaction):
-        for b in blk_list():
-            if b["種別"] == "recruit":
-                blk_toggle(b["名前"], False)
-        blk_add("recruit", "新歓", str(self.start), str(self.end), "recurring", True)
-        await itx.response.send_message(f"新歓: {self.start}〜{self.end} を設定しました。", ephemeral=True)
+        await run_deferred(itx, blk_replace, "recruit", "新歓", str(self.start), str(self.end))
+        await itx.followup.send(f"新歓: {self.start}〜{self.end} を設定しました。", ephemeral=True)
         await maybe_announce(itx, f"新歓期間を **{self.start}〜{self.end}** に設定しました。")
 
-class AddCustomModal(ui.Modal, title="カスタム停止 追加（単発）"):
+class AddCustomModal(LoanLinkModal, title="カスタム停止 追加（単発）"):
     name = ui.TextInput(label="名前", placeholder="例: 学内イベント対応", required=True, max_length=50)
     start = ui.TextInput(label="開始（YYYY-MM-DD）", placeholder="例: 2025-10-25", required=True, max_length=10)
     end = ui.TextInput(label="終了（YYYY-MM-DD）", placeholder="例: 2025-10-28", required=True, max_length=10)
 
     async def on_submit(self, itx: discord.Interaction):
-        blk_add("custom", str(self.name), str(self.start), str(self.end), "once", True)
-        await itx.response.send_message(
+        await run_deferred(itx, blk_add, "custom", str(self.name), str(self.start), str(self.end), "once", True)
+        await itx.followup.send(
             f"カスタム停止を追加: {self.name} / {self.start}〜{self.end}",
             ephemeral=True,
         )
         await maybe_announce(itx, f"カスタム停止 **{self.name}** を {self.start}〜{self.end} で有効化しました。")
 
 # ========= Admin メニュー =========
-class AdminPanelView(ui.View):
+class AdminPanelView(LoanLinkView):
     def __init__(self):
         super().__init__(timeout=None)
         self.add_item(RegisterItemButton())
         self.add_item(AdminInventoryListButton())
         self.add_item(AdminRequestsPeekButton())
+        self.add_item(AdminItemHistoryButton())
+        self.add_item(AdminExportRequestsButton())
+        self.add_item(AdminConsistencyButton())
+        self.add_item(AdminReconcileButton())
+        self.add_item(AdminMetricsButton())
+        self.add_item(AdminStatusBoardButton())
         self.add_item(AdminApproveLoansButton())
         self.add_item(AdminApproveReturnsButton())
         self.add_item(AdminManualLoanButton())          # 手動貸出
+        self.add_item(AdminDueListButton())             # 延滞・返却予定
         self.add_item(SetLoanNotifyTargetButton())      # 貸出通知メンション設定
         self.add_item(OpenBlackoutAdminButton())
 
@@ -534,7 +1766,7 @@ class SetLoanNotifyTargetButton(ui.Button):
             return await itx.response.send_message("権限がありません。", ephemeral=True)
         await itx.response.send_modal(SetLoanNotifyTargetModal())
 
-class SetLoanNotifyTargetModal(ui.Modal, title="貸出通知のメンション先を設定"):
+class SetLoanNotifyTargetModal(LoanLinkModal, title="貸出通知のメンション先を設定"):
     target = ui.TextInput(
         label="メンションまたはID",
         placeholder="例: @機材管理ロール / @ユーザー / 123456789012345678",
@@ -560,8 +1792,8 @@ class SetLoanNotifyTargetModal(ui.Modal, title="貸出通知のメンション
             role = guild.get_role(target_id)
             if not role:
                 return await itx.response.send_message("そのロールはサーバー内に見つかりません。", ephemeral=True)
-            cfg_set("LOAN_NOTIFY_TARGET", f"role:{target_id}")
-            return await itx.response.send_message(
+            await run_deferred(itx, cfg_set, "LOAN_NOTIFY_TARGET", f"role:{target_id}")
+            return await itx.followup.send(
                 f"今後の貸出申請通知はロール {role.mention} をメンションします。",
                 ephemeral=True,
             )
@@ -569,16 +1801,11 @@ class SetLoanNotifyTargetModal(ui.Modal, title="貸出通知のメンション
         # 2) ユーザーメンション
         if m_user:
             target_id = int(m_user.group(1))
-            member = guild.get_member(target_id)
-            if member is None:
-                try:
-                    member = await guild.fetch_member(target_id)
-                except Exception:
-                    member = None
+            member = await resolve_member_id(guild, target_id)
             if not member:
                 return await itx.response.send_message("そのユーザーはサーバー内に見つかりません。", ephemeral=True)
-            cfg_set("LOAN_NOTIFY_TARGET", f"user:{target_id}")
-            return await itx.response.send_message(
+            await run_deferred(itx, cfg_set, "LOAN_NOTIFY_TARGET", f"user:{target_id}")
+            return await itx.followup.send(
                 f"今後の貸出申請通知は {member.mention} をメンションします。",
                 ephemeral=True,
             )
@@ -588,44 +1815,35 @@ class SetLoanNotifyTargetModal(ui.Modal, title="貸出通知のメンション
             target_id = int(raw)
             role = guild.get_role(target_id)
             if role:
-                cfg_set("LOAN_NOTIFY_TARGET", f"role:{target_id}")
-                return await itx.response.send_message(
+                await run_deferred(itx, cfg_set, "LOAN_NOTIFY_TARGET", f"role:{target_id}")
+                return await itx.followup.send(
                     f"今後の貸出申請通知はロール {role.mention} をメンションします。",
                     ephemeral=True,
                 )
-            member = guild.get_member(target_id)
-            if member is None:
-                try:
-                    member = await guild.fetch_member(target_id)
-                except Exception:
-                    member = None
+            member = await resolve_member_id(guild, target_id)
             if member:
-                cfg_set("LOAN_NOTIFY_TARGET", f"user:{target_id}")
-                return await itx.response.send_message(
+                await run_deferred(itx, cfg_set, "LOAN_NOTIFY_TARGET", f"user:{target_id}")
+                return await itx.followup.send(
                     f"今後の貸出申請通知は {member.mention} をメンションします。",
                     ephemeral=True,
                 )
             return await itx.response.send_message("そのIDのロール/ユーザーは見つかりませんでした。", ephemeral=True)
 
-        # 4) 名前でロール検索
-        for r in guild.roles:
-            if r.name == raw:
-                cfg_set("LOAN_NOTIFY_TARGET", f"role:{r.id}")
-                return await itx.response.send_message(
-                    f"今後の貸出申請通知はロール {r.mention} をメンションします。",
-                    ephemeral=True,
-                )
+        # 4) 名前でロール検索（インデックス・大文字小文字無視）
+        index = member_index(guild)
+        r = index.find_role(raw.lstrip("@"))
+        if r:
+            await run_deferred(itx, cfg_set, "LOAN_NOTIFY_TARGET", f"role:{r.id}")
+            return await itx.followup.send(
+                f"今後の貸出申請通知はロール {r.mention} をメンションします。",
+                ephemeral=True,
+            )
 
-        # 5) 名前でユーザー検索
-        lower = raw.lower()
-        member = None
-        for m_ in guild.members:
-            if m_.display_name.lower() == lower or m_.name.lower() == lower:
-                member = m_
-                break
+        # 5) 名前でユーザー検索（表示名 / ユーザー名）
+        member = await find_member_by_name(guild, raw.lstrip("@"))
         if member:
-            cfg_set("LOAN_NOTIFY_TARGET", f"user:{member.id}")
-            return await itx.response.send_message(
+            await run_deferred(itx, cfg_set, "LOAN_NOTIFY_TARGET", f"user:{member.id}")
+            return await itx.followup.send(
                 f"今後の貸出申請通知は {member.mention} をメンションします。",
                 ephemeral=True,
             )
@@ -636,7 +1854,7 @@ class SetLoanNotifyTargetModal(ui.Modal, title="貸出通知のメンション
             "・ユーザーメンション（@ユーザー）\n"
             "・ID（数値）\n"
             "・名前（ロール名 or ユーザーの表示名/ユーザー名）\n"
-            "のいずれかで入力してください。",
+            "のいずれかで入力してください。" + suggest_text(guild, raw.lstrip("@")),
             ephemeral=True,
         )
 
@@ -648,50 +1866,65 @@ class RegisterItemButton(ui.Button):
     async def callback(self, itx: discord.Interaction):
         if not is_admin(itx.user):
             return await itx.response.send_message("権限がありません。", ephemeral=True)
-        cats = inv_categories()
+        cats = await run_deferred(itx, inv_categories)
         opts = [discord.SelectOption(label=c, value=c) for c in cats[:24]]
         opts.insert(0, discord.SelectOption(label="＋新規カテゴリ", value="__NEW__"))
-        view = ui.View(timeout=60)
+        view = LoanLinkView(timeout=60)
         view.add_item(RegisterCategorySelect(opts))
-        await itx.response.send_message("カテゴリを選択：", view=view, ephemeral=True)
+        await itx.followup.send("カテゴリを選択：", view=view, ephemeral=True)
 
 class RegisterCategorySelect(ui.Select):
     def __init__(self, opts):
         super().__init__(placeholder="カテゴリを選択", options=opts, custom_id="admin_sel_cat")
 
     async def callback(self, itx: discord.Interaction):
-        if self.values[0] == "__NEW__":
-            await itx.response.send_modal(RegisterItemModalNewCat())
-        else:
-            await itx.response.send_modal(RegisterItemModalExist(self.values[0]))
+        view = LoanLinkView(timeout=60)
+        view.add_item(RegisterCampusSelect(self.values[0]))
+        await itx.response.send_message("保管キャンパスを選択：", view=view, ephemeral=True)
 
-class RegisterItemModalExist(ui.Modal, title="機材登録（既存カテゴリ）"):
+class RegisterCampusSelect(ui.Select):
     def __init__(self, cat: str):
+        self.cat = cat
+        opts = [discord.SelectOption(label=c, value=c) for c in CAMPUS_CHOICES]
+        super().__init__(placeholder="保管キャンパスを選択", options=opts, custom_id="admin_sel_campus")
+
+    async def callback(self, itx: discord.Interaction):
+        campus = self.values[0]
+        if self.cat == "__NEW__":
+            await itx.response.send_modal(RegisterItemModalNewCat(campus))
+        else:
+            await itx.response.send_modal(RegisterItemModalExist(self.cat, campus))
+
+class RegisterItemModalExist(LoanLinkModal, title="機材登録（既存カテゴリ）"):
+    def __init__(self, cat: str, campus: str):
         super().__init__()
         self.cat = cat
+        self.campus = campus
         self.name = ui.TextInput(label="機材名", placeholder="例: Meta Quest 3 / MacBook Air M3", required=True)
         self.note = ui.TextInput(label="備考（任意）", placeholder="例: 付属品 /注意事項など", required=False)
         self.add_item(self.name)
         self.add_item(self.note)
 
     async def on_submit(self, itx: discord.Interaction):
-        cid = generate_item_id(self.cat)
-        inv_ws.append_row([cid, self.name.value, self.cat, self.note.value, "貸出可", "", ""])
-        await itx.response.send_message(
-            f"登録完了: {cid} / {self.name.value}\n備考: {self.note.value or '（なし）'}",
+        cid = await run_mutation(itx, RegisterItem(self.cat, self.name.value, self.note.value, self.campus))
+        await itx.followup.send(
+            f"登録完了: {cid} / {self.name.value}（{self.campus}）\n備考: {self.note.value or '（なし）'}",
             ephemeral=True,
         )
 
-class RegisterItemModalNewCat(ui.Modal, title="機材登録（新規カテゴリ）"):
+class RegisterItemModalNewCat(LoanLinkModal, title="機材登録（新規カテゴリ）"):
     cat = ui.TextInput(label="カテゴリ名", placeholder="例: HMD / ノートPC / コントローラ", required=True)
     name = ui.TextInput(label="機材名",   placeholder="例: Meta Quest 3 / ThinkPad X1 Carbon", required=True)
     note = ui.TextInput(label="備考（任意）", placeholder="例: 付属品 /注意事項など", required=False)
 
+    def __init__(self, campus: str):
+        super().__init__()
+        self.campus = campus
+
     async def on_submit(self, itx: discord.Interaction):
-        cid = generate_item_id(self.cat.value)
-        inv_ws.append_row([cid, self.name.value, self.cat.value, self.note.value, "貸出可", "", ""])
-        await itx.response.send_message(
-            f"登録完了: {cid} / {self.name.value}\n備考: {self.note.value or '（なし）'}",
+        cid = await run_mutation(itx, RegisterItem(self.cat.value, self.name.value, self.note.value, self.campus))
+        await itx.followup.send(
+            f"登録完了: {cid} / {self.name.value}（{self.campus}）\n備考: {self.note.value or '（なし）'}",
             ephemeral=True,
         )
 
@@ -700,85 +1933,462 @@ class AdminInventoryListButton(ui.Button):
         super().__init__(label="在庫一覧", style=discord.ButtonStyle.secondary, custom_id="admin_list")
 
     async def callback(self, itx: discord.Interaction):
-        recs = inv_all()
-        if not recs:
-            return await itx.response.send_message("在庫なし。", ephemeral=True)
-        st = {}
-        for r in recs:
-            key = r["ステータス"] or "不明"
-            st[key] = st.get(key, 0) + 1
-        msg = "**在庫状況**\n" + "\n".join(f"- {k}: {v}" for k, v in st.items())
-        await itx.response.send_message(msg, ephemeral=True)
+        msg = await run_deferred(itx, inventory_summary)
+        await itx.followup.send(msg or "在庫なし。", ephemeral=True)
+
+def inventory_summary() -> str:
+    """ステータス別・キャンパス別の台数（在庫が無ければ空文字）"""
+    recs = inv_all()
+    if not recs:
+        return ""
+    st = {}
+    for r in recs:
+        key = r.status or "不明"
+        st[key] = st.get(key, 0) + 1
+    msg = "**在庫状況**\n" + "\n".join(f"- {k}: {v}" for k, v in st.items())
+    return msg + "\n\n**キャンパス別**\n" + ("\n".join(campus_summary_lines()) or "- 貸出可の機材なし")
+
+LOG_PAGE_ROWS = 10
+TAIL_SLACK = 20  # Bot 以外からの追記に備えて、覚えている最終行の先まで読む行数
+
+def req_last_row(refresh: bool = False) -> int:
+    """requests の最終行（申請ID索引が覚えている値。分からなければ記録時刻の列から求める）"""
+    idx = current_tenant().req_index
+    if refresh or not idx.last_row:
+        rows = select_columns(req_ws, ["記録時刻"])
+        idx.last_row = rows[-1][0] if rows else 1
+    return idx.last_row
+
+def req_log_page(before: Optional[int] = None, limit: int = LOG_PAGE_ROWS) -> Tuple[List[RequestRecord], int]:
+    """
+    before 行より前（省略時は末尾）の最大 limit 件を新しい順に、1 回の範囲読みで返す。
+    2 つ目の値はこのページの先頭行（次に古いページを読むときの before）。
+    """
+    pos = [c - 1 for c in column_indexes("requests", REQ_HEADERS)]
+    end_col = col_letter(max(pos) + 1)
+
+    def read(start: int, end: int) -> List[Tuple[int, List[str]]]:
+        rows = req_ws.get(f"A{start}:{end_col}{end}") if start <= end else []
+        return [(start + k, r) for k, r in enumerate(rows) if any(r)]
+
+    if before is not None:
+        start = max(2, before - limit)
+        found = read(start, before - 1)
+    else:
+        idx = current_tenant().req_index
+        for attempt in range(2):
+            last = req_last_row(refresh=attempt > 0)
+            start, end = max(2, last - limit + 1), last + TAIL_SLACK
+            found = read(start, end)
+            # 読んだ範囲の最後まで埋まっている / 何も無い → 覚えていた最終行がずれている
+            if (found[-1][0] < end) if found else last <= 1:
+                break
+        idx.last_row = found[-1][0] if found else 1
+    first = found[-limit][0] if len(found) > limit else start
+    return [RequestRecord.from_row(pick(r, pos), i) for i, r in reversed(found[-limit:])], first
+
+def log_page_message(recs: List[RequestRecord], first: int, title: str) -> Tuple[str, Optional[ui.View]]:
+    lines = [title, "記録時刻 / ユーザー名 / 所属キャンパス / 操作 / 機材ID 機材名 / 状態"]
+    for r in recs:
+        lines.append(
+            f"- {r.ts} / {r.user_name} / {r.campus} / "
+            f"{r.op} / {r.item_id} {r.item_name} / {r.status}"
+        )
+    if first <= 2:
+        return "\n".join(lines), None
+    view = LoanLinkView(timeout=300)
+    view.add_item(OlderLogsButton(first))
+    return "\n".join(lines), view
 
 class AdminRequestsPeekButton(ui.Button):
     def __init__(self):
         super().__init__(label="直近申請ログ", style=discord.ButtonStyle.secondary, custom_id="admin_logs")
 
     async def callback(self, itx: discord.Interaction):
-        vals = req_ws.get_all_values()
-        if len(vals) < 2:
-            return await itx.response.send_message("申請ログなし。", ephemeral=True)
-        h = vals[0]
-        data = vals[-10:]
-        idx = {x: i for i, x in enumerate(h)}
-
-        def g(r, k):
-            return r[idx[k]] if k in idx and idx[k] < len(r) else ""
-
-        lines = [
-            "📜 **直近申請ログ（最大10件）**",
-            "記録時刻 / ユーザー名 / 所属キャンパス / 操作 / 機材ID 機材名 / 状態",
-        ]
-        for r in data:
-            lines.append(
-                f"- {g(r, '記録時刻')} / {g(r, 'ユーザー名')} / {g(r, '所属キャンパス')} / "
-                f"{g(r, '操作')} / {g(r, '機材ID')} {g(r, '機材名')} / {g(r, '申請ステータス')}"
-            )
-        await itx.response.send_message("\n".join(lines), ephemeral=True)
+        recs, first = await run_deferred(itx, req_log_page)
+        if not recs:
+            return await itx.followup.send("申請ログなし。", ephemeral=True)
+        text, view = log_page_message(recs, first, f"📜 **直近申請ログ（最大{LOG_PAGE_ROWS}件）**")
+        await itx.followup.send(text, view=view or discord.utils.MISSING, ephemeral=True)
 
-# ========= Admin 手動貸出 =========
-class AdminManualLoanButton(ui.Button):
-    def __init__(self):
-        super().__init__(label="手動で貸出中にする", style=discord.ButtonStyle.secondary, custom_id="admin_manual_loan")
+class OlderLogsButton(ui.Button):
+    """同じ範囲読みで 1 ページずつ遡る"""
+
+    def __init__(self, before: int):
+        super().__init__(label="◀ さらに前", style=discord.ButtonStyle.secondary, custom_id="admin_logs_older")
+        self.before = before
 
     async def callback(self, itx: discord.Interaction):
         if not is_admin(itx.user):
             return await itx.response.send_message("権限がありません。", ephemeral=True)
-        items = inv_all()
-        if not items:
-            return await itx.response.send_message("在庫がありません。", ephemeral=True)
-        candidates = [i for i in items if i["ステータス"] != "貸出中"]
-        if not candidates:
-            return await itx.response.send_message("貸出可能または申請中でない機材がありません。", ephemeral=True)
-        view = ui.View(timeout=60)
-        view.add_item(AdminManualItemSelect(candidates))
-        await itx.response.send_message("貸出中にしたい機材を選択してください：", view=view, ephemeral=True)
+        recs, first = await run_deferred(itx, req_log_page, self.before)
+        text, view = log_page_message(recs, first, f"📜 **申請ログ（{first}〜{self.before - 1}行目）**")
+        await itx.edit_original_response(content=text, view=view)
+
+# ========= 申請ログのエクスポート（CSV / JSONL + 利用統計） =========
+REQ_ARCHIVE_PREFIX = "requests_archive"  # アーカイブシートは requests_archive* の名前で置く
+EXPORT_CHUNK_ROWS = 500
+
+def col_letter(n: int) -> str:
+    s = ""
+    while n > 0:
+        n, r = divmod(n - 1, 26)
+        s = chr(ord("A") + r) + s
+    return s
+
+def req_log_sheets() -> list:
+    """アーカイブ（古い順）→ 現行 requests の順でシートを返す"""
+    archives = sorted(
+        (ws for ws in current_tenant().sh.worksheets() if ws.title.startswith(REQ_ARCHIVE_PREFIX)),
+        key=lambda ws: ws.title,
+    )
+    return archives + [req_ws]
 
-class AdminManualItemSelect(ui.Select):
-    def __init__(self, items: List[dict]):
-        self.items = items
-        opts = []
-        for i in items[:25]:
-            label = f"{i['機材名']} ({i['機材ID']})"
-            desc = f"カテゴリ:{i['カテゴリ']} / 現ステータス:{i['ステータス'] or '-'}"
-            opts.append(discord.SelectOption(label=label[:100], value=i["機材ID"], description=desc[:100]))
-        super().__init__(placeholder="機材を選択", options=opts, custom_id="admin_manual_item")
+def iter_sheet_range(ws, width: int, start: int = 2, chunk: int = EXPORT_CHUNK_ROWS) -> Iterator[Tuple[int, List[str]]]:
+    """
+    start 行目以降を chunk 行ずつ範囲取得し、(行番号, 行) を 1 行ずつ流す（空行は飛ばす）。
+    値の API は範囲末尾の空行を削って返すので、短い・空の応答では止めず、最終行を過ぎたところで止める
+    """
+    end_col = col_letter(width)
+    last: Optional[int] = None
+    while True:
+        rows = ws.get(f"A{start}:{end_col}{start + chunk - 1}")
+        for i, r in enumerate(rows or []):
+            if any(r):
+                yield start + i, (list(r) + [""] * width)[:width]
+        if len(rows or []) < chunk:
+            if last is None:
+                last = sheet_last_row(ws)
+            if start + chunk > last:
+                return
+        start += chunk
 
-    async def callback(self, itx: discord.Interaction):
-        item_id = self.values[0]
-        await itx.response.send_modal(AdminManualLoanModal(item_id))
+def sheet_last_row(ws) -> int:
+    """範囲読みを打ち切ってよい行。requests は記録時刻の列の最終行、アーカイブなどはシートの行数"""
+    if ws is req_ws:
+        return req_last_row(refresh=True)
+    return getattr(ws, "row_count", 0) or 0
 
-class AdminManualLoanModal(ui.Modal, title="手動貸出登録"):
-    def __init__(self, item_id: str):
-        super().__init__()
-        self.item_id = item_id
-        self.borrower = ui.TextInput(
-            label="貸出者（必須：メンション / ユーザーID / 表示名）",
-            placeholder="例: @まーしゅ / 123456789012345678 / まーしゅ",
-            required=True,
-            max_length=50,
-        )
-        self.due = ui.TextInput(
+def iter_sheet_rows(ws, width: int, chunk: int = EXPORT_CHUNK_ROWS) -> Iterator[List[str]]:
+    """2 行目以降を chunk 行ずつ範囲取得して 1 行ずつ流す"""
+    for _, r in iter_sheet_range(ws, width, 2, chunk):
+        yield r
+
+def iter_request_records(chunk: int = EXPORT_CHUNK_ROWS) -> Iterator[RequestRecord]:
+    for ws in req_log_sheets():
+        for r in iter_sheet_rows(ws, len(REQ_HEADERS), chunk):
+            yield RequestRecord.from_row(r)
+
+def parse_ts(s: str) -> Optional[datetime]:
+    try:
+        return datetime.strptime(s.replace(" JST", ""), "%Y-%m-%d %H:%M:%S").replace(tzinfo=JST)
+    except ValueError:
+        return None
+
+class UsageStats:
+    """
+    申請ログを 1 パスで集計する。
+      - 貸出件数（承認済みの貸出申請 + 手動貸出）
+      - 平均貸出日数（貸出の記録時刻 → 承認済み返却申請の記録時刻）
+      - 却下率（却下された貸出申請 / 貸出申請）
+    を機材・カテゴリ・キャンパスごとに持つ。
+    """
+
+    def __init__(self, categories: Dict[str, str]):
+        self.categories = categories
+        self.total = 0
+        # dim -> key -> [貸出件数, 申請件数, 却下件数, 貸出日数合計, 返却済み件数]
+        self.by: Dict[str, Dict[str, List[float]]] = {"item": {}, "category": {}, "campus": {}}
+        self._open: Dict[str, Tuple[datetime, Tuple[str, str, str]]] = {}
+
+    def _keys(self, rec: RequestRecord) -> Tuple[str, str, str]:
+        item = f"{rec.item_id} {rec.item_name}".strip() or "不明"
+        return item, self.categories.get(rec.item_id, "不明"), rec.campus or "不明"
+
+    def _bump(self, keys: Tuple[str, str, str], slot: int, v: float = 1):
+        for dim, k in zip(("item", "category", "campus"), keys):
+            self.by[dim].setdefault(k, [0, 0, 0, 0.0, 0])[slot] += v
+
+    def add(self, rec: RequestRecord):
+        self.total += 1
+        op, st, item_id = rec.op, rec.status, rec.item_id
+        if op in ("貸出申請", "貸出(管理)"):
+            keys = self._keys(rec)
+            if op == "貸出申請":
+                self._bump(keys, 1)
+                if st == "rejected":
+                    self._bump(keys, 2)
+            if st == "approved":
+                self._bump(keys, 0)
+                ts = parse_ts(rec.ts)
+                if ts:
+                    self._open[item_id] = (ts, keys)
+        elif op == "返却申請" and st == "approved":
+            opened = self._open.pop(item_id, None)
+            ts = parse_ts(rec.ts)
+            if opened and ts:
+                days = (ts - opened[0]).total_seconds() / 86400
+                self._bump(opened[1], 3, days)
+                self._bump(opened[1], 4)
+
+    def lines(self, dim: str, limit: int = 10) -> List[str]:
+        rows = sorted(self.by[dim].items(), key=lambda kv: -kv[1][0])[:limit]
+        out = []
+        for k, (loans, reqs, rej, days, returned) in rows:
+            avg = f"{days / returned:.1f}日" if returned else "-"
+            rate = f"{rej / reqs:.0%}" if reqs else "-"
+            out.append(f"- {k}: 貸出 {int(loans)} / 平均 {avg} / 却下率 {rate}")
+        return out
+
+    def summary(self) -> str:
+        parts = [f"📊 **利用統計**（ログ {self.total} 件）"]
+        for dim, title in (("category", "カテゴリ別"), ("campus", "キャンパス別"), ("item", "機材別（上位10）")):
+            parts.append(f"**{title}**")
+            parts.extend(self.lines(dim) or ["- なし"])
+        text = "\n".join(parts)
+        return text if len(text) <= 1900 else text[:1900] + "\n…"
+
+def export_request_log(fmt: str) -> Tuple[str, io.BufferedRandom, UsageStats]:
+    """ログ全体をメモリに載せずに gzip 圧縮した CSV / JSONL へ書き出し、同じパスで統計を取る"""
+    stats = UsageStats({it.item_id: it.category for it in inv_all()})
+    out = tempfile.TemporaryFile()
+    with gzip.GzipFile(fileobj=out, mode="wb") as gz:
+        text = io.TextIOWrapper(gz, encoding="utf-8-sig" if fmt == "csv" else "utf-8", newline="")
+        if fmt == "csv":
+            writer = csv.writer(text)
+            writer.writerow(REQ_HEADERS)
+            for rec in iter_request_records():
+                stats.add(rec)
+                writer.writerow(rec.to_row())
+        else:
+            for rec in iter_request_records():
+                stats.add(rec)
+                text.write(json.dumps(dict(zip(REQ_HEADERS, rec.to_row())), ensure_ascii=False) + "\n")
+        text.flush()
+        text.detach()
+    out.seek(0)
+    name = f"requests_{datetime.now(JST).strftime('%Y%m%d_%H%M%S')}.{'csv' if fmt == 'csv' else 'jsonl'}.gz"
+    return name, out, stats
+
+class AdminExportRequestsButton(ui.Button):
+    def __init__(self):
+        super().__init__(label="申請ログをエクスポート", style=discord.ButtonStyle.secondary, custom_id="admin_export")
+
+    async def callback(self, itx: discord.Interaction):
+        if not is_admin(itx.user):
+            return await itx.response.send_message("権限がありません。", ephemeral=True)
+        view = LoanLinkView(timeout=60)
+        view.add_item(ExportFormatSelect())
+        await itx.response.send_message("出力形式を選択：", view=view, ephemeral=True)
+
+class ExportFormatSelect(ui.Select):
+    def __init__(self):
+        opts = [
+            discord.SelectOption(label="CSV（gzip）", value="csv", description="Excel で開ける形式"),
+            discord.SelectOption(label="JSONL（gzip）", value="jsonl", description="1行1レコードの JSON"),
+        ]
+        super().__init__(placeholder="出力形式を選択", options=opts, custom_id="admin_export_fmt")
+
+    async def callback(self, itx: discord.Interaction):
+        try:
+            name, fp, stats = await run_deferred(itx, export_request_log, self.values[0], thinking=True)
+        except Overloaded:
+            raise
+        except Exception as e:
+            return await itx.followup.send(f"エクスポート中にエラー: {e}", ephemeral=True)
+        with fp:
+            await itx.followup.send(stats.summary(), file=discord.File(fp, filename=name), ephemeral=True)
+
+# ========= 計測 =========
+def metrics_lines() -> List[str]:
+    t = current_tenant()
+    st = t.stats
+    book = (t.cache.records.get("reservations") or (0, None))[1]  # 読み込み済みのときだけ（ここでは Sheets を読まない）
+    lim = t.limiter.stats
+    n_users, n_items = t.postings.sizes()
+    return [
+        "📊 **内部状態**",
+        f"- テナント: …{t.key[-6:]}（全 {len(tenants.all())} テナント）",
+        f"- Sheets 接続: {'⚠️ 読み取り専用モード' if t.degraded else '正常'}"
+        f" / スナップショット: {t.cache.saved_at or '未保存'}",
+        f"- Sheets 読み取り: {int(st['reads'])} / 書き込み: {int(st['writes'])}",
+        f"- クォータ待ち: {int(st['throttled'])} 回 / 合計 {st['waited_sec']:.1f} 秒"
+        f"（イベントループ上で待たずに通した分 {int(st['on_loop'])} 回 / 429 でやり直した分 {int(st['quota_retries'])} 回）",
+        f"- 在庫状態: {len(t.engine.state)} 機材 / チェックポイント行 {t.engine.base_row}",
+        f"- 不整合: {len(t.anomalies)} 件（最終チェック {t.reconciled_at or '未実行'}）",
+        f"- 期限スケジューラ: 追跡 {len(t.due.loans)} 件 / ヒープ {len(t.due.heap)}"
+        f" / 延滞 {t.due.overdue(today_jst())[1]} 件",
+        f"- 在庫ボード編集: {t.board.edits} 回",
+        f"- 申請ID索引: {len(t.req_index.rows)} 件 / 再構築 {t.req_index.rebuilds} 回",
+        f"- 履歴索引: 利用者 {n_users} 人 / 機材 {n_items} 台 / 再構築 {t.postings.rebuilds} 回",
+        f"- 重複送信の吸収: {t.idempotency.hits} 件 / 保持 {len(t.idempotency.entries)} 件",
+        f"- 操作のレート制限: 許可 {lim['allowed']} / 待機 {lim['delayed']} / 拒否 {lim['rejected']}"
+        f"（読み取り {lim['rejected_read']}・書き込み {lim['rejected_write']}）"
+        f" / 上限 {rate_limit_summary()}",
+        f"- 書き込みキュー: 待ち {t.mutations.pending()} / コマンド {t.mutations.stats['commands']}"
+        f" / バッチ {t.mutations.stats['batches']}（最大 {t.mutations.stats['largest']} 件）"
+        f" / 満杯で拒否 {t.mutations.stats['rejected']} / 失敗 {t.mutations.stats['failed']}",
+        f"- ワーカー: 待ち {work_pool.depth} / 実行中 {work_pool.running} / 完了 {work_pool.stats['done']}"
+        f" / 失敗 {work_pool.stats['failed']} / 混雑で拒否 {work_pool.stats['rejected']}"
+        f"（最大待ち {work_pool.stats['max_depth']}）",
+        f"- 予約: 予約中 {sum(len(v) for v in book.by_item.values()) if book else '-'} 件",
+        f"- 公開パネル: 次の切り替え {t.panels.next_at.strftime('%Y-%m-%d') if t.panels.next_at else 'なし'}"
+        f" / 編集 {t.panels.edits} 回",
+    ]
+
+class AdminMetricsButton(ui.Button):
+    def __init__(self):
+        super().__init__(label="📊 内部状態", style=discord.ButtonStyle.secondary, custom_id="admin_metrics")
+
+    async def callback(self, itx: discord.Interaction):
+        if not is_admin(itx.user):
+            return await itx.response.send_message("権限がありません。", ephemeral=True)
+        await itx.response.send_message("\n".join(metrics_lines()), ephemeral=True)
+
+# ========= ライブ在庫ボード =========
+BOARD_MIN_INTERVAL_SEC = 5  # 連続した変更はこの間隔にまとめて 1 回だけ編集する
+
+def board_location() -> Optional[Tuple[int, int]]:
+    raw = cfg_get("STATUS_BOARD") or ""
+    ch, _, msg = raw.partition(":")
+    if ch.isdigit() and msg.isdigit():
+        return int(ch), int(msg)
+    return None
+
+def render_status_board() -> str:
+    blocked, which, human = calc_is_blackout()
+    cats: Dict[str, List[int]] = {}
+    for r in inv_all():
+        c = cats.setdefault(r.category or "未分類", [0, 0])
+        c[1] += 1
+        if r.status in ("貸出可", ""):
+            c[0] += 1
+    lines = ["📦 **LoanLink 在庫ボード**（自動更新）"]
+    if blocked:
+        lines.append(f"⛔ 現在は**{which}期間（{human}）**のため貸出停止中（返却は可能）")
+    else:
+        lines.append("✅ 貸出受付中")
+    if not cats:
+        lines.append("- 在庫なし")
+    for cat in sorted(cats):
+        avail, total = cats[cat]
+        mark = "🟢" if avail else "🔴"
+        lines.append(f"{mark} {cat}: 貸出可 {avail} / {total}")
+    counts = inv_table().campus_counts()
+    if counts:
+        lines.append("📍 " + " / ".join(f"{c} {counts[c]}" for c in campus_order(counts)))
+    lines.append(f"-# 最終更新: {now_jst_str()}")
+    return "\n".join(lines)
+
+class StatusBoard:
+    """
+    テナントの在庫ボードメッセージ。inventory / blackouts の変更で schedule() され、
+    BOARD_MIN_INTERVAL_SEC 以内の変更はまとめて 1 回の編集にする。
+    schedule() は Sheets 呼び出しのスレッドからも呼ばれるのでループへは call_soon_threadsafe で渡す。
+    """
+
+    def __init__(self, tenant: "Tenant"):
+        self.tenant = tenant
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._pending = False
+        self._last = 0.0
+        self.edits = 0
+
+    def attach(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+
+    def schedule(self):
+        if self.loop is None or self._pending:
+            return
+        self._pending = True
+        self.loop.call_soon_threadsafe(lambda: self.loop.create_task(self._flush()))
+
+    async def _flush(self):
+        wait = self._last + BOARD_MIN_INTERVAL_SEC - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        self._pending = False
+        self._last = time.monotonic()
+        try:
+            with tenant_scope(self.tenant):
+                await self.refresh()
+        except Exception as e:
+            print(f"[board] 更新失敗 ({self.tenant.key}): {e}")
+
+    async def refresh(self):
+        loc = await asyncio.to_thread(board_location)
+        if loc is None:
+            return
+        ch = bot.get_channel(loc[0])
+        if ch is None:
+            return
+        content = await asyncio.to_thread(render_status_board)
+        try:
+            await ch.get_partial_message(loc[1]).edit(content=content)
+            self.edits += 1
+        except discord.NotFound:
+            await asyncio.to_thread(cfg_set, "STATUS_BOARD", "")
+
+def board_url(guild: Optional[discord.Guild]) -> str:
+    loc = board_location()
+    if not loc or guild is None:
+        return ""
+    return f"https://discord.com/channels/{guild.id}/{loc[0]}/{loc[1]}"
+
+class AdminStatusBoardButton(ui.Button):
+    def __init__(self):
+        super().__init__(label="📌 在庫ボードをここに設置", style=discord.ButtonStyle.secondary, custom_id="admin_status_board")
+
+    async def callback(self, itx: discord.Interaction):
+        if not is_admin(itx.user):
+            return await itx.response.send_message("権限がありません。", ephemeral=True)
+        msg = await itx.channel.send(await run_deferred(itx, render_status_board))
+        await run_deferred(itx, cfg_set, "STATUS_BOARD", f"{msg.channel.id}:{msg.id}")
+        await itx.followup.send("このチャンネルに在庫ボードを設置しました。在庫の変化に合わせて自動更新されます。", ephemeral=True)
+
+# ========= Admin 手動貸出 =========
+class AdminManualLoanButton(ui.Button):
+    def __init__(self):
+        super().__init__(label="手動で貸出中にする", style=discord.ButtonStyle.secondary, custom_id="admin_manual_loan")
+
+    async def callback(self, itx: discord.Interaction):
+        if not is_admin(itx.user):
+            return await itx.response.send_message("権限がありません。", ephemeral=True)
+        items = await run_deferred(itx, inv_all)
+        if not items:
+            return await itx.followup.send("在庫がありません。", ephemeral=True)
+        candidates = [i for i in items if i.available]
+        if not candidates:
+            return await itx.followup.send("貸出可能な機材がありません。", ephemeral=True)
+        view = LoanLinkView(timeout=60)
+        view.add_item(AdminManualItemSelect(candidates))
+        await itx.followup.send("貸出中にしたい機材を選択してください：", view=view, ephemeral=True)
+
+class AdminManualItemSelect(ui.Select):
+    def __init__(self, items: List[Item]):
+        self.items = items
+        opts = []
+        for i in items[:25]:
+            label = f"{i.name} ({i.item_id})"
+            desc = f"カテゴリ:{i.category} / 現ステータス:{i.status or '-'}"
+            opts.append(discord.SelectOption(label=label[:100], value=i.item_id, description=desc[:100]))
+        super().__init__(placeholder="機材を選択", options=opts, custom_id="admin_manual_item")
+
+    async def callback(self, itx: discord.Interaction):
+        item_id = self.values[0]
+        await itx.response.send_modal(AdminManualLoanModal(item_id))
+
+class AdminManualLoanModal(LoanLinkModal, title="手動貸出登録"):
+    def __init__(self, item_id: str):
+        super().__init__()
+        self.item_id = item_id
+        self.borrower = ui.TextInput(
+            label="貸出者（必須：メンション / ユーザーID / 表示名）",
+            placeholder="例: @まーしゅ / 123456789012345678 / まーしゅ",
+            required=True,
+            max_length=50,
+        )
+        self.due = ui.TextInput(
             label="返却予定日（任意・YYYY-MM-DD）",
             placeholder="例: 2025-11-15",
             required=False,
@@ -800,6 +2410,10 @@ class AdminManualLoanModal(ui.Modal, title="手動貸出登録"):
         if guild is None:
             await itx.response.send_message("サーバー内でのみ使用できます。", ephemeral=True)
             return
+        due = await reject_bad_due(itx, self.due.value, allow_past=True)  # 過去の貸出の記録も受け付ける
+        if due is None:
+            return
+        await itx.response.defer(ephemeral=True)  # fetch_member / query_members が続くので先に応答
 
         raw = self.borrower.value.strip()
         member: Optional[discord.Member] = None
@@ -814,250 +2428,1576 @@ class AdminManualLoanModal(ui.Modal, title="手動貸出登録"):
         if user_id is None and raw.isdigit():
             user_id = int(raw)
 
-        # user_id が取れた場合は get_member → fetch_member の順で試す
+        # user_id が取れた場合はインデックス → get_member → fetch_member の順で試す
         if user_id is not None:
-            member = guild.get_member(user_id)
-            if member is None:
-                try:
-                    member = await guild.fetch_member(user_id)
-                except Exception:
-                    member = None
+            member = await resolve_member_id(guild, user_id)
 
-        # 3) user_id 取れなかった場合は、表示名 / ユーザー名で検索（完全一致・小文字比較）
+        # 3) user_id 取れなかった場合は、表示名 / ユーザー名で検索（インデックス・大文字小文字無視）
         if member is None and user_id is None:
-            lower = raw.lower()
-            for m_ in guild.members:
-                if m_.display_name.lower() == lower or m_.name.lower() == lower:
-                    member = m_
-                    break
+            member = await find_member_by_name(guild, raw.lstrip("@"))
 
         # 見つからなかった
         if member is None:
-            await itx.response.send_message(
+            await itx.followup.send(
                 "サーバー内にそのユーザーが見つかりませんでした。\n"
                 "・メンション（@ユーザー）\n"
                 "・ユーザーID\n"
                 "・表示名 / ユーザー名（完全一致）\n"
                 "のいずれかで入力してください。\n\n"
-                "※ できれば **メンション か ユーザーID** を使うのがおすすめです。",
+                "※ できれば **メンション か ユーザーID** を使うのがおすすめです。"
+                + (suggest_text(guild, raw.lstrip("@")) if user_id is None else ""),
                 ephemeral=True,
             )
             return
 
-        # ここから実際の登録処理
-        admin_user = itx.user
-        idx = inv_find_row(self.item_id)
+        # ここから実際の登録処理（書き込みキュー経由）
+        inv_name = await run_mutation(itx, ManualLoan(
+            self.item_id, member.id, member.display_name,
+            due, self.note.value.strip(), itx.user.display_name,
+        ))
+        if inv_name is None:
+            await itx.followup.send("inventory に対象機材が見つかりませんでした。", ephemeral=True)
+            return
+
+        await itx.followup.send(
+            f"手動で貸出登録しました。\n"
+            f"- 機材: {self.item_id} {inv_name}\n"
+            f"- 貸出者: {member.display_name} (ID: {member.id})\n"
+            f"- 返却予定日: {due or '未入力'}",
+            ephemeral=True,
+        )
+
+# ========= 列を絞った読み取り =========
+# requests のようにキャッシュしていない大きなシートは、必要な列だけを A1 範囲（E2:E など）で
+# まとめて batch_get する。見出し → 列番号の対応はテナントごとに一度だけ解決して持ち、
+# 同じ batch_get で見出しのセルも読んで、列が挿入・移動されていたら解決し直す。
+# キャッシュ対象のシートはメモリ上の行から同じ形で返す。
+BATCH_GET_RANGES = 100  # 1 回の batch_get に載せる範囲の数
+
+def header_indexes(title: str, header: List[str], names: List[str]) -> List[int]:
+    """names の各列の列番号（1 始まり）。見出しに無い列は既定の並びの位置"""
+    pos = {h: i for i, h in enumerate(header, start=1) if h}
+    return [pos.get(n) or SHEET_SPECS[title].index(n) + 1 for n in names]
+
+def column_indexes(title: str, names: List[str], refresh: bool = False) -> List[int]:
+    t = current_tenant()
+    header = t.columns.get(title)
+    if header is None or refresh:
+        header = t.columns[title] = t.call(title, "row_values", (1,))
+    return header_indexes(title, header, names)
+
+def select_columns(ws: SheetProxy, names: List[str], start: int = 2,
+                   end: Optional[int] = None) -> List[Tuple[int, List[str]]]:
+    """start〜end 行目の names の列だけを読み、(行番号, 値) を返す（全部空の行は飛ばす）"""
+    if ws.title in CACHED_SHEETS:
+        rows = current_tenant().rows(ws.title)
+        pos = [c - 1 for c in header_indexes(ws.title, rows[0] if rows else [], names)]
+        out = []
+        for i, r in enumerate(rows[start - 1:end], start=start):
+            v = pick(r, pos)
+            if any(v):
+                out.append((i, v))
+        return out
+    for attempt in range(2):
+        letters = [col_letter(c) for c in column_indexes(ws.title, names, refresh=attempt > 0)]
+        res = ws.batch_get([f"{L}1" for L in letters] + [f"{L}{start}:{L}{end or ''}" for L in letters])
+        got = [r[0][0] if r and r[0] else "" for r in res[:len(names)]]
+        if got == list(names):
+            break
+    else:
+        # 見出しを読み直しても合わない（列の編集中など）。ずれた列を返さず、読めなかった扱いにする
+        current_tenant().columns.pop(ws.title, None)
+        print(f"[sheets] {ws.title} の見出しが一致しません: 期待 {names} / 実際 {got}")
+        raise SheetsUnavailable(f"{ws.title} シートの見出しが想定と異なるため読み取れませんでした。しばらくしてから再度お試しください。")
+    cols = [[r[0] if r else "" for r in col] for col in res[len(names):]]
+    out = []
+    for k in range(max(map(len, cols), default=0)):
+        v = [c[k] if k < len(c) else "" for c in cols]
+        if any(v):
+            out.append((start + k, v))
+    return out
+
+def select_rows(ws: SheetProxy, rowis: List[int], names: List[str]) -> List[Tuple[int, List[str]]]:
+    """指定した行だけを読み、names の並びで (行番号, 値) を返す"""
+    if ws.title in CACHED_SHEETS:
+        rows = current_tenant().rows(ws.title)
+        pos = [c - 1 for c in header_indexes(ws.title, rows[0] if rows else [], names)]
+        return [(i, pick(rows[i - 1] if i <= len(rows) else [], pos)) for i in rowis]
+    pos = [c - 1 for c in column_indexes(ws.title, names)]
+    end = col_letter(max(pos) + 1)
+    out = []
+    for k in range(0, len(rowis), BATCH_GET_RANGES):
+        part = rowis[k:k + BATCH_GET_RANGES]
+        res = ws.batch_get([f"A{i}:{end}{i}" for i in part])
+        for i, r in zip(part, res):
+            out.append((i, pick(r[0] if r else [], pos)))
+    return out
+
+# ========= 申請ID（行番号に依存しない申請の特定） =========
+REQ_ID_COL = REQ_HEADERS.index("申請ID") + 1
+OP_KINDS = {"loan": "貸出申請", "ret": "返却申請"}  # custom_id 用の短い名前
+
+def new_request_id() -> str:
+    return "R" + uuid.uuid4().hex[:10].upper()
+
+class RequestIndex:
+    """
+    テナントの 申請ID → requests の行番号。
+    引いた行の ID が違えば（誰かが行を削除・挿入してずれた）作り直して引き直す。
+    """
+
+    def __init__(self):
+        self.rows: Dict[str, int] = {}
+        self.built = False
+        self.rebuilds = 0
+        self.last_row = 0  # requests の最終行（0 は不明）。末尾読みで使う
+        self.lock = threading.Lock()
+
+    def load(self, ids: Iterable[Tuple[int, str]]):
+        """(行番号, 申請ID) の一覧から作る（ID の無い行は飛ばす）"""
+        ids = list(ids)
+        rows = {rid: i for i, rid in ids if rid}
+        with self.lock:
+            self.rows = rows
+            self.last_row = ids[-1][0] if ids else 1
+            self.built = True
+
+    def rebuild(self, b: Optional["MutationBatch"] = None):
+        """
+        記録時刻と ID の列だけを読み直す。b（writer のバッチ）を渡すと、
+        ID の無い行（導入前の行や手で追加された行）に採番してバッチに積む。
+        """
+        rows = {}
+        cols = select_columns(req_ws, ["記録時刻", "申請ID"])
+        for i, (stamp, rid) in cols:
+            if not rid and b is not None:
+                rid = b.req_cells.get((i, REQ_ID_COL), "")
+                if not rid and stamp:
+                    rid = new_request_id()
+                    b.set_req(i, REQ_ID_COL, rid)
+            if rid:
+                rows[rid] = i
+        with self.lock:
+            self.rows = rows
+            self.built = True
+            self.rebuilds += 1
+            self.last_row = cols[-1][0] if cols else 1
+
+    def appended(self, ids: List[str], resp) -> Optional[int]:
+        """
+        append_rows の応答（updatedRange）から追記した行の位置と最終行を覚え、先頭の行番号を返す。
+        分からなければ作り直し待ちにして None
+        """
+        try:
+            start = a1_start(resp["updates"]["updatedRange"])[0]
+        except (TypeError, KeyError):
+            self.built = False
+            self.last_row = 0
+            return None
+        with self.lock:
+            for i, rid in enumerate(ids):
+                self.rows[rid] = start + i
+            self.last_row = max(self.last_row, start + len(ids) - 1)
+        return start
+
+    def locate(self, rid: str, b: Optional["MutationBatch"] = None) -> RequestRecord:
+        """申請ID の行。b があれば未送信の変更を重ねた行を返す"""
+        for attempt in range(2):
+            if not self.built or attempt:
+                self.rebuild(b)
+            rowi = self.rows.get(rid)
+            if rowi is None:
+                continue
+            if b is not None:
+                row = b.req_row(rowi)
+            else:
+                row = (req_ws.row_values(rowi) + [""] * len(REQ_HEADERS))[:len(REQ_HEADERS)]
+            if row[REQ_ID_COL - 1] == rid:
+                return RequestRecord.from_row(row, rowi)
+        raise MutationRejected("申請が見つかりません（シートから削除された可能性があります）。")
+
+# ========= 利用者・機材ごとの申請履歴（ポスティングリスト） =========
+class RequestPostings:
+    """
+    テナントの ユーザーID / 機材ID → requests の行の一覧（古い順）。
+    各行にはもう一方のキーも持たせる（利用者の一覧なら機材ID、機材の一覧ならユーザーID）。
+    追記した行は末尾に足すだけで、読んだ行のキーが食い違えば（誰かが行を削除・挿入してずれた）作り直す。
+    """
+    KINDS = {"user": "user_id", "item": "item_id"}  # 種類 → RequestRecord の属性
+    USER_POS = REQ_HEADERS.index("ユーザーID")
+    ITEM_POS = REQ_HEADERS.index("機材ID")
+
+    def __init__(self):
+        self.lists: Dict[str, Dict[str, List[Tuple[int, str]]]] = {k: {} for k in self.KINDS}
+        self.built = False
+        self.rebuilds = 0
+        self.building = 0
+        self.fresh: List[Tuple[int, str, str]] = []  # 作り直しの読み取り中に追記された (行番号, ユーザーID, 機材ID)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _add(lists: Dict[str, Dict[str, List[Tuple[int, str]]]], rowi: int, user_id: str, item_id: str):
+        if user_id:
+            lists["user"].setdefault(user_id, []).append((rowi, item_id))
+        if item_id:
+            lists["item"].setdefault(item_id, []).append((rowi, user_id))
+
+    def rebuild(self):
+        """ユーザーID と機材ID の列だけを読み直す"""
+        with self.lock:
+            self.building += 1
+        try:
+            cols = select_columns(req_ws, ["ユーザーID", "機材ID"])
+        except BaseException:
+            with self.lock:
+                self.building -= 1
+            raise
+        lists = {k: {} for k in self.KINDS}
+        for i, (user_id, item_id) in cols:
+            self._add(lists, i, user_id, item_id)
+        last = cols[-1][0] if cols else 1
+        with self.lock:
+            self.building -= 1
+            for i, user_id, item_id in self.fresh:
+                if i > last:
+                    self._add(lists, i, user_id, item_id)
+            if not self.building:
+                self.fresh = []
+            self.lists = lists
+            self.built = True
+            self.rebuilds += 1
+
+    def appended(self, rows: List[List[str]], start: Optional[int]):
+        """追記した行（REQ_HEADERS の並び）を末尾に足す。先頭の行番号が分からなければ作り直し待ち"""
+        if start is None:
+            self.built = False
+            return
+        with self.lock:
+            for i, r in enumerate(rows, start=start):
+                user_id, item_id = r[self.USER_POS], r[self.ITEM_POS]
+                if self.building:
+                    self.fresh.append((i, user_id, item_id))
+                if self.built:
+                    self._add(self.lists, i, user_id, item_id)
+
+    def entries(self, kind: str, key: str) -> List[Tuple[int, str]]:
+        if not self.built:
+            self.rebuild()
+        with self.lock:
+            return list(self.lists[kind].get(key, ()))
+
+    def fetch(self, kind: str, key: str, choose) -> Tuple[List[RequestRecord], List[Tuple[int, str]]]:
+        """
+        choose(一覧) で選んだ行だけを読み、(レコード, 読んだときの一覧) を返す。
+        キーの違う行が混じっていれば作り直して 1 回だけ読み直す（それでも違う行は除く）
+        """
+        attr, other_attr = self.KINDS[kind], next(a for k, a in self.KINDS.items() if k != kind)
+        for attempt in range(2):
+            if attempt:
+                self.rebuild()
+            ents = self.entries(kind, key)
+            others = dict(ents)
+            recs = [RequestRecord.from_row(r, i) for i, r in select_rows(req_ws, choose(ents), REQ_HEADERS)]
+            ok = [rec for rec in recs if getattr(rec, attr) == key and getattr(rec, other_attr) == others[rec.row]]
+            if len(ok) == len(recs):
+                break
+        return ok, ents
+
+    def sizes(self) -> Tuple[int, int]:
+        with self.lock:
+            return len(self.lists["user"]), len(self.lists["item"])
+
+def loans_of(user_id) -> List[Item]:
+    """
+    ユーザーID で引いた貸出中・貸出申請中の機材（表示名を変えても追える）。
+    SubmitReturn と同じく在庫状態エンジンの借用者IDで判定するので Sheets は読まない
+    （申請ログの行を引くのは履歴の表示だけ）。
+    """
+    uid = str(user_id)
+    table = inv_table()
+    held = [
+        item_id for item_id, st in list(current_tenant().engine.state.items())
+        if st.borrower_id == uid and st.status in ("貸出中", "貸出申請中")
+    ]
+    return sorted((table.by_id[i] for i in held if i in table.by_id), key=lambda it: it.row)
+
+def history_page(kind: str, key: str, offset: int = 0,
+                 limit: int = LOG_PAGE_ROWS) -> Tuple[List[RequestRecord], int]:
+    """利用者・機材の履歴を新しい順に offset 件目から最大 limit 件。2 つ目の値は全件数"""
+    recs, ents = current_tenant().postings.fetch(
+        kind, key, lambda ents: [i for i, _ in reversed(ents[max(0, len(ents) - offset - limit):len(ents) - offset])]
+    )
+    return recs, len(ents)
+
+def history_message(kind: str, key: str, recs: List[RequestRecord], offset: int,
+                    total: int) -> Tuple[str, Optional[ui.View]]:
+    span = f"{offset + 1}〜{offset + len(recs)}件目 / 全{total}件"
+    if kind == "user":
+        lines = [f"🗂️ **あなたの利用履歴**（{span}）", "記録時刻 / 操作 / 機材ID 機材名 / 状態"]
+        lines += [f"- {r.ts} / {r.op} / {r.item_id} {r.item_name} / {r.status}" for r in recs]
+    else:
+        lines = [f"🗂️ **{key} の履歴**（{span}）", "記録時刻 / ユーザー名 / 所属キャンパス / 操作 / 状態"]
+        lines += [f"- {r.ts} / {r.user_name} / {r.campus} / {r.op} / {r.status}" for r in recs]
+    if offset + LOG_PAGE_ROWS >= total:
+        return "\n".join(lines), None
+    view = LoanLinkView(timeout=300)
+    view.add_item(OlderHistoryButton(kind, key, offset + LOG_PAGE_ROWS))
+    return "\n".join(lines), view
+
+class OlderHistoryButton(ui.Button):
+    """索引の一覧を 1 ページずつ遡る（読むのはそのページの行だけ）"""
+
+    def __init__(self, kind: str, key: str, offset: int):
+        super().__init__(label="◀ さらに前", style=discord.ButtonStyle.secondary, custom_id=f"history_older_{kind}")
+        self.kind = kind
+        self.key = key
+        self.offset = offset
+
+    async def callback(self, itx: discord.Interaction):
+        if self.kind == "item" and not is_admin(itx.user):
+            return await itx.response.send_message("権限がありません。", ephemeral=True)
+        recs, total = await run_deferred(itx, history_page, self.kind, self.key, self.offset)
+        text, view = history_message(self.kind, self.key, recs, self.offset, total)
+        await itx.edit_original_response(content=text, view=view)
+
+class MyHistoryButton(ui.Button):
+    def __init__(self):
+        super().__init__(label="利用履歴", style=discord.ButtonStyle.secondary, custom_id="btn_my_history")
+
+    async def callback(self, itx: discord.Interaction):
+        key = str(itx.user.id)
+        recs, total = await run_deferred(itx, history_page, "user", key)
+        if not recs:
+            return await itx.followup.send("利用履歴はありません。", ephemeral=True)
+        text, view = history_message("user", key, recs, 0, total)
+        await itx.followup.send(text, view=view or discord.utils.MISSING, ephemeral=True)
+
+class AdminItemHistoryButton(ui.Button):
+    def __init__(self):
+        super().__init__(label="機材の履歴", style=discord.ButtonStyle.secondary, custom_id="admin_item_history")
+
+    async def callback(self, itx: discord.Interaction):
+        if not is_admin(itx.user):
+            return await itx.response.send_message("権限がありません。", ephemeral=True)
+        await itx.response.send_modal(ItemHistoryModal())
+
+class ItemHistoryModal(LoanLinkModal, title="機材の履歴"):
+    def __init__(self):
+        super().__init__()
+        self.item_id = ui.TextInput(label="機材ID", placeholder="例: CAM-001", required=True, max_length=40)
+        self.add_item(self.item_id)
+
+    async def on_submit(self, itx: discord.Interaction):
+        key = self.item_id.value.strip()
+        recs, total = await run_deferred(itx, history_page, "item", key)
+        if not recs:
+            return await itx.followup.send(f"{key} の履歴はありません。", ephemeral=True)
+        text, view = history_message("item", key, recs, 0, total)
+        await itx.followup.send(text, view=view or discord.utils.MISSING, ephemeral=True)
+
+# ========= 承認フロー =========
+def req_pending(op: str) -> List[RequestRecord]:
+    """承認待ちの申請。操作・ステータス・ID の列で絞ってから、該当する行だけを読む"""
+    t = current_tenant()
+    try:
+        heads = select_columns(req_ws, ["操作", "申請ステータス", "申請ID"])
+        t.req_index.load((i, rid) for i, (_, _, rid) in heads)
+        waiting = [(i, rid) for i, (o, st, rid) in heads if o == op and st == "submitted"]
+        rows = select_rows(req_ws, [i for i, rid in waiting if rid], REQ_HEADERS)
+    except SheetsUnavailable:
+        return [RequestRecord.from_row(r, i) for i, r in t.cache.pending.get(op, [])]
+    if any(not rid for _, rid in waiting):
+        t.mutations.post(IndexRequests())  # ID の無い申請は採番してから次回の一覧に出す
+    out = []
+    for i, r in rows:
+        rec = RequestRecord.from_row(r, i)
+        if rec.op == op and rec.status == "submitted" and rec.req_id:  # 2 回の読み取りの間に処理された行は除く
+            out.append(rec)
+    t.cache.put_pending(op, [(rec.row, rec.to_row()) for rec in out])
+    return out
+
+class AdminApproveLoansButton(ui.Button):
+    def __init__(self):
+        super().__init__(label="貸出の承認/却下", style=discord.ButtonStyle.success, custom_id="admin_appr_loan")
+
+    async def callback(self, itx: discord.Interaction):
+        if not is_admin(itx.user):
+            return await itx.response.send_message("権限がありません。", ephemeral=True)
+        p = await run_deferred(itx, req_pending, "貸出申請")
+        if not p:
+            return await itx.followup.send("承認待ちの『貸出申請』はありません。", ephemeral=True)
+        view = LoanLinkView(timeout=60)
+        view.add_item(PendingSelect("貸出申請", p))
+        await itx.followup.send("承認・却下する申請を選択：", view=view, ephemeral=True)
+
+class AdminApproveReturnsButton(ui.Button):
+    def __init__(self):
+        super().__init__(label="返却の承認/却下", style=discord.ButtonStyle.primary, custom_id="admin_appr_ret")
+
+    async def callback(self, itx: discord.Interaction):
+        if not is_admin(itx.user):
+            return await itx.response.send_message("権限がありません。", ephemeral=True)
+        p = await run_deferred(itx, req_pending, "返却申請")
+        if not p:
+            return await itx.followup.send("承認待ちの『返却申請』はありません。", ephemeral=True)
+        view = LoanLinkView(timeout=60)
+        view.add_item(PendingSelect("返却申請", p))
+        await itx.followup.send("承認・却下する申請を選択：", view=view, ephemeral=True)
+
+class PendingSelect(ui.Select):
+    def __init__(self, op: str, pending: List[RequestRecord]):
+        self.op = op
+        opts = []
+        for rec in pending[:25]:
+            opts.append(
+                discord.SelectOption(
+                    label=f"{rec.ts} / {rec.user_name} / {rec.campus} / {rec.item_id} {rec.item_name}"[:100],
+                    value=rec.req_id,
+                )
+            )
+        super().__init__(
+            placeholder=f"{op} を選択",
+            options=opts,
+            min_values=1,
+            max_values=1,
+            custom_id=f"sel_{'loan' if op == '貸出申請' else 'ret'}",
+        )
+
+    def summary(self, rid: str) -> str:
+        rec = current_tenant().req_index.locate(rid)
+        return (
+            f"**{self.op} 対象**（{rid}）\n"
+            f"- 申請時刻: {rec.ts}\n"
+            f"- 申請者: {rec.user_name} (ID:{rec.user_id})\n"
+            f"- 所属キャンパス: {rec.campus}\n"
+            f"- 機材: {rec.item_id} {rec.item_name}\n"
+            f"- 返却予定日: {rec.due or '-'}\n"
+            f"- 用途/状態: {rec.purpose or '-'}\n"
+            f"- コメント: {rec.comment or '-'}\n"
+            f"- 現在ステータス: {rec.status}"
+        )
+
+    async def callback(self, itx: discord.Interaction):
+        rid = self.values[0]
+        summary = await run_deferred(itx, self.summary, rid)
+        view = LoanLinkView(timeout=60)
+        view.add_item(ApproveButton(self.op, rid))
+        view.add_item(RejectButton(self.op, rid))
+        await itx.followup.send(summary, view=view, ephemeral=True)
+
+async def decide_from_button(itx: discord.Interaction, cmd: "Decide", verb: str, mark: str):
+    try:
+        await run_mutation(itx, cmd)
+    except (SheetsUnavailable, Overloaded) as e:
+        return await reply_error(itx, str(e))
+    except Exception as e:
+        return await reply_error(itx, f"{verb}中にエラー: {e}")
+    await itx.edit_original_response(content=f"{itx.message.content}\n\n{mark} {verb}しました。", view=None)
+
+async def check_decider(itx: discord.Interaction) -> bool:
+    if not await bind_interaction(itx):
+        return False
+    if not is_admin(itx.user):
+        await itx.response.send_message("権限がありません。", ephemeral=True)
+        return False
+    return True
+
+class ApproveButton(ui.DynamicItem[ui.Button], template=r"ap:(?P<kind>loan|ret):(?P<rid>R[0-9A-F]+)"):
+    """custom_id に申請IDを持つので、再起動後も行番号を引き直さずにそのまま処理できる"""
+
+    def __init__(self, op: str, rid: str):
+        kind = next(k for k, v in OP_KINDS.items() if v == op)
+        super().__init__(ui.Button(label="✅ 承認", style=discord.ButtonStyle.success, custom_id=f"ap:{kind}:{rid}"))
+        self.op = op
+        self.rid = rid
+
+    @classmethod
+    async def from_custom_id(cls, itx: discord.Interaction, item: ui.Button, match: re.Match):
+        return cls(OP_KINDS[match["kind"]], match["rid"])
+
+    async def interaction_check(self, itx: discord.Interaction) -> bool:
+        return await check_decider(itx)
+
+    async def callback(self, itx: discord.Interaction):
+        await decide_from_button(itx, Approve(self.op, self.rid), "承認", "✅")
+
+class RejectButton(ui.DynamicItem[ui.Button], template=r"rj:(?P<kind>loan|ret):(?P<rid>R[0-9A-F]+)"):
+    def __init__(self, op: str, rid: str):
+        kind = next(k for k, v in OP_KINDS.items() if v == op)
+        super().__init__(ui.Button(label="❌ 却下", style=discord.ButtonStyle.danger, custom_id=f"rj:{kind}:{rid}"))
+        self.op = op
+        self.rid = rid
+
+    @classmethod
+    async def from_custom_id(cls, itx: discord.Interaction, item: ui.Button, match: re.Match):
+        return cls(OP_KINDS[match["kind"]], match["rid"])
+
+    async def interaction_check(self, itx: discord.Interaction) -> bool:
+        return await check_decider(itx)
+
+    async def callback(self, itx: discord.Interaction):
+        await decide_from_button(itx, Reject(self.op, self.rid), "却下", "❌")
+
+# ========= 書き込みキュー（テナントごとに 1 本の書き手） =========
+# inventory / requests への変更はすべて型付きのコマンドにしてキューへ積み、writer タスクが順番に適用する。
+# 溜まっているコマンドはまとめて 1 回の append_rows / batch_update で送る。
+MUTATION_QUEUE_LIMIT = 100
+MUTATION_BATCH_MAX = 25
+
+class QueueFull(Overloaded):
+    def __init__(self, msg: str = "書き込みが混み合っています。少し時間をおいてからもう一度お試しください。"):
+        super().__init__(msg)
+
+class MutationRejected(RuntimeError):
+    """コマンドの前提が崩れていた（処理済み・貸出中など）。メッセージはそのまま利用者に返す"""
+
+def cell_ranges(cells: Dict[Tuple[int, int], str]) -> List[dict]:
+    """{(行, 列): 値} を行ごとの連続範囲にまとめて batch_update の形にする"""
+    out = []
+    run: List[Tuple[int, int, str]] = []
+    for (r, c), v in sorted(cells.items()) + [((0, 0), "")]:
+        if run and (r != run[-1][0] or c != run[-1][1] + 1):
+            r0, c0 = run[0][0], run[0][1]
+            out.append({"range": f"{col_letter(c0)}{r0}:{col_letter(run[-1][1])}{r0}", "values": [[x[2] for x in run]]})
+            run = []
+        run.append((r, c, v))
+    return out
+
+class MutationBatch:
+    """
+    writer が 1 回で処理するコマンドの書き込みを集めるバッファ。
+    後のコマンドが前のコマンドの変更を読めるよう、未送信の変更を重ねた行を返す。
+    コマンドは検証（MutationRejected）を済ませてから書き込みを積むこと。
+    書き込みとフックは積んだコマンド（owner）ごとに覚え、送信に失敗したコマンドだけを失敗にする。
+    """
+    # 送信の順番。requests のログは最後に書く（ログに残った操作は在庫にも反映済みにする）
+    STAGES = ("inv_cells", "inv_rows", "res_rows", "res_cells", "req_rows", "req_cells")
+
+    def __init__(self):
+        self.req_rows: List[List[str]] = []
+        self.req_cells: Dict[Tuple[int, int], str] = {}
+        self.inv_rows: List[List[str]] = []
+        self.inv_cells: Dict[Tuple[int, int], str] = {}
+        self.res_rows: List[List[str]] = []
+        self.res_cells: Dict[Tuple[int, int], str] = {}
+        self.inv_ids: Optional[List[str]] = None  # inventory の A 列（バッチごとにシートから 1 回だけ読む）
+        self.inv_before: Dict[Tuple[int, int], Tuple[int, str]] = {}  # セル → (最後に書いたコマンド, バッチ前の値)
+        self.hooks: List[tuple] = []  # 送信後にイベントループ側で実行する (コマンド, 関数, 引数)
+        self.owner = 0  # いま apply しているコマンドの番号
+        self.writers: Dict[str, Set[int]] = {stage: set() for stage in self.STAGES}
+        self.failed: Set[int] = set()  # 書き込みが届かなかったコマンド
+
+    def req_row(self, rowi: int) -> List[str]:
+        row = (req_ws.row_values(rowi) + [""] * len(REQ_HEADERS))[:len(REQ_HEADERS)]
+        for (r, c), v in self.req_cells.items():
+            if r == rowi:
+                row[c - 1] = v
+        return row
+
+    def inv_row(self, rowi: int) -> List[str]:
+        row = (inv_ws.row_values(rowi) + [""] * len(INV_HEADERS))[:len(INV_HEADERS)]
+        for (r, c), v in self.inv_cells.items():
+            if r == rowi:
+                row[c - 1] = v
+        return row
+
+    def item(self, rowi: int) -> Item:
+        return Item(rowi, *self.inv_row(rowi))
+
+    def live_item_id(self, rowi: int) -> str:
+        """その行の今の機材ID（キャッシュではなくシートの A 列から）"""
+        if self.inv_ids is None:
+            self.inv_ids = current_tenant().call("inventory", "col_values", (1,))
+        return self.inv_ids[rowi - 1] if 0 < rowi <= len(self.inv_ids) else ""
+
+    def find_item(self, item_id: str) -> Optional[Item]:
+        """
+        機材の行（未送信の変更を重ねたもの）。無ければ None。
+        行番号と中身はキャッシュした在庫から引くので、書く前にシートの A 列と突き合わせる。
+        手で行が挿入・削除されてずれていればキャッシュを捨てて 1 回だけ引き直す
+        """
+        for attempt in range(2):
+            if attempt:
+                current_tenant().cache.expire("inventory")
+            idx = inv_find_row(item_id)
+            if idx is not None and self.live_item_id(idx) == item_id:
+                return self.item(idx)
+            if idx is None and not attempt:
+                self.live_item_id(1)  # A 列を読んでおく
+                if item_id not in self.inv_ids:
+                    return None
         if idx is None:
-            await itx.response.send_message("inventory に対象機材が見つかりませんでした。", ephemeral=True)
+            return None
+        raise MutationRejected("在庫シートの行が変わったため処理できませんでした。もう一度お試しください。")
+
+    def request(self, rowi: int) -> RequestRecord:
+        return RequestRecord.from_row(self.req_row(rowi), rowi)
+
+    def log(self, rec: RequestRecord):
+        """requests への追記（申請IDを採番し、在庫状態エンジンにも反映する）"""
+        rec.req_id = rec.req_id or new_request_id()
+        self.req_rows.append(rec.to_row())
+        self.writers["req_rows"].add(self.owner)
+        self.after(current_tenant().engine.apply, rec, True)
+
+    def set_req(self, rowi: int, col: int, value: str):
+        self.req_cells[(rowi, col)] = str(value)
+        self.writers["req_cells"].add(self.owner)
+
+    def set_inv(self, rowi: int, col: int, value: str):
+        before = self.inv_before[(rowi, col)][1] if (rowi, col) in self.inv_before else \
+            (inv_ws.row_values(rowi) + [""] * col)[col - 1]
+        self.inv_before[(rowi, col)] = (self.owner, before)
+        self.inv_cells[(rowi, col)] = str(value)
+        self.writers["inv_cells"].add(self.owner)
+
+    def add_item(self, row: List[str]):
+        self.inv_rows.append([str(x) for x in row])
+        self.writers["inv_rows"].add(self.owner)
+
+    def add_reservation(self, row: List[str]):
+        self.res_rows.append([str(x) for x in row])
+        self.writers["res_rows"].add(self.owner)
+
+    def set_res(self, rowi: int, col: int, value: str):
+        self.res_cells[(rowi, col)] = str(value)
+        self.writers["res_cells"].add(self.owner)
+
+    def res_conflict(self, item_id: str, start: date, end: date) -> Optional["Reservation"]:
+        """同じバッチで先に積んだ予約との重なり"""
+        book = ReservationBook([RES_HEADERS] + [r for r in self.res_rows if r[1] == item_id])
+        return book.conflict(item_id, start, end)
+
+    def after(self, fn, *args):
+        self.hooks.append((self.owner, fn, args))
+
+    def flush(self) -> Optional[Exception]:
+        """
+        STAGES の順に送る。途中で失敗したら、その段以降に書き込みを積んだコマンドを failed にし、
+        それらが先に書いた在庫のセルを元の値に戻す。失敗の例外を返す（全部届けば None）
+        """
+        for i, stage in enumerate(self.STAGES):
+            try:
+                self._send(stage)
+            except Exception as e:
+                self.failed = set().union(*(self.writers[s] for s in self.STAGES[i:]))
+                if i > 0:
+                    self._revert_inventory()
+                return e
+        return None
+
+    def _send(self, stage: str):
+        if stage == "inv_cells" and self.inv_cells:
+            inv_ws.batch_update(cell_ranges(self.inv_cells))
+        elif stage == "inv_rows" and self.inv_rows:
+            inv_ws.append_rows(self.inv_rows)
+        elif stage == "res_rows" and self.res_rows:
+            res_ws.append_rows(self.res_rows)
+        elif stage == "res_cells" and self.res_cells:
+            res_ws.batch_update(cell_ranges(self.res_cells))
+        elif stage == "req_rows" and self.req_rows:
+            resp = req_ws.append_rows(self.req_rows)
+            t = current_tenant()
+            start = t.req_index.appended([r[REQ_ID_COL - 1] for r in self.req_rows], resp)
+            t.postings.appended(self.req_rows, start)
+        elif stage == "req_cells" and self.req_cells:
+            req_ws.batch_update(cell_ranges(self.req_cells))
+
+    def _revert_inventory(self):
+        """失敗したコマンドが書いた在庫のセルを戻す（戻せなければ定期の突き合わせで直す）"""
+        cells = {cell: v for cell, (owner, v) in self.inv_before.items() if owner in self.failed}
+        if not cells:
             return
+        try:
+            inv_ws.batch_update(cell_ranges(cells))
+        except Exception as e:
+            print(f"[mutation] 在庫の書き戻し失敗 ({current_tenant().key}): {e}")
+
+class Mutation:
+    """コマンドの基底。apply はバッチに書き込みを積み、呼び出し元に返す値を返す（writer のスレッドで実行）"""
+    __slots__ = ()
+
+    def apply(self, b: MutationBatch):
+        raise NotImplementedError
+
+class SubmitLoan(Mutation):
+    """貸出申請。戻り値は (機材名, 停止期間種別, 期間)。停止期間中なら自動却下して種別を返す。機材が無ければ None"""
+    __slots__ = ("item_id", "user_id", "user_name", "campus", "due", "purpose")
+
+    def __init__(self, item_id: str, user_id: int, user_name: str, campus: str, due: str, purpose: str):
+        self.item_id = item_id
+        self.user_id = user_id
+        self.user_name = user_name
+        self.campus = campus
+        self.due = due
+        self.purpose = purpose
+
+    def apply(self, b: MutationBatch):
+        blocked, which, human = calc_is_blackout()
+        it = b.find_item(self.item_id)
+        if it is None:
+            return None
+        idx, inv_name = it.row, it.name
+        if blocked:
+            # 停止期間中：自動却下としてログだけ残す
+            b.log(RequestRecord(
+                now_jst_str(), str(self.user_id), self.user_name, self.campus,
+                "貸出申請", self.item_id, inv_name, self.due,
+                self.purpose,
+                f"{which}期間（{human}）のため自動却下", "rejected",
+            ))
+            return inv_name, which, human
+        if not it.available:
+            raise MutationRejected(f"{self.item_id} {inv_name} は現在「{it.status}」のため申請できません。")
+        today = today_jst()
+        held = res_book().conflict(self.item_id, today, max(parse_due(self.due) or today, today), str(self.user_id))
+        if held is not None:
+            raise MutationRejected(f"{self.item_id} {inv_name} は {held.period} に予約が入っているため、その期間にかかる貸出はできません。")
+        b.log(RequestRecord(
+            now_jst_str(), str(self.user_id), self.user_name, self.campus,
+            "貸出申請", self.item_id, inv_name, self.due,
+            self.purpose, "", "submitted",
+        ))
+        b.set_inv(idx, 5, "貸出申請中")
+        b.set_inv(idx, 6, self.user_name)
+        b.set_inv(idx, 7, self.due)
+        return inv_name, "", ""
+
+class SubmitReturn(Mutation):
+    """返却申請。戻り値は機材名、機材が無ければ None"""
+    __slots__ = ("item_id", "user_id", "user_name", "campus", "condition", "comment")
+
+    def __init__(self, item_id: str, user_id: int, user_name: str, campus: str, condition: str, comment: str):
+        self.item_id = item_id
+        self.user_id = user_id
+        self.user_name = user_name
+        self.campus = campus
+        self.condition = condition
+        self.comment = comment
+
+    def borrowed_by_user(self, it: Item) -> bool:
+        """借用者の判定はユーザーID（在庫状態エンジン）で。ID が分からない古い貸出だけ表示名で見る"""
+        st = current_tenant().engine.state.get(it.item_id)
+        if st is not None and st.borrower_id:
+            return st.borrower_id == str(self.user_id)
+        return it.borrower == self.user_name
+
+    def apply(self, b: MutationBatch):
+        it = b.find_item(self.item_id)
+        if it is None:
+            return None
+        idx, inv_name = it.row, it.name
+        if it.status == "返却申請中":
+            raise MutationRejected(f"{self.item_id} {inv_name} はすでに返却申請中です。")
+        if it.status != "貸出中":
+            raise MutationRejected(f"{self.item_id} {inv_name} は現在「{it.status or '貸出可'}」のため返却申請できません。")
+        if not self.borrowed_by_user(it):
+            raise MutationRejected(f"{self.item_id} {inv_name} はあなたへの貸出ではありません。")
+        b.log(RequestRecord(
+            now_jst_str(), str(self.user_id), self.user_name, self.campus,
+            "返却申請", self.item_id, inv_name, "",
+            self.condition, self.comment, "submitted",
+        ))
+        b.set_inv(idx, 5, "返却申請中")
+        b.set_inv(idx, 6, self.user_name)
+        return inv_name
 
-        row = inv_ws.row_values(idx)
-        inv_name = row[1] if len(row) > 1 else ""
+class IndexRequests(Mutation):
+    """申請ID索引の作り直し（ID の無い行への採番を含む）"""
+    __slots__ = ()
+
+    def apply(self, b: MutationBatch):
+        current_tenant().req_index.rebuild(b)
+
+class Decide(Mutation):
+    """承認 / 却下の共通部分（申請IDで行を引き、まだ submitted であることを確認する）"""
+    __slots__ = ("op", "rid")
+    status = ""
+
+    def __init__(self, op: str, rid: str):
+        self.op = op
+        self.rid = rid
+
+    def load(self, b: MutationBatch) -> Tuple[RequestRecord, int]:
+        rec = current_tenant().req_index.locate(self.rid, b)
+        if rec.op != self.op or rec.status != "submitted":
+            raise MutationRejected("この申請はすでに処理済みです。")
+        it = b.find_item(rec.item_id)
+        if it is None:
+            raise RuntimeError("inventory に該当機材が見つかりません。")
+        return rec, it.row
+
+    def decide(self, b: MutationBatch, rec: RequestRecord):
+        b.set_req(rec.row, REQ_HEADERS.index("申請ステータス") + 1, self.status)
+        b.after(current_tenant().engine.apply, rec.with_status(self.status), True)
+        b.after(current_tenant().idempotency.discard, ("fp", rec.user_id, rec.item_id, rec.op))
+
+class Approve(Decide):
+    __slots__ = ()
+    status = "approved"
+
+    def apply(self, b: MutationBatch):
+        rec, inv_row = self.load(b)
+        item, user, due = rec.item_id, rec.user_name, rec.due
+        # inventory: 1:ID, 2:名, 3:カテゴリ, 4:備考, 5:ステータス, 6:借用者, 7:返却予定
+        if rec.campus in CAMPUS_CHOICES:  # 借りた人・返した人のキャンパスに機材が移る
+            b.set_inv(inv_row, INV_CURRENT_CAMPUS_COL, rec.campus)
+        if self.op == "貸出申請":
+            b.set_inv(inv_row, 5, "貸出中")
+            b.set_inv(inv_row, 6, user)
+            b.set_inv(inv_row, 7, due)
+            uid = rec.user_id
+            b.after(current_tenant().due.track, item, rec.item_name, int(uid) if uid.isdigit() else None, user, due)
+        elif self.op == "返却申請":
+            b.set_inv(inv_row, 5, "貸出可")
+            b.set_inv(inv_row, 6, "")
+            b.set_inv(inv_row, 7, "")
+            b.after(current_tenant().due.untrack, item)
+        else:
+            raise RuntimeError("不明な操作")
+        self.decide(b, rec)
+
+class Reject(Decide):
+    __slots__ = ()
+    status = "rejected"
+
+    def apply(self, b: MutationBatch):
+        rec, inv_row = self.load(b)
+        if self.op == "貸出申請":
+            b.set_inv(inv_row, 5, "貸出可")
+            b.set_inv(inv_row, 6, "")
+            b.set_inv(inv_row, 7, "")
+        elif self.op == "返却申請":
+            b.set_inv(inv_row, 5, "貸出中")
+        else:
+            raise RuntimeError("不明な操作")
+        self.decide(b, rec)
+
+class RegisterItem(Mutation):
+    """機材登録。戻り値は採番した機材ID"""
+    __slots__ = ("cat", "name", "note", "campus")
+
+    def __init__(self, cat: str, name: str, note: str, campus: str = ""):
+        self.cat = cat
+        self.name = name
+        self.note = note
+        self.campus = campus
+
+    def apply(self, b: MutationBatch):
+        cid = generate_item_id(self.cat, [r[0] for r in b.inv_rows])
+        b.add_item([cid, self.name, self.cat, self.note, "貸出可", "", "", self.campus, self.campus])
+        return cid
+
+class ManualLoan(Mutation):
+    """管理者による手動貸出。戻り値は機材名、機材が無ければ None"""
+    __slots__ = ("item_id", "user_id", "user_name", "due", "note", "admin_name")
+
+    def __init__(self, item_id: str, user_id: int, user_name: str, due: str, note: str, admin_name: str):
+        self.item_id = item_id
+        self.user_id = user_id
+        self.user_name = user_name
+        self.due = due
+        self.note = note
+        self.admin_name = admin_name
+
+    def apply(self, b: MutationBatch):
+        it = b.find_item(self.item_id)
+        if it is None:
+            return None
+        idx, inv_name = it.row, it.name
+        if not it.available:
+            raise MutationRejected(f"{self.item_id} {inv_name} は現在「{it.status}」のため手動貸出できません。")
 
         # inventory を「貸出中」に更新
-        inv_ws.update_cell(idx, 5, "貸出中")               # ステータス
-        inv_ws.update_cell(idx, 6, member.display_name)    # 借用者（表示名）
-        inv_ws.update_cell(idx, 7, self.due.value.strip()) # 返却予定日
+        b.set_inv(idx, 5, "貸出中")         # ステータス
+        b.set_inv(idx, 6, self.user_name)  # 借用者（表示名）
+        b.set_inv(idx, 7, self.due)        # 返却予定日
 
         # requests にも「借りる人」をユーザーとして記録
-        req_ws.append_row([
+        b.log(RequestRecord(
             now_jst_str(),
-            str(member.id),                 # ユーザーID = 借りる人
-            member.display_name,            # ユーザー名 = 借りる人
+            str(self.user_id),              # ユーザーID = 借りる人
+            self.user_name,                 # ユーザー名 = 借りる人
             "未設定(管理)",                 # 所属キャンパス（手動なので不明）
             "貸出(管理)",                   # 操作
             self.item_id,
             inv_name,
-            self.due.value.strip(),
-            self.note.value.strip(),        # 用途/状態
-            f"Admin {admin_user.display_name} が手動登録",  # コメント
+            self.due,
+            self.note,                      # 用途/状態
+            f"Admin {self.admin_name} が手動登録",  # コメント
             "approved",
-        ])
+        ))
+        b.after(current_tenant().due.track, self.item_id, inv_name, self.user_id, self.user_name, self.due)
+        return inv_name
 
-        await itx.response.send_message(
-            f"手動で貸出登録しました。\n"
-            f"- 機材: {self.item_id} {inv_name}\n"
-            f"- 貸出者: {member.display_name} (ID: {member.id})\n"
-            f"- 返却予定日: {self.due.value or '未入力'}",
-            ephemeral=True,
-        )
+class MutationQueue:
+    """
+    テナントの書き込みキュー。writer タスクが先頭から最大 MUTATION_BATCH_MAX 件ずつ取り出し、
+    スレッドで順に apply → まとめて送信し、送信後のフック（在庫状態・期限スケジューラの更新）はループ側で行う。
+    キューが満杯なら submit は待たずに QueueFull を投げる。
+    """
+
+    def __init__(self, tenant: "Tenant"):
+        self.tenant = tenant
+        self.queue: Optional[asyncio.Queue] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.stats = {"commands": 0, "batches": 0, "largest": 0, "rejected": 0, "failed": 0}
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        self._loop = loop
+        self.queue = asyncio.Queue(MUTATION_QUEUE_LIMIT)
+        loop.create_task(self._writer())
+
+    def pending(self) -> int:
+        return self.queue.qsize() if self.queue is not None else 0
+
+    def post(self, cmd: Mutation):
+        """結果を待たずに積む（スレッドからも呼べる）。満杯なら諦める"""
+        def put():
+            try:
+                fut, = self.submit(cmd)
+            except QueueFull:
+                return
+            fut.add_done_callback(lambda f: f.cancelled() or f.exception())
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(put)
+            return
+        put()
+
+    def submit(self, *cmds: Mutation) -> List[asyncio.Future]:
+        self.start()
+        if self.queue.maxsize - self.queue.qsize() < len(cmds):
+            self.stats["rejected"] += len(cmds)
+            raise QueueFull()
+        futs = []
+        for cmd in cmds:
+            fut = self._loop.create_future()
+            self.queue.put_nowait((cmd, fut))
+            futs.append(fut)
+        return futs
+
+    async def _writer(self):
+        with tenant_scope(self.tenant):
+            while True:
+                jobs = [await self.queue.get()]
+                while len(jobs) < MUTATION_BATCH_MAX and not self.queue.empty():
+                    jobs.append(self.queue.get_nowait())
+                await self._run(jobs)
+
+    async def _run(self, jobs: List[Tuple[Mutation, asyncio.Future]]):
+        batch = MutationBatch()
+
+        def work() -> List[tuple]:
+            results = []
+            for k, (cmd, _) in enumerate(jobs):
+                batch.owner = k
+                try:
+                    results.append((True, cmd.apply(batch)))
+                except Exception as e:
+                    results.append((False, e))
+            err = batch.flush()
+            for k in batch.failed:
+                results[k] = (False, err)
+            return results
+
+        self.stats["batches"] += 1
+        self.stats["commands"] += len(jobs)
+        self.stats["largest"] = max(self.stats["largest"], len(jobs))
+        try:
+            results = await asyncio.to_thread(work)
+        except Exception as e:
+            self.stats["failed"] += len(jobs)
+            results = [(False, e)] * len(jobs)
+        else:
+            self.stats["failed"] += len(batch.failed)
+            for owner, fn, args in batch.hooks:
+                if owner in batch.failed:
+                    continue
+                try:
+                    fn(*args)
+                except Exception as e:
+                    print(f"[mutation] 後処理失敗 ({self.tenant.key}): {e}")
+        for (_, fut), (ok, value) in zip(jobs, results):
+            if fut.cancelled():
+                continue
+            if ok:
+                fut.set_result(value)
+            else:
+                fut.set_exception(value)
+
+async def run_mutation(itx: discord.Interaction, cmd: Mutation):
+    """先に応答を保留（defer）してからテナントの書き込みキューに積み、結果を待つ"""
+    if not itx.response.is_done():
+        await itx.response.defer(ephemeral=True)
+    fut, = current_tenant().mutations.submit(cmd)
+    return await fut
+
+# ========= 重複送信の吸収（冪等性） =========
+# モーダルの二度押しや Discord の再配送で、同じ申請が続けて届くことがある。
+# インタラクションID と (ユーザー, 機材, 操作) の指紋の両方で最初の結果を短時間だけ覚えておき、
+# 重複には Sheets に触れずに同じ結果（処理中なら完了を待って）で応答する。
+IDEMPOTENCY_TTL_SEC = float(os.getenv("IDEMPOTENCY_TTL_SEC", "30"))
+IDEMPOTENCY_MAX_ENTRIES = 1024
+
+class IdempotencyCache:
+    """キー → (期限, 結果の Future) の LRU。容量を超えたら最も古く使われたものから捨てる（ループ上でのみ使う）"""
+
+    def __init__(self, ttl: float = IDEMPOTENCY_TTL_SEC, size: int = IDEMPOTENCY_MAX_ENTRIES):
+        self.ttl = ttl
+        self.size = size
+        self.entries: "OrderedDict[tuple, Tuple[float, asyncio.Future]]" = OrderedDict()
+        self.parts: "OrderedDict[tuple, tuple]" = OrderedDict()  # 個々の申請の指紋 → まとめて出した申請の指紋
+        self.hits = 0
+
+    @staticmethod
+    def keys(itx: discord.Interaction, fingerprint: tuple) -> Tuple[tuple, tuple]:
+        return ("itx", itx.id), ("fp",) + tuple(str(x) for x in fingerprint)
+
+    def get(self, keys: Iterable[tuple]) -> Optional[asyncio.Future]:
+        now = time.monotonic()
+        for key in keys:
+            hit = self.entries.get(key)
+            if hit is None:
+                continue
+            if hit[0] < now:
+                del self.entries[key]
+                continue
+            self.entries.move_to_end(key)
+            return hit[1]
+        return None
+
+    def put(self, keys: Iterable[tuple], fut: asyncio.Future):
+        expires = time.monotonic() + self.ttl
+        for key in keys:
+            self.entries[key] = (expires, fut)
+            self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def group(self, parts: Iterable[tuple], key: tuple):
+        """まとめて出した申請（プロジェクト貸出）の指紋 key に、中身の申請ごとの指紋 parts を紐付ける"""
+        for part in parts:
+            self.parts[part] = key
+            self.parts.move_to_end(part)
+        while len(self.parts) > self.size:
+            self.parts.popitem(last=False)
+
+    def forget(self, keys: Iterable[tuple], fut: asyncio.Future):
+        for key in keys:
+            hit = self.entries.get(key)
+            if hit is not None and hit[1] is fut:
+                del self.entries[key]
+
+    def discard(self, key: tuple):
+        """申請が承認・却下されたら指紋を忘れる（直後の再申請を重複扱いしない）。まとめた申請の一部ならまとめごと忘れる"""
+        self.entries.pop(key, None)
+        group = self.parts.pop(key, None)
+        if group is not None:
+            self.entries.pop(group, None)
+
+async def run_once(itx: discord.Interaction, fingerprint: tuple, work, parts: Iterable[tuple] = ()) -> Tuple[object, bool]:
+    """
+    work()（コルーチン関数）を重複を除いて 1 回だけ実行し、(結果, 初回か) を返す。
+    重複は応答を保留して初回の結果を待つだけで、通知などの副作用は初回の呼び出し側だけが行う。
+    parts は複数の申請をまとめて出すときの申請ごとの指紋で、どれかが承認・却下されたらこの指紋も忘れる。
+    結果が例外を含むリスト（gather(return_exceptions=True) の戻り値）なら、待っている重複には返すが覚えない。
+    """
+    cache = current_tenant().idempotency
+    keys = cache.keys(itx, fingerprint)
+    fut = cache.get(keys)
+    if fut is not None:
+        cache.hits += 1
+        if not itx.response.is_done():
+            await itx.response.defer(ephemeral=True)
+        return await asyncio.shield(fut), False
+    fut = asyncio.get_running_loop().create_future()
+    cache.put(keys, fut)
+    cache.group((cache.keys(itx, p)[1] for p in parts), keys[1])
+    try:
+        res = await work()
+    except BaseException as e:
+        cache.forget(keys, fut)  # 失敗したものは覚えない（やり直しは通常どおり処理する）
+        if isinstance(e, Exception):
+            fut.set_exception(e)
+            fut.exception()  # 待っている重複が無くても警告を出さない
+        else:
+            fut.cancel()
+        raise
+    if isinstance(res, list) and any(isinstance(r, BaseException) for r in res):
+        cache.forget(keys, fut)
+    fut.set_result(res)
+    return res, True
+
+# ========= 申請ログからの在庫状態（イベントソーシング） =========
+INVENTORY_CHECKPOINT_PATH = os.getenv("INVENTORY_CHECKPOINT_PATH", "inventory_checkpoint.json")
+CHECKPOINT_INTERVAL_SEC = 600
+
+class ItemState:
+    __slots__ = ("status", "borrower", "borrower_id", "due")
+
+    def __init__(self, status: str = "貸出可", borrower: str = "", borrower_id: str = "", due: str = ""):
+        self.status = status
+        self.borrower = borrower
+        self.borrower_id = borrower_id
+        self.due = due
+
+    def to_list(self) -> List[str]:
+        return [self.status, self.borrower, self.borrower_id, self.due]
+
+class InventoryEngine:
+    """
+    requests ログを先頭から畳み込んで各機材のステータス・借用者・返却予定日を導出する。
+
+    ログの行は後から submitted → approved/rejected に書き換わるため、
+    「最初の submitted 行の手前」までを確定済みとみなしてチェックポイントに保存する。
+    起動時はチェックポイント + それ以降の末尾だけを再生すればよい。
+    """
+
+    def __init__(self, path: str, sheet_key: str):
+        self.path = path
+        self.sheet_key = sheet_key
+        self.state: Dict[str, ItemState] = {}
+        self.base: Dict[str, ItemState] = {}
+        self.base_row = 2
+        self.base_fp = ""
+        self.loaded = False
+
+    @staticmethod
+    def fold(state: Dict[str, ItemState], rec: RequestRecord, live: bool = False):
+        """
+        1 レコード分の状態遷移。
+        ログの畳み込みでは rejected は「申請前の状態のまま」なので何もしない。
+        live=True（承認/却下の直後に反映する場合）は申請中の状態を元に戻す。
+        """
+        op, st, item = rec.op, rec.status, rec.item_id
+        if not item:
+            return
+        cur = state.get(item) or ItemState()
+        if op in ("貸出申請", "貸出(管理)"):
+            if st == "submitted":
+                cur = ItemState("貸出申請中", rec.user_name, rec.user_id, rec.due)
+            elif st == "approved":
+                cur = ItemState("貸出中", rec.user_name, rec.user_id, rec.due)
+            elif st == "rejected" and live and cur.status == "貸出申請中":
+                cur = ItemState()
+        elif op == "返却申請":
+            if st == "submitted":
+                cur = ItemState("返却申請中", rec.user_name, cur.borrower_id or rec.user_id, cur.due)
+            elif st == "approved":
+                cur = ItemState()
+            elif st == "rejected" and live and cur.status == "返却申請中":
+                cur = ItemState("貸出中", cur.borrower, cur.borrower_id, cur.due)
+        else:
+            return
+        state[item] = cur
+
+    def apply(self, rec: RequestRecord, live: bool = False):
+        if self.loaded:
+            self.fold(self.state, rec, live=live)
+
+    # ---- チェックポイント ----
+    @staticmethod
+    def _fingerprint(row: List[str]) -> str:
+        return "|".join((list(row) + [""] * 6)[:6])
+
+    def _read_checkpoint(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("sheet") != self.sheet_key:
+            return
+        self.base = {k: ItemState(*v) for k, v in data.get("items", {}).items()}
+        self.base_row = int(data.get("row", 2))
+        self.base_fp = data.get("fp", "")
+
+    def _write_checkpoint(self):
+        data = {
+            "sheet": self.sheet_key,
+            "row": self.base_row,
+            "fp": self.base_fp,
+            "items": {k: v.to_list() for k, v in self.base.items()},
+        }
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+    def _checkpoint_valid(self) -> bool:
+        """チェックポイント直前の行が変わっていない（行の削除・挿入が無い）か確認"""
+        if self.base_row <= 2:
+            return True
+        return self._fingerprint(req_ws.row_values(self.base_row - 1)) == self.base_fp
+
+    @staticmethod
+    def _copy(state: Dict[str, ItemState]) -> Dict[str, ItemState]:
+        return {k: ItemState(*v.to_list()) for k, v in state.items()}
+
+    def _replay_tail(self) -> Dict[str, ItemState]:
+        """base_row 以降を範囲読みで再生し、確定済みの範囲までチェックポイントを前進させる"""
+        if not self._checkpoint_valid():
+            self.base, self.base_row, self.base_fp = {}, 2, ""
+        state = self._copy(self.base)
+        new_base: Optional[Dict[str, ItemState]] = None
+        new_row, new_fp = self.base_row, self.base_fp
+        for rowi, r in iter_sheet_range(req_ws, len(REQ_HEADERS), self.base_row):
+            rec = RequestRecord.from_row(r, rowi)
+            if new_base is None and rec.status == "submitted":
+                new_base = self._copy(state)
+            self.fold(state, rec)
+            if new_base is None:
+                new_row, new_fp = rowi + 1, self._fingerprint(r)
+        if new_base is None:
+            new_base = self._copy(state)
+        if new_row != self.base_row:
+            self.base, self.base_row, self.base_fp = new_base, new_row, new_fp
+            self._write_checkpoint()
+        return state
+
+    def load(self):
+        """チェックポイント + 末尾の再生で現在状態を構築"""
+        self._read_checkpoint()
+        self.state = self._replay_tail()
+        self.loaded = True
+
+    def load_offline(self):
+        """Sheets に繋がらないときはチェックポイント時点の状態で代用する"""
+        self._read_checkpoint()
+        self.state = self._copy(self.base)
+        self.loaded = True
+
+    def checkpoint(self):
+        """確定済み範囲までチェックポイントを進める（現在状態はそのまま）"""
+        self._replay_tail()
+
+    # ---- 在庫シートとの突き合わせ ----
+    def consistency_report(self) -> List[Tuple[Item, ItemState]]:
+        """inventory の列と畳み込み結果が食い違う (在庫行, 導出状態) の一覧"""
+        out = []
+        for it in inv_all():
+            st = self.state.get(it.item_id) or ItemState()
+            sheet_status = it.status or "貸出可"
+            if (sheet_status, it.borrower, it.due) != (st.status, st.borrower, st.due):
+                out.append((it, st))
+        return out
+
+    def rebuild_sheet(self) -> int:
+        """inventory のステータス/借用者/返却予定日列を導出状態で一括上書き"""
+        ids = inv_ws.col_values(1)[1:]
+        if not ids:
+            return 0
+        values = []
+        for item_id in ids:
+            st = self.state.get(item_id) or ItemState()
+            values.append([st.status, st.borrower, st.due])
+        inv_ws.update(values, f"E2:G{len(ids) + 1}")
+        return len(ids)
+
+async def checkpoint_loop():
+    while True:
+        await asyncio.sleep(CHECKPOINT_INTERVAL_SEC)
+        for t in tenants.all():
+            if not t.started:
+                continue
+            try:
+                with tenant_scope(t):
+                    await asyncio.to_thread(t.engine.checkpoint)
+            except Exception as e:
+                print(f"[engine] チェックポイント失敗 ({t.key}): {e}")
+
+class AdminConsistencyButton(ui.Button):
+    def __init__(self):
+        super().__init__(label="在庫とログの整合性チェック", style=discord.ButtonStyle.secondary, custom_id="admin_consistency")
+
+    async def callback(self, itx: discord.Interaction):
+        if not is_admin(itx.user):
+            return await itx.response.send_message("権限がありません。", ephemeral=True)
+        diffs = await run_deferred(itx, current_tenant().engine.consistency_report, thinking=True)
+        if not diffs:
+            return await itx.followup.send("✅ inventory とログは一致しています。", ephemeral=True)
+        lines = [f"⚠️ **不一致 {len(diffs)} 件**（シート → ログから導出）"]
+        for it, st in diffs[:20]:
+            lines.append(
+                f"- {it.item_id} {it.name}: "
+                f"{it.status or '-'}/{it.borrower or '-'}/{it.due or '-'} → "
+                f"{st.status}/{st.borrower or '-'}/{st.due or '-'}"
+            )
+        if len(diffs) > 20:
+            lines.append(f"…ほか {len(diffs) - 20} 件")
+        view = LoanLinkView(timeout=120)
+        view.add_item(RebuildInventoryButton())
+        await itx.followup.send("\n".join(lines), view=view, ephemeral=True)
+
+class RebuildInventoryButton(ui.Button):
+    def __init__(self):
+        super().__init__(label="ログから在庫列を再構築", style=discord.ButtonStyle.danger, custom_id="admin_rebuild_inv")
+
+    async def callback(self, itx: discord.Interaction):
+        if not is_admin(itx.user):
+            return await itx.response.send_message("権限がありません。", ephemeral=True)
+        engine = current_tenant().engine
+
+        def work() -> int:
+            engine.load()
+            return engine.rebuild_sheet()
+
+        n = await run_deferred(itx, work, thinking=True)
+        await itx.followup.send(f"inventory {n} 行のステータス/借用者/返却予定日をログから再構築しました。", ephemeral=True)
+
+# ========= 在庫とログの突き合わせ（不整合の分類と修復） =========
+# 手作業の編集や途中で失敗した書き込みで inventory と requests が食い違ったものを探す。
+# 両シートを 1 回ずつ読み、機材ID をキーにした辞書で突き合わせて種類ごとに分類する。
+RECONCILE_INTERVAL_SEC = float(os.getenv("RECONCILE_INTERVAL_SEC", "3600"))  # 0 以下で定期実行しない
+RECONCILE_COLUMNS = ["ユーザーID", "ユーザー名", "操作", "機材ID", "返却予定日", "申請ステータス", "申請ID"]
+PENDING_OPS = {"貸出申請中": "貸出申請", "返却申請中": "返却申請"}
+ANOMALY_KINDS = {
+    "orphan": "対応する申請が無い申請中ステータス",
+    "stale": "在庫に反映されていない申請",
+    "duplicate": "重複した申請",
+    "borrower": "借用者の不一致",
+}
+
+class Anomaly:
+    """
+    不整合 1 件。fix は修復で書く inventory の (ステータス, 借用者, 返却予定日)、
+    rejects は却下する申請ID、keep は重複のうち残す申請ID。どれも無ければ報告のみ
+    """
+    __slots__ = ("kind", "item_id", "name", "detail", "row", "seen", "fix", "fix_user_id", "rejects", "keep")
+
+    def __init__(self, kind: str, it: Item, detail: str, fix: Optional[Tuple[str, str, str]] = None,
+                 fix_user_id: str = "", rejects: Iterable[str] = (), keep: str = ""):
+        self.kind = kind
+        self.item_id = it.item_id
+        self.name = it.name
+        self.detail = detail
+        self.row = it.row
+        self.seen = (it.status, it.borrower, it.due)  # 検出時の在庫（修復時に変わっていれば触らない）
+        self.fix = fix
+        self.fix_user_id = fix_user_id
+        self.rejects = [rid for rid in rejects if rid]
+        self.keep = keep
+
+    @property
+    def fixable(self) -> bool:
+        return self.fix is not None or bool(self.rejects)
+
+    @property
+    def key(self) -> str:
+        return f"{self.kind}:{self.item_id}"
+
+def find_anomalies() -> List[Anomaly]:
+    """inventory と requests を 1 回ずつ読んで不整合を分類する"""
+    current_tenant().cache.expire("inventory")  # 手で編集された在庫も拾えるよう取り直す
+    table = inv_table()
+    holder: Dict[str, Tuple[str, str, str]] = {}  # 機材ID → 最後に承認された貸出の (ユーザーID, ユーザー名, 返却予定日)
+    waiting: Dict[Tuple[str, str], List[Tuple[str, str, str, str]]] = {}  # (機材ID, 操作) → submitted の申請
+    for _, (uid, uname, op, iid, due, st, rid) in select_columns(req_ws, RECONCILE_COLUMNS):
+        if not iid:
+            continue
+        if op in ("貸出申請", "貸出(管理)"):
+            if st == "approved":
+                holder[iid] = (uid, uname, due)
+        elif op == "返却申請":
+            if st == "approved":
+                holder.pop(iid, None)
+        else:
+            continue
+        if st == "submitted":
+            waiting.setdefault((iid, op), []).append((uid, uname, due, rid))
 
-# ========= 承認フロー =========
-def req_pending(op: str) -> List[Tuple[int, List[str]]]:
-    vals = req_ws.get_all_values()
-    if len(vals) < 2:
-        return []
-    h = vals[0]
-    idx = {x: i for i, x in enumerate(h)}
     out = []
-    for i, r in enumerate(vals[1:], start=2):
-        opv = r[idx.get("操作", -1)] if idx.get("操作") is not None and idx["操作"] < len(r) else ""
-        st = r[idx.get("申請ステータス", -1)] if idx.get("申請ステータス") is not None and idx["申請ステータス"] < len(r) else ""
-        if opv == op and st == "submitted":
-            out.append((i, r))
+    for it in table.items:
+        if not it.item_id:
+            continue
+        status = it.status or "貸出可"
+        held = holder.get(it.item_id)
+        restore = ("貸出中", held[1], held[2]) if held else ("貸出可", "", "")
+        pending_op = PENDING_OPS.get(status)
+        for op in ("貸出申請", "返却申請"):
+            subs = waiting.get((it.item_id, op), [])
+            if len(subs) > 1:
+                keep = next((s for s in subs if s[1] == it.borrower), subs[0])
+                out.append(Anomaly(
+                    "duplicate", it, f"{op}が {len(subs)} 件 submitted のまま（{keep[1]} の申請を残して却下）",
+                    rejects=[s[3] for s in subs if s is not keep], keep=keep[3],
+                ))
+            if subs and op != pending_op:
+                out.append(Anomaly(
+                    "stale", it, f"{subs[-1][1]} の{op}が submitted のままですが在庫は「{status}」です（申請を却下）",
+                    rejects=[s[3] for s in subs],
+                ))
+        if pending_op and not waiting.get((it.item_id, pending_op)):
+            out.append(Anomaly(
+                "orphan", it, f"「{status}」ですが submitted の{pending_op}がありません（→ {restore[0]}"
+                              f"{'/' + restore[1] if restore[1] else ''}）",
+                fix=restore, fix_user_id=held[0] if held else "",
+            ))
+        elif status in ("貸出中", "返却申請中"):
+            if held is None:
+                out.append(Anomaly("borrower", it, f"「{status}」（{it.borrower or '-'}）ですが承認済みの貸出がログにありません"))
+            elif it.borrower != held[1]:
+                out.append(Anomaly(
+                    "borrower", it, f"借用者が {it.borrower or '-'} ですがログでは {held[1]} です",
+                    fix=(it.status, held[1], held[2]), fix_user_id=held[0],
+                ))
+        elif status == "貸出申請中" and len(waiting[(it.item_id, "貸出申請")]) == 1:  # 重複していれば重複の修復に任せる
+            last = waiting[(it.item_id, "貸出申請")][0]
+            if it.borrower != last[1]:
+                out.append(Anomaly(
+                    "borrower", it, f"借用者が {it.borrower or '-'} ですが申請者は {last[1]} です",
+                    fix=(it.status, last[1], last[2]), fix_user_id=last[0],
+                ))
+        elif held is not None:
+            out.append(Anomaly("borrower", it, f"在庫は「{status}」ですがログでは {held[1]} に貸出中です"))
     return out
 
-class AdminApproveLoansButton(ui.Button):
+def anomaly_lines(found: List[Anomaly], limit: int = 20) -> List[str]:
+    lines = []
+    for kind, label in ANOMALY_KINDS.items():
+        rows = [a for a in found if a.kind == kind]
+        if not rows:
+            continue
+        lines.append(f"**{label}**（{len(rows)} 件）")
+        for a in rows[:limit]:
+            lines.append(f"- {a.item_id} {a.name}: {a.detail}{'' if a.fixable else '（要確認・自動修復なし）'}")
+        if len(rows) > limit:
+            lines.append(f"…ほか {len(rows) - limit} 件")
+    return lines
+
+class RepairAnomalies(Mutation):
+    """検出した不整合をまとめて修復する。検出後に状態が変わったものは飛ばす。戻り値は修復した件数"""
+    __slots__ = ("anomalies",)
+
+    def __init__(self, anomalies: List[Anomaly]):
+        self.anomalies = anomalies
+
+    def apply(self, b: MutationBatch) -> int:
+        t = current_tenant()
+        st_col = REQ_HEADERS.index("申請ステータス") + 1
+        cm_col = REQ_HEADERS.index("コメント") + 1
+        fixed = 0
+        for a in self.anomalies:
+            it = b.item(a.row)
+            if b.live_item_id(a.row) != a.item_id or it.item_id != a.item_id or (it.status, it.borrower, it.due) != a.seen:
+                continue
+            done = False
+            for rid in a.rejects:
+                try:
+                    rec = t.req_index.locate(rid, b)
+                except MutationRejected:
+                    continue
+                if rec.status != "submitted":
+                    continue
+                b.set_req(rec.row, st_col, "rejected")
+                b.set_req(rec.row, cm_col, f"{rec.comment} / 整合性修復で却下" if rec.comment else "整合性修復で却下")
+                if a.kind == "stale":
+                    b.after(t.engine.apply, rec.with_status("rejected"), True)
+                done = True
+            if a.keep and done:
+                try:
+                    kept = t.req_index.locate(a.keep, b)
+                except MutationRejected:
+                    kept = None
+                if kept is not None:
+                    b.after(t.engine.apply, kept, False)  # 残した申請の状態に戻す
+            if a.fix is not None:
+                status, borrower, due = a.fix
+                b.set_inv(a.row, 5, status)
+                b.set_inv(a.row, 6, borrower)
+                b.set_inv(a.row, 7, due)
+                if status == "貸出中":
+                    uid = a.fix_user_id
+                    b.after(t.due.track, a.item_id, a.name, int(uid) if uid.isdigit() else None, borrower, due)
+                elif status == "貸出可":
+                    b.after(t.due.untrack, a.item_id)
+                done = True
+            fixed += done
+        return fixed
+
+def reconcile_now() -> List[Anomaly]:
+    """検出してテナントに結果を覚えておく（内部状態の表示・定期報告用）"""
+    t = current_tenant()
+    found = find_anomalies()
+    t.anomalies = found
+    t.reconciled_at = now_jst_str()
+    return found
+
+async def reconcile_loop():
+    if RECONCILE_INTERVAL_SEC <= 0:
+        return
+    while True:
+        await asyncio.sleep(RECONCILE_INTERVAL_SEC)
+        for t in tenants.all():
+            if not t.started or t.degraded:
+                continue
+            try:
+                with tenant_scope(t):
+                    before = {a.key for a in t.anomalies}
+                    found = await asyncio.to_thread(reconcile_now)
+                    if found and {a.key for a in found} != before:  # 前回と同じ内容なら繰り返し知らせない
+                        await announce_anomalies(found)
+            except Exception as e:
+                print(f"[reconcile] 突き合わせ失敗 ({t.key}): {e}")
+
+async def announce_anomalies(found: List[Anomaly]):
+    ch = await announce_channel()
+    if ch is None:
+        return
+    lines = [f"🩺 inventory と申請ログの不整合が **{len(found)} 件** あります。"] + anomaly_lines(found, limit=5)
+    lines.append("Admin パネルの『不整合の検出と修復』から確認・修復できます。")
+    await ch.send("\n".join(lines)[:2000])
+
+class AdminReconcileButton(ui.Button):
     def __init__(self):
-        super().__init__(label="貸出の承認/却下", style=discord.ButtonStyle.success, custom_id="admin_appr_loan")
+        super().__init__(label="🩺 不整合の検出と修復", style=discord.ButtonStyle.secondary, custom_id="admin_reconcile")
 
     async def callback(self, itx: discord.Interaction):
         if not is_admin(itx.user):
             return await itx.response.send_message("権限がありません。", ephemeral=True)
-        p = req_pending("貸出申請")
-        if not p:
-            return await itx.response.send_message("承認待ちの『貸出申請』はありません。", ephemeral=True)
-        view = ui.View(timeout=60)
-        view.add_item(PendingSelect("貸出申請", p))
-        await itx.response.send_message("承認・却下する申請を選択：", view=view, ephemeral=True)
-
-class AdminApproveReturnsButton(ui.Button):
-    def __init__(self):
-        super().__init__(label="返却の承認/却下", style=discord.ButtonStyle.primary, custom_id="admin_appr_ret")
+        found = await run_deferred(itx, reconcile_now, thinking=True)
+        if not found:
+            return await itx.followup.send("✅ 不整合は見つかりませんでした。", ephemeral=True)
+        text = "\n".join([f"⚠️ **不整合 {len(found)} 件**"] + anomaly_lines(found))
+        fixable = [a for a in found if a.fixable]
+        if not fixable:
+            return await itx.followup.send(text[:2000], ephemeral=True)
+        view = LoanLinkView(timeout=120)
+        view.add_item(RepairAnomaliesButton(fixable))
+        await itx.followup.send(text[:2000], view=view, ephemeral=True)
+
+class RepairAnomaliesButton(ui.Button):
+    def __init__(self, anomalies: List[Anomaly]):
+        super().__init__(label=f"まとめて修復（{len(anomalies)} 件）", style=discord.ButtonStyle.danger,
+                         custom_id="admin_reconcile_fix")
+        self.anomalies = anomalies
 
     async def callback(self, itx: discord.Interaction):
         if not is_admin(itx.user):
             return await itx.response.send_message("権限がありません。", ephemeral=True)
-        p = req_pending("返却申請")
-        if not p:
-            return await itx.response.send_message("承認待ちの『返却申請』はありません。", ephemeral=True)
-        view = ui.View(timeout=60)
-        view.add_item(PendingSelect("返却申請", p))
-        await itx.response.send_message("承認・却下する申請を選択：", view=view, ephemeral=True)
-
-class PendingSelect(ui.Select):
-    def __init__(self, op: str, pending: List[Tuple[int, List[str]]]):
-        self.op = op
-        h = req_ws.row_values(1)
-        idx = {x: i for i, x in enumerate(h)}
-        opts = []
-        for rowi, row in pending[:25]:
-            ts = row[idx.get("記録時刻", 0)] if "記録時刻" in idx else ""
-            user = row[idx.get("ユーザー名", 0)] if "ユーザー名" in idx else ""
-            campus = row[idx.get("所属キャンパス", 0)] if "所属キャンパス" in idx else ""
-            item = row[idx.get("機材ID", 0)] if "機材ID" in idx else ""
-            name = row[idx.get("機材名", 0)] if "機材名" in idx else ""
-            opts.append(
-                discord.SelectOption(
-                    label=f"{ts} / {user} / {campus} / {item} {name}"[:100],
-                    value=str(rowi),
-                )
-            )
-        super().__init__(
-            placeholder=f"{op} を選択",
-            options=opts,
-            min_values=1,
-            max_values=1,
-            custom_id=f"sel_{'loan' if op == '貸出申請' else 'ret'}",
-        )
-
-    async def callback(self, itx: discord.Interaction):
-        rowi = int(self.values[0])
-        row = req_ws.row_values(rowi)
-        h = req_ws.row_values(1)
-        idx = {x: i for i, x in enumerate(h)}
-
-        def g(k):
-            return row[idx[k]] if k in idx and idx[k] < len(row) else ""
-
-        summary = (
-            f"**{self.op} 対象**\n"
-            f"- 申請時刻: {g('記録時刻')}\n"
-            f"- 申請者: {g('ユーザー名')} (ID:{g('ユーザーID')})\n"
-            f"- 所属キャンパス: {g('所属キャンパス')}\n"
-            f"- 機材: {g('機材ID')} {g('機材名')}\n"
-            f"- 返却予定日: {g('返却予定日') or '-'}\n"
-            f"- 用途/状態: {g('用途/状態') or '-'}\n"
-            f"- コメント: {g('コメント') or '-'}\n"
-            f"- 現在ステータス: {g('申請ステータス')}"
+        n = await run_mutation(itx, RepairAnomalies(self.anomalies))
+        skipped = len(self.anomalies) - n
+        await itx.followup.send(
+            f"🩺 {n} 件を修復しました。" + (f"（検出後に状態が変わった {skipped} 件は飛ばしました）" if skipped else ""),
+            ephemeral=True,
         )
-        view = ui.View(timeout=60)
-        view.add_item(ApproveButton(self.op, rowi))
-        view.add_item(RejectButton(self.op, rowi))
-        await itx.response.send_message(summary, view=view, ephemeral=True)
-
-class ApproveButton(ui.Button):
-    def __init__(self, op: str, rowi: int):
-        super().__init__(label="✅ 承認", style=discord.ButtonStyle.success, custom_id=f"ap_{rowi}")
-        self.op = op
-        self.rowi = rowi
-
-    async def callback(self, itx: discord.Interaction):
-        try:
-            approve_request(self.op, self.rowi)
-            await itx.response.send_message("承認しました。", ephemeral=True)
-        except Exception as e:
-            await itx.response.send_message(f"承認中にエラー: {e}", ephemeral=True)
-
-class RejectButton(ui.Button):
-    def __init__(self, op: str, rowi: int):
-        super().__init__(label="❌ 却下", style=discord.ButtonStyle.danger, custom_id=f"rj_{rowi}")
-        self.op = op
-        self.rowi = rowi
-
-    async def callback(self, itx: discord.Interaction):
-        try:
-            reject_request(self.op, self.rowi)
-            await itx.response.send_message("却下しました。", ephemeral=True)
-        except Exception as e:
-            await itx.response.send_message(f"却下中にエラー: {e}", ephemeral=True)
-
-def approve_request(op: str, rowi: int):
-    h = req_ws.row_values(1)
-    idx = {x: i for i, x in enumerate(h)}
-    r = req_ws.row_values(rowi)
-
-    def g(k):
-        return r[idx[k]] if k in idx and idx[k] < len(r) else ""
-
-    item = g("機材ID")
-    user = g("ユーザー名")
-    due = g("返却予定日")
-    inv_row = inv_find_row(item)
-    if inv_row is None:
-        raise RuntimeError("inventory に該当機材が見つかりません。")
-    # inventory: 1:ID, 2:名, 3:カテゴリ, 4:備考, 5:ステータス, 6:借用者, 7:返却予定
-    if op == "貸出申請":
-        inv_ws.update_cell(inv_row, 5, "貸出中")
-        inv_ws.update_cell(inv_row, 6, user)
-        inv_ws.update_cell(inv_row, 7, due)
-    elif op == "返却申請":
-        inv_ws.update_cell(inv_row, 5, "貸出可")
-        inv_ws.update_cell(inv_row, 6, "")
-        inv_ws.update_cell(inv_row, 7, "")
-    else:
-        raise RuntimeError("不明な操作")
-    req_ws.update_cell(rowi, idx["申請ステータス"] + 1, "approved")
-
-def reject_request(op: str, rowi: int):
-    h = req_ws.row_values(1)
-    idx = {x: i for i, x in enumerate(h)}
-    r = req_ws.row_values(rowi)
-
-    def g(k):
-        return r[idx[k]] if k in idx and idx[k] < len(r) else ""
-
-    item = g("機材ID")
-    inv_row = inv_find_row(item)
-    if inv_row is None:
-        raise RuntimeError("inventory に該当機材が見つかりません。")
-    if op == "貸出申請":
-        inv_ws.update_cell(inv_row, 5, "貸出可")
-        inv_ws.update_cell(inv_row, 6, "")
-        inv_ws.update_cell(inv_row, 7, "")
-    elif op == "返却申請":
-        inv_ws.update_cell(inv_row, 5, "貸出中")
-    else:
-        raise RuntimeError("不明な操作")
-    req_ws.update_cell(rowi, idx["申請ステータス"] + 1, "rejected")
 
 # ========= 一般向けパネル（貸出ボタンは停止中なら無効風） =========
-class PublicPanelView(ui.View):
+class PublicPanelView(LoanLinkView):
     def __init__(self, disabled_loan: bool):
         super().__init__(timeout=None)
         self.add_item(LoanByCategoryButton(disabled_loan))
         self.add_item(ReturnButton())
         self.add_item(StatusButton())
+        self.add_item(ReserveButton())
+        self.add_item(MyReservationsButton())
+        self.add_item(MyHistoryButton())
 
 class LoanByCategoryButton(ui.Button):
     def __init__(self, disabled_loan: bool):
@@ -1066,16 +4006,18 @@ class LoanByCategoryButton(ui.Button):
         super().__init__(label=label, style=style, custom_id="loan_by_cat", disabled=disabled_loan)
 
     async def callback(self, itx: discord.Interaction):
-        blocked, which, human = calc_is_blackout()
+        blocked, which, human = await run_deferred(itx, calc_is_blackout)
         if blocked:
-            return await itx.response.send_message(
+            return await itx.followup.send(
                 f"現在は**{which}期間（{human}）**のため、貸出申請は停止中です。返却は可能です。",
                 ephemeral=True,
             )
+        if current_tenant().degraded:
+            raise SheetsUnavailable()
         # ここから「個人 / プロジェクト」選択
-        view = ui.View(timeout=60)
+        view = LoanLinkView(timeout=60)
         view.add_item(LoanTypeSelect())
-        await itx.response.send_message("申請種別を選択してください：", view=view, ephemeral=True)
+        await itx.followup.send("申請種別を選択してください：", view=view, ephemeral=True)
 
 # 個人かプロジェクトかを選ぶセレクト
 class LoanTypeSelect(ui.Select):
@@ -1097,50 +4039,85 @@ class LoanTypeSelect(ui.Select):
     async def callback(self, itx: discord.Interaction):
         mode = self.values[0]
         if mode == "individual":
-            cats = inv_categories()
-            if not cats:
-                return await itx.response.send_message("カテゴリがありません。", ephemeral=True)
-            view = ui.View(timeout=60)
-            view.add_item(CategorySelect(cats))
-            await itx.response.send_message("カテゴリを選択：", view=view, ephemeral=True)
+            counts = await run_deferred(itx, inv_campus_counts)
+            if counts is None:
+                return await itx.followup.send("カテゴリがありません。", ephemeral=True)
+            view = LoanLinkView(timeout=60)
+            view.add_item(CampusFilterSelect(counts))
+            await itx.followup.send("機材のあるキャンパスで絞り込み：", view=view, ephemeral=True)
         else:
-            projs = proj_all()
+            projs = await run_deferred(itx, proj_all)
             if not projs:
-                return await itx.response.send_message(
+                return await itx.followup.send(
                     "プロジェクトが登録されていません。\n"
                     "スプレッドシートの **projects** シートに\n"
                     "『プロジェクト名』『説明』を入力してください。",
                     ephemeral=True,
                 )
-            view = ui.View(timeout=60)
+            view = LoanLinkView(timeout=60)
             view.add_item(ProjectSelect(projs))
-            await itx.response.send_message("プロジェクトを選択：", view=view, ephemeral=True)
+            await itx.followup.send("プロジェクトを選択：", view=view, ephemeral=True)
+
+# ---- キャンパスでの絞り込み（個人・プロジェクト共通） ----
+ALL_CAMPUSES = "__ALL__"
+
+class CampusFilterSelect(ui.Select):
+    """貸出可の機材があるキャンパスを台数付きで並べる。proj_name があればプロジェクト申請の続き"""
+
+    def __init__(self, counts: Dict[str, int], proj_name: Optional[str] = None):
+        self.proj_name = proj_name
+        opts = [discord.SelectOption(label="すべてのキャンパス", value=ALL_CAMPUSES,
+                                     description=f"貸出可 {sum(counts.values())} 台")]
+        for c in campus_order(counts)[:24]:
+            opts.append(discord.SelectOption(label=c, value=c, description=f"貸出可 {counts[c]} 台"))
+        super().__init__(
+            placeholder="キャンパスを選択",
+            options=opts,
+            custom_id="sel_campus_filter_proj" if proj_name is not None else "sel_campus_filter",
+        )
+
+    async def callback(self, itx: discord.Interaction):
+        campus = None if self.values[0] == ALL_CAMPUSES else self.values[0]
+        cats = await run_deferred(itx, inv_categories_at, campus)
+        if not cats:
+            return await itx.followup.send("このキャンパスには貸出可能な機材がありません。", ephemeral=True)
+        where = f"キャンパス: {campus}\n" if campus else ""
+        view = LoanLinkView(timeout=60)
+        if self.proj_name is None:
+            view.add_item(CategorySelect(cats, campus))
+            await itx.followup.send(f"{where}カテゴリを選択：", view=view, ephemeral=True)
+        else:
+            view.add_item(CategorySelectForProject(self.proj_name, cats, campus))
+            await itx.followup.send(
+                f"プロジェクト: {self.proj_name}\n{where}カテゴリを選択：", view=view, ephemeral=True,
+            )
 
 # ---- 個人申請フロー ----
 class CategorySelect(ui.Select):
-    def __init__(self, cats: List[str]):
+    def __init__(self, cats: List[str], campus: Optional[str] = None):
+        self.campus = campus
         super().__init__(
             placeholder="カテゴリを選択",
-            options=[discord.SelectOption(label=c, value=c) for c in cats],
+            options=[discord.SelectOption(label=c, value=c) for c in cats[:25]],
             custom_id="sel_cat",
         )
 
     async def callback(self, itx: discord.Interaction):
         cat = self.values[0]
-        items = inv_available(cat)
+        items = await run_deferred(itx, inv_available, cat, self.campus)
         if not items:
-            return await itx.response.send_message("貸出可能な機材がありません。", ephemeral=True)
-        view = ui.View(timeout=60)
+            return await itx.followup.send("貸出可能な機材がありません。", ephemeral=True)
+        view = LoanLinkView(timeout=60)
         view.add_item(ItemSelect(items))
-        await itx.response.send_message(f"{cat} の貸出可能機材：", view=view, ephemeral=True)
+        await itx.followup.send(f"{cat} の貸出可能機材：", view=view, ephemeral=True)
 
 class ItemSelect(ui.Select):
-    def __init__(self, items: List[dict]):
+    def __init__(self, items: List[Item]):
         opts = []
         for i in items[:25]:
-            label = f"{i['機材名']} ({i['機材ID']})"
-            desc = (i["備考"] or "")[:100]
-            opts.append(discord.SelectOption(label=label[:100], value=i["機材ID"], description=desc))
+            label = f"{i.name} ({i.item_id})"
+            desc = f"{i.campus} / {i.note}"[:100] if i.note else i.campus
+            opts.append(discord.SelectOption(label=label[:100], value=i.item_id, description=desc))
         super().__init__(placeholder="機材を選択", options=opts, custom_id="sel_item")
 
     async def callback(self, itx: discord.Interaction):
@@ -1150,7 +4127,7 @@ class ItemSelect(ui.Select):
             ephemeral=True,
         )
 
-class CampusSelectForLoanView(ui.View):
+class CampusSelectForLoanView(LoanLinkView):
     def __init__(self, item_id: str):
         super().__init__(timeout=120)
         self.add_item(CampusSelectForLoan(item_id))
@@ -1164,7 +4141,7 @@ class CampusSelectForLoan(ui.Select):
     async def callback(self, itx: discord.Interaction):
         await itx.response.send_modal(LoanFinalizeModal(self.item_id, self.values[0]))
 
-class LoanFinalizeModal(ui.Modal, title="貸出申請（個人）"):
+class LoanFinalizeModal(LoanLinkModal, title="貸出申請（個人）"):
     def __init__(self, item_id: str, campus: str):
         super().__init__()
         self.item_id = item_id
@@ -1184,30 +4161,21 @@ class LoanFinalizeModal(ui.Modal, title="貸出申請（個人）"):
         self.add_item(self.note)
 
     async def on_submit(self, itx: discord.Interaction):
-        # Unknown interaction 対策で先に defer
-        await itx.response.defer(ephemeral=True)
-
-        blocked, which, human = calc_is_blackout()
         u = itx.user
-        idx = inv_find_row(self.item_id)
-        if idx is None:
-            await itx.followup.send("inventory に対象機材が見つかりませんでした。", ephemeral=True)
+        due = await reject_bad_due(itx, self.date.value)
+        if due is None:
             return
-
-        vals = inv_ws.row_values(idx)
-        inv_name = vals[1] if len(vals) > 1 else ""
-        due = self.date.value.strip()
         base_note = self.note.value.strip()
         purpose = f"[個人] {base_note}" if base_note else "[個人]"
+        res, first = await run_once(itx, (u.id, self.item_id, "貸出申請"), lambda: run_mutation(
+            itx, SubmitLoan(self.item_id, u.id, u.display_name, self.campus, due, purpose),
+        ))
+        if res is None:
+            await itx.followup.send("inventory に対象機材が見つかりませんでした。", ephemeral=True)
+            return
+        inv_name, which, human = res
 
-        if blocked:
-            # 停止期間中：自動却下としてログだけ残す
-            req_ws.append_row([
-                now_jst_str(), str(u.id), u.display_name, self.campus,
-                "貸出申請", self.item_id, inv_name, due,
-                purpose,
-                f"{which}期間（{human}）のため自動却下", "rejected",
-            ])
+        if which:
             await itx.followup.send(
                 f"現在は**{which}期間（{human}）**のため、貸出申請は受け付けていません。\n"
                 "この申請は自動的に却下されました。返却申請は通常通り可能です。",
@@ -1215,25 +4183,16 @@ class LoanFinalizeModal(ui.Modal, title="貸出申請（個人）"):
             )
             return
 
-        # 通常時：申請を記録し、inventory を貸出申請中に更新
-        req_ws.append_row([
-            now_jst_str(), str(u.id), u.display_name, self.campus,
-            "貸出申請", self.item_id, inv_name, due,
-            purpose, "", "submitted",
-        ])
-        inv_ws.update_cell(idx, 5, "貸出申請中")
-        inv_ws.update_cell(idx, 6, u.display_name)
-        inv_ws.update_cell(idx, 7, due)
-
-        # 貸出申請通知（admin用チャンネル + メンション先）
-        await notify_request(
-            itx,
-            "新しい**貸出申請（個人）**があります。\n"
-            f"- 申請者: {u.display_name} (ID:{u.id})\n"
-            f"- 所属キャンパス: {self.campus}\n"
-            f"- 機材: {self.item_id} {inv_name}\n"
-            f"- 返却予定日: {due or '未入力'}",
-        )
+        # 貸出申請通知（admin用チャンネル + メンション先）。重複送信では通知しない
+        if first:
+            await notify_request(
+                itx,
+                "新しい**貸出申請（個人）**があります。\n"
+                f"- 申請者: {u.display_name} (ID:{u.id})\n"
+                f"- 所属キャンパス: {self.campus}\n"
+                f"- 機材: {self.item_id} {inv_name}\n"
+                f"- 返却予定日: {due or '未入力'}",
+            )
 
         # ユーザー向けメッセージ
         await itx.followup.send(
@@ -1246,15 +4205,15 @@ class LoanFinalizeModal(ui.Modal, title="貸出申請（個人）"):
 
 # ---- プロジェクト申請フロー ----
 class ProjectSelect(ui.Select):
-    def __init__(self, projs: List[dict]):
+    def __init__(self, projs: List[Project]):
         opts = []
         for p in projs[:25]:
-            label = p["name"]
-            desc = p["desc"]
+            label = p.name
+            desc = p.desc
             opts.append(
                 discord.SelectOption(
                     label=label[:100],
-                    value=p["name"],
+                    value=p.name,
                     description=desc[:100] if desc else None,
                 )
             )
@@ -1262,34 +4221,35 @@ class ProjectSelect(ui.Select):
 
     async def callback(self, itx: discord.Interaction):
         proj_name = self.values[0]
-        cats = inv_categories()
-        if not cats:
-            return await itx.response.send_message("カテゴリがありません。", ephemeral=True)
-        view = ui.View(timeout=60)
-        view.add_item(CategorySelectForProject(proj_name, cats))
-        await itx.response.send_message(
-            f"プロジェクト: {proj_name}\nカテゴリを選択：",
+        counts = await run_deferred(itx, inv_campus_counts)
+        if counts is None:
+            return await itx.followup.send("カテゴリがありません。", ephemeral=True)
+        view = LoanLinkView(timeout=60)
+        view.add_item(CampusFilterSelect(counts, proj_name))
+        await itx.followup.send(
+            f"プロジェクト: {proj_name}\n機材のあるキャンパスで絞り込み：",
             view=view,
             ephemeral=True,
         )
 
 class CategorySelectForProject(ui.Select):
-    def __init__(self, proj_name: str, cats: List[str]):
+    def __init__(self, proj_name: str, cats: List[str], campus: Optional[str] = None):
         self.proj_name = proj_name
+        self.campus = campus
         super().__init__(
             placeholder="カテゴリを選択",
-            options=[discord.SelectOption(label=c, value=c) for c in cats],
+            options=[discord.SelectOption(label=c, value=c) for c in cats[:25]],
             custom_id="sel_cat_proj",
         )
 
     async def callback(self, itx: discord.Interaction):
         cat = self.values[0]
-        items = inv_available(cat)
+        items = await run_deferred(itx, inv_available, cat, self.campus)
         if not items:
-            return await itx.response.send_message("貸出可能な機材がありません。", ephemeral=True)
-        view = ui.View(timeout=60)
+            return await itx.followup.send("貸出可能な機材がありません。", ephemeral=True)
+        view = LoanLinkView(timeout=60)
         view.add_item(ProjectItemMultiSelect(self.proj_name, items))
-        await itx.response.send_message(
+        await itx.followup.send(
             f"プロジェクト: {self.proj_name}\nカテゴリ: {cat}\n"
             "貸出したい機材を選択してください（複数選択可）：",
             view=view,
@@ -1297,13 +4257,13 @@ class CategorySelectForProject(ui.Select):
         )
 
 class ProjectItemMultiSelect(ui.Select):
-    def __init__(self, proj_name: str, items: List[dict]):
+    def __init__(self, proj_name: str, items: List[Item]):
         self.proj_name = proj_name
         opts = []
         for i in items[:25]:
-            label = f"{i['機材名']} ({i['機材ID']})"
-            desc = (i["備考"] or "")[:100]
-            opts.append(discord.SelectOption(label=label[:100], value=i["機材ID"], description=desc))
+            label = f"{i.name} ({i.item_id})"
+            desc = f"{i.campus} / {i.note}"[:100] if i.note else i.campus
+            opts.append(discord.SelectOption(label=label[:100], value=i.item_id, description=desc))
         max_vals = max(1, len(opts))
         super().__init__(
             placeholder="機材を選択（複数選択可能）",
@@ -1322,7 +4282,7 @@ class ProjectItemMultiSelect(ui.Select):
             ephemeral=True,
         )
 
-class CampusSelectForProjectView(ui.View):
+class CampusSelectForProjectView(LoanLinkView):
     def __init__(self, proj_name: str, item_ids: List[str]):
         super().__init__(timeout=120)
         self.add_item(CampusSelectForProject(proj_name, item_ids))
@@ -1338,7 +4298,7 @@ class CampusSelectForProject(ui.Select):
         campus = self.values[0]
         await itx.response.send_modal(ProjectLoanFinalizeModal(self.proj_name, self.item_ids, campus))
 
-class ProjectLoanFinalizeModal(ui.Modal, title="貸出申請（プロジェクト）"):
+class ProjectLoanFinalizeModal(LoanLinkModal, title="貸出申請（プロジェクト）"):
     def __init__(self, proj_name: str, item_ids: List[str], campus: str):
         super().__init__()
         self.proj_name = proj_name
@@ -1359,32 +4319,47 @@ class ProjectLoanFinalizeModal(ui.Modal, title="貸出申請（プロジェク
         self.add_item(self.note)
 
     async def on_submit(self, itx: discord.Interaction):
-        await itx.response.defer(ephemeral=True)
-
-        blocked, which, human = calc_is_blackout()
         u = itx.user
-        due = self.date.value.strip()
+        due = await reject_bad_due(itx, self.date.value)
+        if due is None:
+            return
+        await itx.response.defer(ephemeral=True)
         base_note = self.note.value.strip()
         purpose = f"[プロジェクト:{self.proj_name}] {base_note}" if base_note else f"[プロジェクト:{self.proj_name}]"
 
+        async def submit_all():
+            # 機材ごとのコマンドをまとめて積む（writer が 1 バッチで書き込む）
+            futs = current_tenant().mutations.submit(*(
+                SubmitLoan(item_id, u.id, u.display_name, self.campus, due, purpose) for item_id in self.item_ids
+            ))
+            return await asyncio.gather(*futs, return_exceptions=True)
+
+        fingerprint = (u.id, ",".join(sorted(self.item_ids)), f"プロジェクト:{self.proj_name}")
+        parts = [(u.id, item_id, "貸出申請") for item_id in self.item_ids]
+        results, first = await run_once(itx, fingerprint, submit_all, parts)
+
         success_items = []
         missing_items = []
+        refused = []
+        failed: List[Tuple[str, Exception]] = []
+        blocked, which, human = False, "", ""
+        for item_id, res in zip(self.item_ids, results):
+            if isinstance(res, MutationRejected):
+                refused.append(str(res))
+            elif isinstance(res, Exception):
+                failed.append((item_id, res))
+            elif res is None:
+                missing_items.append(item_id)
+            else:
+                inv_name, which, human = res
+                blocked = blocked or bool(which)
+                success_items.append(f"{item_id} {inv_name}".strip())
+        if failed and not success_items:
+            raise failed[0][1]  # 1 件も通っていなければ通常のエラーとして返す
+        for item_id, e in failed:
+            print(f"[loan] プロジェクト貸出の一部が失敗 ({self.proj_name} {item_id}): {e}")
 
         if blocked:
-            # 全機材について自動却下ログだけ残す
-            for item_id in self.item_ids:
-                idx = inv_find_row(item_id)
-                inv_name = ""
-                if idx is not None:
-                    vals = inv_ws.row_values(idx)
-                    inv_name = vals[1] if len(vals) > 1 else ""
-                req_ws.append_row([
-                    now_jst_str(), str(u.id), u.display_name, self.campus,
-                    "貸出申請", item_id, inv_name, due,
-                    purpose,
-                    f"{which}期間（{human}）のため自動却下", "rejected",
-                ])
-                success_items.append(f"{item_id} {inv_name}".strip())
             await itx.followup.send(
                 f"現在は**{which}期間（{human}）**のため、プロジェクト貸出申請は受け付けていません。\n"
                 "この申請はすべて自動的に却下されました。",
@@ -1392,25 +4367,7 @@ class ProjectLoanFinalizeModal(ui.Modal, title="貸出申請（プロジェク
             )
             return
 
-        # 通常時：複数機材を一括で submitted + inventory 更新
-        for item_id in self.item_ids:
-            idx = inv_find_row(item_id)
-            if idx is None:
-                missing_items.append(item_id)
-                continue
-            vals = inv_ws.row_values(idx)
-            inv_name = vals[1] if len(vals) > 1 else ""
-            req_ws.append_row([
-                now_jst_str(), str(u.id), u.display_name, self.campus,
-                "貸出申請", item_id, inv_name, due,
-                purpose, "", "submitted",
-            ])
-            inv_ws.update_cell(idx, 5, "貸出申請中")
-            inv_ws.update_cell(idx, 6, u.display_name)
-            inv_ws.update_cell(idx, 7, due)
-            success_items.append(f"{item_id} {inv_name}".strip())
-
-        if success_items:
+        if success_items and first:
             await notify_request(
                 itx,
                 "新しい**貸出申請（プロジェクト）**があります。\n"
@@ -1432,6 +4389,11 @@ class ProjectLoanFinalizeModal(ui.Modal, title="貸出申請（プロジェク
             msg_lines.append(
                 f"※ 以下の機材IDは在庫から見つからずスキップされました: {', '.join(missing_items)}"
             )
+        msg_lines.extend(f"※ {r}" for r in refused)
+        if failed:
+            msg_lines.append(
+                f"※ 以下の機材はエラーのため申請できませんでした（もう一度お試しください）: {', '.join(i for i, _ in failed)}"
+            )
         await itx.followup.send("\n".join(msg_lines), ephemeral=True)
 
 # ---- 返却フロー ----
@@ -1440,26 +4402,28 @@ class ReturnButton(ui.Button):
         super().__init__(label="返却申請", style=discord.ButtonStyle.success, custom_id="btn_return")
 
     async def callback(self, itx: discord.Interaction):
-        borrowed = inv_borrowed_by(itx.user.display_name)
+        if current_tenant().degraded:
+            raise SheetsUnavailable()
+        borrowed = [i for i in await run_deferred(itx, loans_of, itx.user.id) if i.status == "貸出中"]
         if not borrowed:
-            return await itx.response.send_message("貸出中の機材はありません。", ephemeral=True)
-        view = ui.View(timeout=60)
-        view.add_item(BorrowedItemSelect(borrowed))
-        await itx.response.send_message("返却する機材を選択：", view=view, ephemeral=True)
+            return await itx.followup.send("貸出中の機材はありません。", ephemeral=True)
+        view = LoanLinkView(timeout=60)
+        view.add_item(BorrowedItemSelect(borrowed[:25]))
+        await itx.followup.send("返却する機材を選択：", view=view, ephemeral=True)
 
 class BorrowedItemSelect(ui.Select):
-    def __init__(self, items: List[dict]):
+    def __init__(self, items: List[Item]):
         opts = []
         for i in items:
-            label = f"{i['機材名']} ({i['機材ID']})"
-            desc = f"状態: {i['ステータス'] or '-'} / 備考: {(i['備考'] or '')[:60]}"
-            opts.append(discord.SelectOption(label=label[:100], value=i["機材ID"], description=desc))
+            label = f"{i.name} ({i.item_id})"
+            desc = f"状態: {i.status or '-'} / 備考: {(i.note or '')[:60]}"
+            opts.append(discord.SelectOption(label=label[:100], value=i.item_id, description=desc))
         super().__init__(placeholder="返却機材を選択", options=opts, custom_id="sel_return")
 
     async def callback(self, itx: discord.Interaction):
         await itx.response.send_modal(ReturnFinalizeModal(self.values[0]))
 
-class ReturnFinalizeModal(ui.Modal, title="返却申請（確定）"):
+class ReturnFinalizeModal(LoanLinkModal, title="返却申請（確定）"):
     def __init__(self, item_id: str):
         super().__init__()
         self.item_id = item_id
@@ -1473,45 +4437,35 @@ class ReturnFinalizeModal(ui.Modal, title="返却申請（確定）"):
         self.add_item(self.condition)
         self.add_item(self.comment)
 
-    def infer_campus(self, item_id: str, user_name: str) -> str:
-        vals = req_ws.get_all_values()
-        if len(vals) < 2:
-            return "不明"
-        h = vals[0]
-        idx = {x: i for i, x in enumerate(h)}
+    def infer_campus(self, item_id: str, user_id) -> str:
+        """この利用者のこの機材の行だけを索引から読み、貸出申請時の所属キャンパスを引く"""
+        recs, _ = current_tenant().postings.fetch(
+            "user", str(user_id), lambda ents: [i for i, iid in ents if iid == item_id]
+        )
         latest = None
-        for r in reversed(vals[1:]):
-            try:
-                if r[idx["操作"]] != "貸出申請":
-                    continue
-                if r[idx["機材ID"]] != item_id:
-                    continue
-                if r[idx["ユーザー名"]] != user_name:
-                    continue
-                st = r[idx["申請ステータス"]]
-                campus = r[idx["所属キャンパス"]] if "所属キャンパス" in idx else "不明"
-                if st == "approved":
-                    return campus or "不明"
-                if st == "submitted" and latest is None:
-                    latest = campus or "不明"
-            except Exception:
+        for rec in reversed(recs):
+            if rec.op != "貸出申請" or rec.item_id != item_id:
                 continue
+            if rec.status == "approved":
+                return rec.campus or "不明"
+            if rec.status == "submitted" and latest is None:
+                latest = rec.campus or "不明"
         return latest or "不明"
 
     async def on_submit(self, itx: discord.Interaction):
         u = itx.user
-        idx = inv_find_row(self.item_id)
-        vals = inv_ws.row_values(idx)
-        inv_name = vals[1] if len(vals) > 1 else ""
-        campus = self.infer_campus(self.item_id, u.display_name)
-        req_ws.append_row([
-            now_jst_str(), str(u.id), u.display_name, campus,
-            "返却申請", self.item_id, inv_name, "",
-            self.condition.value, self.comment.value, "submitted",
-        ])
-        inv_ws.update_cell(idx, 5, "返却申請中")
-        inv_ws.update_cell(idx, 6, u.display_name)
-        await itx.response.send_message(
+
+        async def submit() -> Tuple[str, Optional[str]]:
+            campus = await run_deferred(itx, self.infer_campus, self.item_id, u.id)
+            return campus, await run_mutation(itx, SubmitReturn(
+                self.item_id, u.id, u.display_name, campus, self.condition.value, self.comment.value,
+            ))
+
+        (campus, inv_name), _ = await run_once(itx, (u.id, self.item_id, "返却申請"), submit)
+        if inv_name is None:
+            await itx.followup.send("inventory に対象機材が見つかりませんでした。", ephemeral=True)
+            return
+        await itx.followup.send(
             f"返却申請完了: {self.item_id} {inv_name}\n"
             f"- 所属キャンパス: {campus}\n"
             f"- 状態: {self.condition.value or '未入力'}",
@@ -1523,48 +4477,811 @@ class StatusButton(ui.Button):
         super().__init__(label="在庫状況", style=discord.ButtonStyle.secondary, custom_id="btn_status")
 
     async def callback(self, itx: discord.Interaction):
-        recs = inv_all()
-        if not recs:
-            return await itx.response.send_message("在庫なし。", ephemeral=True)
-        st = {}
-        for r in recs:
-            key = r["ステータス"] or "不明"
-            st[key] = st.get(key, 0) + 1
-        await itx.response.send_message(
-            "**在庫状況**\n" + "\n".join(f"- {k}: {v}" for k, v in st.items()),
+        msg, url = await run_deferred(itx, self.summary, itx.guild)
+        if not msg:
+            return await itx.followup.send("在庫なし。", ephemeral=True)
+        await itx.followup.send(
+            msg + (f"\n\nカテゴリ別の最新状況はこちらで常に確認できます: {url}" if url else ""),
+            ephemeral=True,
+        )
+
+    @staticmethod
+    def summary(guild: Optional[discord.Guild]) -> Tuple[str, str]:
+        return inventory_summary(), board_url(guild)
+
+# ========= 予約（日付を指定した先の貸出） =========
+# reservations シートに 1 予約 1 行で記録する。予約中の行は機材ごとに開始日順に並べ、
+# 「開始日の列」と「そこまでの終了日の最大値」で期間の重なりを二分探索 1 回で判定する。
+# 空き状況は 予約 + 現在の貸出（返却予定日まで）+ 停止期間 を合わせて判断する。
+RES_ACTIVE = "予約中"
+RES_CANCELLED = "取消"
+RES_MAX_DAYS = 30  # 1 回の予約で押さえられる日数
+RES_STATUS_COL = RES_HEADERS.index("ステータス") + 1
+
+def new_reservation_id() -> str:
+    return "Y" + uuid.uuid4().hex[:10].upper()
+
+class Reservation:
+    __slots__ = ("row", "res_id", "item_id", "user_id", "user_name", "start", "end", "purpose", "status", "ts")
+
+    def __init__(self, row: int, res_id: str, item_id: str, user_id: str, user_name: str,
+                 start: date, end: date, purpose: str, status: str, ts: str):
+        self.row = row
+        self.res_id = res_id
+        self.item_id = item_id
+        self.user_id = user_id
+        self.user_name = user_name
+        self.start = start
+        self.end = end
+        self.purpose = purpose
+        self.status = sys.intern(status)
+        self.ts = ts
+
+    @property
+    def period(self) -> str:
+        return f"{self.start.isoformat()}〜{self.end.isoformat()}"
+
+class ReservationBook:
+    """
+    reservations 全体（予約ID → 予約 と、機材ごとの予約中の区間）。
+    機材ごとに開始日順の一覧と、その終了日の最大値を持つセグメント木を作り、重なりを O(log n) で探す
+    """
+    __slots__ = ("by_id", "by_item", "starts", "max_end")
+
+    def __init__(self, rows: List[List[str]]):
+        self.by_id: Dict[str, Reservation] = {}
+        self.by_item: Dict[str, List[Reservation]] = {}
+        if rows:
+            pos = column_positions(rows[0], RES_HEADERS)
+            for i, r in enumerate(rows[1:], start=2):
+                rid, item_id, uid, uname, start, end, purpose, status, ts = pick(r, pos)
+                s, e = parse_due(start), parse_due(end)
+                if not rid or s is None or e is None:
+                    continue
+                res = Reservation(i, rid, item_id, uid, uname, s, e, purpose, status, ts)
+                self.by_id[rid] = res
+                if res.status == RES_ACTIVE:
+                    self.by_item.setdefault(item_id, []).append(res)
+        self.starts: Dict[str, List[date]] = {}
+        self.max_end: Dict[str, List[date]] = {}  # 葉が予約の終了日、節が子の最大値（1 始まりの配列）
+        for item_id, lst in self.by_item.items():
+            lst.sort(key=lambda x: (x.start, x.end))
+            self.starts[item_id] = [x.start for x in lst]
+            size = 1
+            while size < len(lst):
+                size *= 2
+            tree = [date.min] * (2 * size)
+            tree[size:size + len(lst)] = [x.end for x in lst]
+            for node in range(size - 1, 0, -1):
+                tree[node] = max(tree[2 * node], tree[2 * node + 1])
+            self.max_end[item_id] = tree
+
+    def conflict(self, item_id: str, start: date, end: date, ignore_user: str = "") -> Optional[Reservation]:
+        """[start, end] と重なる予約中の予約（ignore_user の予約は除く）。無ければ None"""
+        starts = self.starts.get(item_id)
+        if not starts:
+            return None
+        lst, tree = self.by_item[item_id], self.max_end[item_id]
+        i = bisect.bisect_right(starts, end)  # 開始日が end 以前の予約だけが候補
+        while i > 0:
+            j = self._last_ending_after(tree, 1, 0, len(tree) // 2, i, start)
+            if j < 0:
+                return None
+            if lst[j].user_id != ignore_user:
+                return lst[j]
+            i = j  # 本人の予約は飛ばしてその手前を探す
+        return None
+
+    @classmethod
+    def _last_ending_after(cls, tree: List[date], node: int, lo: int, width: int, hi: int, start: date) -> int:
+        """node が受け持つ [lo, lo + width) のうち hi 未満で終了日が start 以降の最後の位置（無ければ -1）"""
+        if lo >= hi or tree[node] < start:
+            return -1
+        if width == 1:
+            return lo
+        half = width // 2
+        j = cls._last_ending_after(tree, 2 * node + 1, lo + half, half, hi, start)
+        return j if j >= 0 else cls._last_ending_after(tree, 2 * node, lo, half, hi, start)
+
+    def of_user(self, user_id: str, today: date) -> List[Reservation]:
+        return sorted(
+            (r for r in self.by_id.values() if r.user_id == user_id and r.status == RES_ACTIVE and r.end >= today),
+            key=lambda r: r.start,
+        )
+
+def res_book() -> ReservationBook:
+    return current_tenant().records("reservations", ReservationBook)
+
+def loan_blocks(it: Item, start: date) -> bool:
+    """現在の貸出・申請が start の時点でまだ続いているか（返却予定日が無ければ続いているとみなす）"""
+    if it.available:
+        return False
+    due = parse_due(it.due)
+    return due is None or due >= start
+
+def available_between(cat: str, start: date, end: date) -> List[Item]:
+    """カテゴリ内で [start, end] に予約できる機材（カテゴリを 1 回なめるだけで判定する）"""
+    book = res_book()
+    return [
+        it for it in inv_all()
+        if it.category == cat and not loan_blocks(it, start) and book.conflict(it.item_id, start, end) is None
+    ]
+
+class Reserve(Mutation):
+    """予約。戻り値は (機材名, 予約ID)。機材が無ければ None"""
+    __slots__ = ("item_id", "user_id", "user_name", "start", "end", "purpose")
+
+    def __init__(self, item_id: str, user_id: int, user_name: str, start: date, end: date, purpose: str):
+        self.item_id = item_id
+        self.user_id = user_id
+        self.user_name = user_name
+        self.start = start
+        self.end = end
+        self.purpose = purpose
+
+    def apply(self, b: MutationBatch):
+        it = b.find_item(self.item_id)
+        if it is None:
+            return None
+        blocked, which, human = calc_is_blackout(self.start, self.end)
+        if blocked:
+            raise MutationRejected(f"{which}期間（{human}）にかかるため予約できません。")
+        if loan_blocks(it, self.start):
+            raise MutationRejected(f"{it.item_id} {it.name} は {it.due or '返却予定日未定'} まで{it.status}です。")
+        other = res_book().conflict(self.item_id, self.start, self.end)
+        if other is None:
+            other = b.res_conflict(self.item_id, self.start, self.end)
+        if other is not None:
+            raise MutationRejected(f"{it.item_id} {it.name} は {other.period} に予約が入っています。")
+        rid = new_reservation_id()
+        b.add_reservation([
+            rid, self.item_id, str(self.user_id), self.user_name,
+            self.start.isoformat(), self.end.isoformat(), self.purpose, RES_ACTIVE, now_jst_str(),
+        ])
+        return it.name, rid
+
+class CancelReservation(Mutation):
+    """予約の取消（本人のみ）。戻り値は取り消した予約"""
+    __slots__ = ("res_id", "user_id")
+
+    def __init__(self, res_id: str, user_id: int):
+        self.res_id = res_id
+        self.user_id = user_id
+
+    def apply(self, b: MutationBatch):
+        res = res_book().by_id.get(self.res_id)
+        if res is None or res.user_id != str(self.user_id):
+            raise MutationRejected("予約が見つかりません。")
+        if res.status != RES_ACTIVE:
+            raise MutationRejected("この予約はすでに取り消されています。")
+        b.set_res(res.row, RES_STATUS_COL, RES_CANCELLED)
+        return res
+
+class ReserveButton(ui.Button):
+    def __init__(self):
+        super().__init__(label="📅 日付を指定して予約", style=discord.ButtonStyle.primary, custom_id="reserve")
+
+    async def callback(self, itx: discord.Interaction):
+        if current_tenant().degraded:
+            raise SheetsUnavailable()
+        cats = await run_deferred(itx, inv_categories)
+        if not cats:
+            return await itx.followup.send("カテゴリがありません。", ephemeral=True)
+        view = LoanLinkView(timeout=60)
+        view.add_item(ReserveCategorySelect(cats))
+        await itx.followup.send("予約する機材のカテゴリを選択：", view=view, ephemeral=True)
+
+class ReserveCategorySelect(ui.Select):
+    def __init__(self, cats: List[str]):
+        super().__init__(
+            placeholder="カテゴリを選択",
+            options=[discord.SelectOption(label=c, value=c) for c in cats],
+            custom_id="sel_cat_reserve",
+        )
+
+    async def callback(self, itx: discord.Interaction):
+        await itx.response.send_modal(ReserveDatesModal(self.values[0]))
+
+class ReserveDatesModal(LoanLinkModal, title="予約（日付指定）"):
+    def __init__(self, cat: str):
+        super().__init__()
+        self.cat = cat
+        self.start = ui.TextInput(label="開始日（YYYY-MM-DD）", placeholder="例: 2025-11-01", required=True, max_length=12)
+        self.end = ui.TextInput(label="終了日（YYYY-MM-DD）", placeholder="例: 2025-11-03", required=True, max_length=12)
+        self.purpose = ui.TextInput(
+            label="用途（任意）",
+            placeholder="例: 文化祭ブース展示",
+            style=discord.TextStyle.paragraph,
+            required=False,
+        )
+        self.add_item(self.start)
+        self.add_item(self.end)
+        self.add_item(self.purpose)
+
+    async def on_submit(self, itx: discord.Interaction):
+        start = await reject_bad_due(itx, self.start.value, label="開始日")
+        if not start:
+            return
+        end = await reject_bad_due(itx, self.end.value, label="終了日")
+        if not end:
+            return
+        s, e = date.fromisoformat(start), date.fromisoformat(end)
+        if e < s:
+            return await itx.response.send_message("終了日が開始日より前です。", ephemeral=True)
+        if (e - s).days + 1 > RES_MAX_DAYS:
+            return await itx.response.send_message(f"予約できるのは最長 {RES_MAX_DAYS} 日間です。", ephemeral=True)
+        blocked, which, human = await run_deferred(itx, calc_is_blackout, s, e)
+        if blocked:
+            return await itx.followup.send(
+                f"指定の期間は**{which}期間（{human}）**にかかるため予約できません。", ephemeral=True
+            )
+        items = await run_deferred(itx, available_between, self.cat, s, e)
+        if not items:
+            return await itx.followup.send(f"{self.cat} に {start}〜{end} で空いている機材はありません。", ephemeral=True)
+        view = LoanLinkView(timeout=120)
+        view.add_item(ReserveItemSelect(items, s, e, self.purpose.value.strip()))
+        await itx.followup.send(
+            f"{self.cat} で **{start}〜{end}** に空いている機材（{len(items)} 台）：",
+            view=view,
             ephemeral=True,
         )
 
+class ReserveItemSelect(ui.Select):
+    def __init__(self, items: List[Item], start: date, end: date, purpose: str):
+        self.start = start
+        self.end = end
+        self.purpose = purpose
+        opts = []
+        for i in items[:25]:
+            label = f"{i.name} ({i.item_id})"
+            desc = (i.note or "")[:100]
+            opts.append(discord.SelectOption(label=label[:100], value=i.item_id, description=desc))
+        super().__init__(
+            placeholder="予約する機材を選択（複数選択可能）",
+            options=opts,
+            min_values=1,
+            max_values=len(opts),
+            custom_id="sel_items_reserve",
+        )
+
+    async def callback(self, itx: discord.Interaction):
+        await itx.response.defer(ephemeral=True)
+        u = itx.user
+        item_ids = list(self.values)
+        futs = current_tenant().mutations.submit(*(
+            Reserve(item_id, u.id, u.display_name, self.start, self.end, self.purpose) for item_id in item_ids
+        ))
+        results = await asyncio.gather(*futs, return_exceptions=True)
+        done, refused = [], []
+        for item_id, res in zip(item_ids, results):
+            if isinstance(res, MutationRejected):
+                refused.append(str(res))
+            elif isinstance(res, Exception):
+                # 他の機材の予約は書き込み済みのことがあるので、ここで投げずに結果と一緒に返す
+                print(f"[reserve] 予約失敗 ({item_id}): {res}")
+                refused.append(f"{item_id} はエラーのため予約できませんでした。もう一度お試しください。")
+            elif res is None:
+                refused.append(f"{item_id} は inventory に見つかりませんでした。")
+            else:
+                done.append(f"{item_id} {res[0]}（{res[1]}）")
+        lines = []
+        if done:
+            lines.append(f"✅ **{self.start.isoformat()}〜{self.end.isoformat()}** で予約しました：")
+            lines.extend(f"- {x}" for x in done)
+        if refused:
+            lines.append("⚠️ 予約できなかった機材：")
+            lines.extend(f"- {x}" for x in refused)
+        await itx.followup.send("\n".join(lines), ephemeral=True)
+
+class MyReservationsButton(ui.Button):
+    def __init__(self):
+        super().__init__(label="予約の確認・取消", style=discord.ButtonStyle.secondary, custom_id="my_reservations")
+
+    async def callback(self, itx: discord.Interaction):
+        mine, names = await run_deferred(itx, self.load, str(itx.user.id))
+        if not mine:
+            return await itx.followup.send("予約はありません。", ephemeral=True)
+        lines = ["📅 **あなたの予約**"]
+        lines.extend(f"- {r.period} {r.item_id} {names.get(r.item_id, '')}（{r.res_id}）" for r in mine[:25])
+        view = LoanLinkView(timeout=120)
+        view.add_item(ReservationCancelSelect(mine[:25], names))
+        await itx.followup.send("\n".join(lines), view=view, ephemeral=True)
+
+    @staticmethod
+    def load(user_id: str) -> Tuple[List["Reservation"], Dict[str, str]]:
+        return res_book().of_user(user_id, today_jst()), {it.item_id: it.name for it in inv_all()}
+
+class ReservationCancelSelect(ui.Select):
+    def __init__(self, mine: List[Reservation], names: Dict[str, str]):
+        opts = [
+            discord.SelectOption(label=f"{r.period} {r.item_id} {names.get(r.item_id, '')}"[:100], value=r.res_id)
+            for r in mine
+        ]
+        super().__init__(placeholder="取り消す予約を選択", options=opts, custom_id="sel_res_cancel")
+
+    async def callback(self, itx: discord.Interaction):
+        res = await run_mutation(itx, CancelReservation(self.values[0], itx.user.id))
+        await itx.followup.send(f"予約 {res.period} {res.item_id} を取り消しました。", ephemeral=True)
+
+# ========= 返却期限リマインダー / 延滞通知 =========
+REMIND_HOUR = 9  # リマインド・延滞通知を送る時刻（JST）
+
+DUE_PAGE_ROWS = 10
+DUE_UPCOMING_DAYS = 7
+
+def normalize_due(raw: str) -> Optional[str]:
+    """返却予定日の入力を YYYY-MM-DD に揃える（空欄は ""、日付として解釈できなければ None）"""
+    s = unicodedata.normalize("NFKC", raw or "").strip()
+    if not s:
+        return ""
+    m = re.fullmatch(r"(\d{4})\s*[-/.年]\s*(\d{1,2})\s*[-/.月]\s*(\d{1,2})\s*日?", s)
+    if not m:
+        return None
+    try:
+        return date(*map(int, m.groups())).isoformat()
+    except ValueError:
+        return None
+
+def parse_due(s: str) -> Optional[date]:
+    n = normalize_due(s)
+    return date.fromisoformat(n) if n else None
+
+async def reject_bad_due(itx: discord.Interaction, raw: str, allow_past: bool = False,
+                         label: str = "返却予定日") -> Optional[str]:
+    """日付の入力を検証して正規化した値を返す。不正なら利用者に伝えて None"""
+    due = normalize_due(raw)
+    if due is None:
+        await reply_error(itx, f"{label}「{raw.strip()}」を日付として読めませんでした。YYYY-MM-DD 形式（例: 2025-11-15）で入力してください。")
+        return None
+    if due and not allow_past and date.fromisoformat(due) < today_jst():
+        await reply_error(itx, f"{label}（{due}）が過去の日付です。")
+        return None
+    return due
+
+class DueLoan:
+    __slots__ = ("item_id", "item_name", "user_id", "user_name", "due", "version")
+
+    def __init__(self, item_id: str, item_name: str, user_id: Optional[int], user_name: str, due: date, version: int):
+        self.item_id = item_id
+        self.item_name = item_name
+        self.user_id = user_id
+        self.user_name = user_name
+        self.due = due
+        self.version = version
+
+class DueScheduler:
+    """
+    貸出中の機材を返却予定日でヒープ管理し、次の期限まで眠って待つ。
+      - 返却予定日の DUE_REMIND_DAYS 日前: 借用者へ DM リマインド
+      - 返却予定日の翌日: お知らせチャンネルへ延滞通知
+    ヒープの要素は (発火時刻, 連番, 種別, 機材ID, version)。
+    貸出の更新・返却で version を進め、古い要素は取り出し時に捨てる（遅延削除）。
+    管理画面の「延滞中」「まもなく返却」用に (返却予定日, 機材ID) の整列済みリストも持ち、
+    範囲の問い合わせは二分探索で切り出す。
+    """
+
+    def __init__(self):
+        self.heap: List[Tuple[datetime, int, str, str, int]] = []
+        self.loans: Dict[str, DueLoan] = {}
+        self.by_due: List[Tuple[date, str]] = []
+        self._seq = 0
+        self._version = 0
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def remind_days(self) -> int:
+        """track はバッチの後処理としてループ上で呼ばれるので、最後に読んだ config を使う（Sheets は読まない）"""
+        try:
+            return max(0, int(current_tenant().peek_records("config", parse_config).get("DUE_REMIND_DAYS") or 1))
+        except ValueError:
+            return 1
+
+    def _push(self, at: datetime, kind: str, loan: DueLoan):
+        self._seq += 1
+        heapq.heappush(self.heap, (at, self._seq, kind, loan.item_id, loan.version))
+
+    def track(self, item_id: str, item_name: str, user_id: Optional[int], user_name: str, due_str: str,
+              lead_days: Optional[int] = None, skip_past: bool = False):
+        """貸出を登録（同じ機材の既存エントリは置き換え）。返却予定日が無効なら追跡しない"""
+        due = parse_due(due_str)
+        if due is None:
+            self.untrack(item_id)
+            return
+        if lead_days is None:
+            lead_days = self.remind_days()
+        self._version += 1
+        loan = DueLoan(item_id, item_name, user_id, user_name, due, self._version)
+        self._unindex(self.loans.get(item_id))
+        self.loans[item_id] = loan
+        bisect.insort(self.by_due, (due, item_id))
+        remind_at = datetime.combine(due - timedelta(days=lead_days), datetime.min.time(), JST).replace(hour=REMIND_HOUR)
+        overdue_at = datetime.combine(due + timedelta(days=1), datetime.min.time(), JST).replace(hour=REMIND_HOUR)
+        now = datetime.now(JST)
+        # 起動時の読み込みでは過去の通知を再送しない
+        if not (skip_past and remind_at <= now) and remind_at < overdue_at:
+            self._push(remind_at, "remind", loan)
+        if not (skip_past and overdue_at <= now):
+            self._push(overdue_at, "overdue", loan)
+        self._wake.set()
+
+    def untrack(self, item_id: str):
+        loan = self.loans.pop(item_id, None)
+        if loan is not None:
+            self._unindex(loan)
+            self._wake.set()
+
+    def _unindex(self, loan: Optional[DueLoan]):
+        if loan is None:
+            return
+        i = bisect.bisect_left(self.by_due, (loan.due, loan.item_id))
+        if i < len(self.by_due) and self.by_due[i] == (loan.due, loan.item_id):
+            del self.by_due[i]
+
+    def between(self, start: Optional[date], end: Optional[date],
+                offset: int = 0, limit: Optional[int] = None) -> Tuple[List[DueLoan], int]:
+        """返却予定日が start 以上 end 未満の貸出を返却予定日順に offset から limit 件と、該当の総数"""
+        lo = bisect.bisect_left(self.by_due, (start, "")) if start else 0
+        hi = bisect.bisect_left(self.by_due, (end, "")) if end else len(self.by_due)
+        first = min(lo + offset, hi)
+        last = hi if limit is None else min(hi, first + limit)
+        return [self.loans[k] for _, k in self.by_due[first:last]], hi - lo
+
+    def overdue(self, today: date, offset: int = 0, limit: Optional[int] = None) -> Tuple[List[DueLoan], int]:
+        return self.between(None, today, offset, limit)
+
+    def upcoming(self, today: date, days: int, offset: int = 0, limit: Optional[int] = None) -> Tuple[List[DueLoan], int]:
+        """今日から days 日後までに返却予定の貸出"""
+        return self.between(today, today + timedelta(days=days + 1), offset, limit)
+
+    def load(self):
+        """inventory の貸出中機材と在庫状態エンジンの借用者IDから一括構築"""
+        user_ids: Dict[str, int] = {}
+        for item_id, st in current_tenant().engine.state.items():
+            if st.borrower_id.isdigit():
+                user_ids[item_id] = int(st.borrower_id)
+        self.heap.clear()
+        self.loans.clear()
+        self.by_due.clear()
+        lead = self.remind_days()
+        for it in inv_all():
+            if it.status == "貸出中":
+                self.track(it.item_id, it.name, user_ids.get(it.item_id), it.borrower, it.due,
+                           lead_days=lead, skip_past=True)
+
+    def start(self):
+        self.load()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            now = datetime.now(JST)
+            while self.heap and self.heap[0][0] <= now:
+                _, _, kind, item_id, version = heapq.heappop(self.heap)
+                loan = self.loans.get(item_id)
+                if loan is None or loan.version != version:
+                    continue
+                try:
+                    if kind == "remind":
+                        await self._send_remind(loan)
+                    else:
+                        await self._send_overdue(loan)
+                except Exception as e:
+                    print(f"[due] 通知に失敗: {item_id} {kind}: {e}")
+            timeout = (self.heap[0][0] - now).total_seconds() if self.heap else None
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _send_remind(self, loan: DueLoan):
+        if loan.user_id is None:
+            return
+        user = bot.get_user(loan.user_id) or await bot.fetch_user(loan.user_id)
+        try:
+            await user.send(
+                f"⏰ 返却予定日のお知らせ\n"
+                f"- 機材: {loan.item_id} {loan.item_name}\n"
+                f"- 返却予定日: {loan.due.isoformat()}\n"
+                "期限までに返却申請をお願いします。"
+            )
+        except discord.Forbidden:
+            pass
+
+    async def _send_overdue(self, loan: DueLoan):
+        ch = await announce_channel()
+        if ch is None:
+            return
+        who = f"<@{loan.user_id}>" if loan.user_id else loan.user_name
+        await ch.send(
+            f"⚠️ 返却期限を過ぎた機材があります。\n"
+            f"- 機材: {loan.item_id} {loan.item_name}\n"
+            f"- 借用者: {who}\n"
+            f"- 返却予定日: {loan.due.isoformat()}"
+        )
+
+DUE_VIEWS = {"overdue": "延滞中", "upcoming": f"{DUE_UPCOMING_DAYS}日以内に返却予定"}
+
+def due_page_message(kind: str, page: int) -> Tuple[str, "DueListView"]:
+    due = current_tenant().due
+    today = today_jst()
+    if kind == "overdue":
+        loans, total = due.overdue(today, page * DUE_PAGE_ROWS, DUE_PAGE_ROWS)
+    else:
+        loans, total = due.upcoming(today, DUE_UPCOMING_DAYS, page * DUE_PAGE_ROWS, DUE_PAGE_ROWS)
+    pages = max(1, -(-total // DUE_PAGE_ROWS))
+    lines = [f"📅 **{DUE_VIEWS[kind]}**（{total} 件・{page + 1}/{pages} ページ）"]
+    for loan in loans:
+        days = (today - loan.due).days
+        when = f"{days}日超過" if days > 0 else ("今日" if days == 0 else f"あと{-days}日")
+        who = f"<@{loan.user_id}>" if loan.user_id else loan.user_name
+        lines.append(f"- {loan.due.isoformat()}（{when}）{loan.item_id} {loan.item_name} / {who}")
+    if not loans:
+        lines.append("- なし")
+    return "\n".join(lines), DueListView(kind, page, pages)
+
+class AdminDueListButton(ui.Button):
+    def __init__(self):
+        super().__init__(label="📅 延滞・返却予定", style=discord.ButtonStyle.secondary, custom_id="admin_due")
+
+    async def callback(self, itx: discord.Interaction):
+        if not is_admin(itx.user):
+            return await itx.response.send_message("権限がありません。", ephemeral=True)
+        text, view = due_page_message("overdue", 0)
+        await itx.response.send_message(text, view=view, ephemeral=True, allowed_mentions=discord.AllowedMentions.none())
+
+class DueListView(LoanLinkView):
+    def __init__(self, kind: str, page: int, pages: int):
+        super().__init__(timeout=300)
+        for k, label in DUE_VIEWS.items():
+            self.add_item(DuePageButton(k, 0, label, f"due_{k}", disabled=k == kind))
+        self.add_item(DuePageButton(kind, page - 1, "◀", "due_prev", disabled=page <= 0))
+        self.add_item(DuePageButton(kind, page + 1, "▶", "due_next", disabled=page + 1 >= pages))
+
+class DuePageButton(ui.Button):
+    def __init__(self, kind: str, page: int, label: str, custom_id: str, disabled: bool = False):
+        super().__init__(label=label, style=discord.ButtonStyle.secondary, custom_id=custom_id, disabled=disabled)
+        self.kind = kind
+        self.page = page
+
+    async def callback(self, itx: discord.Interaction):
+        text, view = due_page_message(self.kind, self.page)
+        await itx.response.edit_message(content=text, view=view, allowed_mentions=discord.AllowedMentions.none())
+
+# ========= 公開パネルの追跡と停止期間の切り替え =========
+MAX_TRACKED_PANELS = 20
+
+def panel_content(blocked: bool, which: str, human: str) -> str:
+    if blocked:
+        return f"※ 現在は**{which}期間（{human}）**のため、貸出は停止中です（返却は可能）。"
+    return "貸出・返却メニュー"
+
+def panel_locations() -> List[Tuple[int, int]]:
+    out = []
+    for part in (cfg_get("PUBLIC_PANELS") or "").split(","):
+        ch, _, msg = part.partition(":")
+        if ch.isdigit() and msg.isdigit():
+            out.append((int(ch), int(msg)))
+    return out
+
+def save_panel_locations(locs: List[Tuple[int, int]]):
+    cfg_set("PUBLIC_PANELS", ",".join(f"{c}:{m}" for c, m in locs[-MAX_TRACKED_PANELS:]))
+
+def track_panel(channel_id: int, message_id: int):
+    locs = panel_locations()
+    locs.append((channel_id, message_id))
+    save_panel_locations(locs)
+
+class PanelScheduler:
+    """
+    投稿済みの公開パネルを、次の停止期間の開始/終了まで眠って待ち、
+    その時点の状態（貸出ボタンの有効/無効）に編集し直す。
+    停止期間が追加・切替・削除されたら reschedule() で起こして予定を組み直す。
+    """
+
+    def __init__(self, tenant: "Tenant"):
+        self.tenant = tenant
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.next_at: Optional[datetime] = None
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.edits = 0
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def reschedule(self):
+        """スレッドからも呼べる"""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._wake.set)
+
+    async def _run(self):
+        while True:
+            try:
+                await self.refresh_panels()
+                nxt = await asyncio.to_thread(next_blackout_transition)
+            except Exception as e:
+                print(f"[panel] 更新失敗 ({self.tenant.key}): {e}")
+                nxt = today_jst() + timedelta(days=1)
+            self.next_at = datetime.combine(nxt, datetime.min.time(), JST) if nxt else None
+            timeout = (self.next_at - datetime.now(JST)).total_seconds() if self.next_at else None
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                self.tenant.board.schedule()  # 日付で停止状態が変わったのでボードも更新
+
+    async def refresh_panels(self):
+        blocked, which, human = await asyncio.to_thread(calc_is_blackout)
+        locs = await asyncio.to_thread(panel_locations)
+        alive = []
+        for ch_id, msg_id in locs:
+            # 消えたと分かった（NotFound）パネルだけを外す。権限・一時的な失敗は残して次回また試す
+            try:
+                ch = bot.get_channel(ch_id) or await bot.fetch_channel(ch_id)  # スレッドや未キャッシュのチャンネル
+                await ch.get_partial_message(msg_id).edit(
+                    content=panel_content(blocked, which, human),
+                    view=PublicPanelView(disabled_loan=blocked),
+                )
+                self.edits += 1
+            except discord.NotFound:
+                continue
+            except discord.HTTPException as e:
+                print(f"[panel] パネルを更新できません ({self.tenant.key} {ch_id}:{msg_id}): {e}")
+            alive.append((ch_id, msg_id))
+        if alive != locs:
+            await asyncio.to_thread(save_panel_locations, alive)
+
 # ========= 起動時 =========
-@bot.event
 async def on_ready():
-    bot.add_view(AdminPanelView())  # Persistent admin view
+    await asyncio.gather(*(start_tenant(guild) for guild in bot.guilds))
     print("🔗 LoanLink is now online!")
 
-# ========= メッセージコマンド =========
-@bot.event
-async def on_message(msg: discord.Message):
-    if msg.author.bot:
-        return
-    content = msg.content.strip()
-    if content == "!admin":
-        if not isinstance(msg.author, discord.Member) or not is_admin(msg.author):
-            return await msg.channel.send("権限がありません。")
-        await msg.channel.send("🛡️ LoanLink Admin メニュー", view=AdminPanelView())
+async def start_tenant(guild: discord.Guild):
+    try:
+        await tenants.for_guild(guild.id).start()
+    except TenantNotConfigured:
+        print(f"[tenant] {guild.name} ({guild.id}) はスプレッドシート未設定のためスキップ")
+
+async def on_guild_join(guild: discord.Guild):
+    await start_tenant(guild)
+
+# ========= ロール / チャンネルイベント（検索インデックスの差分更新） =========
+# メンバーのイベントは members インテントが必要なので購読しない（メンバーは操作時に取り込む）
+async def on_guild_role_create(role: discord.Role):
+    idx = _member_indexes.get(role.guild.id)
+    if idx:
+        idx.add_role(role)
+
+async def on_guild_role_update(before: discord.Role, after: discord.Role):
+    idx = _member_indexes.get(after.guild.id)
+    if idx:
+        idx.add_role(after)
+
+async def on_guild_role_delete(role: discord.Role):
+    idx = _member_indexes.get(role.guild.id)
+    if idx:
+        idx.remove_role(role.id)
+    _drop_destination_if(role.guild.id, "role", role.id)
+
+async def on_guild_channel_delete(channel: discord.abc.GuildChannel):
+    _drop_destination_if(channel.guild.id, "channel", channel.id)
+
+# ========= スラッシュコマンド =========
+class NotAdmin(app_commands.CheckFailure):
+    pass
+
+def admin_only():
+    async def predicate(itx: discord.Interaction) -> bool:
+        if not isinstance(itx.user, discord.Member) or not is_admin(itx.user):
+            raise NotAdmin("権限がありません。")
+        return True
+    return app_commands.check(predicate)
+
+@app_commands.command(name="admin", description="LoanLink の管理メニューをこのチャンネルに表示します")
+@app_commands.guild_only()
+@admin_only()
+async def admin_command(itx: discord.Interaction):
+    if not await bind_interaction(itx):
         return
-    if content == "!set":
-        blocked, which, human = calc_is_blackout()
-        view = PublicPanelView(disabled_loan=blocked)
-        if blocked:
-            await msg.channel.send(
-                f"※ 現在は**{which}期間（{human}）**のため、貸出は停止中です（返却は可能）。",
-                view=view,
-            )
-        else:
-            await msg.channel.send("貸出・返却メニュー", view=view)
+    await itx.channel.send("🛡️ LoanLink Admin メニュー", view=AdminPanelView())
+    await itx.response.send_message("管理メニューを表示しました。", ephemeral=True)
+
+@app_commands.command(name="set", description="貸出・返却メニューをこのチャンネルに設置します")
+@app_commands.guild_only()
+@admin_only()
+async def set_command(itx: discord.Interaction):
+    if not await bind_interaction(itx):
         return
+    blocked, which, human = await asyncio.to_thread(calc_is_blackout)
+    view = PublicPanelView(disabled_loan=blocked)
+    sent = await itx.channel.send(panel_content(blocked, which, human), view=view)
+    await itx.response.send_message("貸出・返却メニューを設置しました。", ephemeral=True)
+    await asyncio.to_thread(track_panel, sent.channel.id, sent.id)
+
+SLASH_COMMANDS = (admin_command, set_command)
+COMMAND_SYNC_PATH = os.path.join(STATE_DIR, "command_tree.json")  # 最後に同期したコマンド定義
+FORCE_COMMAND_SYNC = os.getenv("SYNC_COMMANDS", "").lower() in ("1", "true", "yes")
+
+def command_signature(tree: app_commands.CommandTree) -> str:
+    return json.dumps([c.to_dict(tree) for c in tree.get_commands()], sort_keys=True, ensure_ascii=False)
+
+async def on_app_command_error(itx: discord.Interaction, error: app_commands.AppCommandError):
+    if isinstance(error, app_commands.CheckFailure):
+        return await reply_error(itx, str(error) or "権限がありません。")
+    original = getattr(error, "original", error)
+    if isinstance(original, (SheetsUnavailable, Overloaded, MutationRejected, discord.Forbidden)):
+        text = str(original) if not isinstance(original, discord.Forbidden) else "このチャンネルにメッセージを送信する権限がありません。"
+        return await reply_error(itx, text)
+    print(f"[command] /{itx.command.name if itx.command else '?'} 失敗: {original!r}")
+    await reply_error(itx, "エラーが発生しました。")
+
+# ========= アプリケーション生成 =========
+class LoanLinkBot(commands.Bot):
+    async def setup_hook(self):
+        self.add_view(AdminPanelView())  # Persistent admin view
+        self.add_view(PublicPanelView(disabled_loan=False))  # 投稿済みパネルのボタンを再起動後も受け付ける
+        await self.sync_commands()
+        self.loop.create_task(checkpoint_loop())
+        self.loop.create_task(reconcile_loop())
+        self.loop.create_task(snapshot_loop())
+        self.loop.create_task(health_loop())
+
+    async def sync_commands(self):
+        """コマンド定義が前回の同期から変わったとき（または SYNC_COMMANDS=1 のとき）だけ全体同期する"""
+        sig = command_signature(self.tree)
+        try:
+            with open(COMMAND_SYNC_PATH, encoding="utf-8") as f:
+                last = f.read()
+        except OSError:
+            last = ""
+        if sig == last and not FORCE_COMMAND_SYNC:
+            return
+        await self.tree.sync()
+        tmp = COMMAND_SYNC_PATH + ".tmp"
+        try:
+            os.makedirs(STATE_DIR, exist_ok=True)
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(sig)
+            os.replace(tmp, COMMAND_SYNC_PATH)
+        except OSError as e:
+            print(f"[commands] 同期結果の保存に失敗（次回の起動でも同期します）: {e}")
+
+LISTENERS = (
+    on_ready, on_guild_join,
+    on_guild_role_create, on_guild_role_update, on_guild_role_delete, on_guild_channel_delete,
+)
+
+def create_app(sheets=None) -> LoanLinkBot:
+    """
+    Bot を組み立てて返す。import 時には何も接続せず、
+    Sheets へは各テナントの初回アクセス時に接続する。
+    sheets に open_by_key を持つオブジェクトを渡すとそのバックエンドを使う。
+    """
+    global bot
+    if sheets is not None:
+        set_sheets_client(sheets)
+    # 必要なのはギルド/チャンネル/ロールの情報だけ（メッセージ本文・全メンバーは受け取らない）
+    intents = discord.Intents.none()
+    intents.guilds = True
+    bot = LoanLinkBot(
+        command_prefix=commands.when_mentioned,
+        intents=intents,
+        chunk_guilds_at_startup=False,
+        member_cache_flags=discord.MemberCacheFlags.from_intents(intents),
+    )
+    for fn in LISTENERS:
+        bot.add_listener(fn)
+    bot.add_dynamic_items(ApproveButton, RejectButton)  # 承認/却下ボタンは再起動後も申請IDで動く
+    for cmd in SLASH_COMMANDS:
+        bot.tree.add_command(cmd)
+    bot.tree.on_error = on_app_command_error
+    return bot
 
 if __name__ == "__main__":
     if not DISCORD_TOKEN:
         raise RuntimeError("DISCORD_TOKEN が未設定です。")
-    bot.run(DISCORD_TOKEN)
+    create_app().run(DISCORD_TOKEN)
@@ -0,0 +1,728 @@
+"""
+LoanLink の負荷試験。
+
+Discord にもスプレッドシートにも繋がずに、N 人の利用者が同時に
+  貸出（LoanByCategoryButton → LoanTypeSelect → CampusFilterSelect → CategorySelect
+        → ItemSelect → CampusSelectForLoan → LoanFinalizeModal）→ 承認待ち → 返却
+を繰り返し、管理者が貸出・返却を承認していく状況を再現する。
+ボタン・セレクト・モーダルのコールバックは偽の Interaction で直接呼び、
+スプレッドシートは呼び出しごとに遅延を入れるメモリ上の偽物に差し替える（bot.set_sheets_client）。
+
+  python loadtest.py --users 50 --items 30 --rounds 2 --latency 0.3
+
+報告する値:
+  - スループット（完了したフロー / 秒、インタラクション / 秒）
+  - 最初の応答までの時間（p50 / p95 / p99 / 最大）と 3 秒の期限を超えた件数
+  - エラー件数（例外の種類ごと）と、競合で断られた申請の件数
+  - 二重貸出（同じ機材に、承認済みの返却を挟まずに 2 件目の貸出が通った件数）
+
+Sheets のクォータ（SHEETS_READS_PER_MIN / SHEETS_WRITES_PER_MIN）と
+INTERACTION_WORKERS は本番と同じく環境変数の値を使う。--quota / --workers で上書きできる。
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from collections import Counter
+from datetime import timedelta
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Tuple
+
+DEADLINE_SEC = 3.0  # Discord が最初の応答を待つ時間
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="LoanLink の負荷試験（偽の Discord / 偽のスプレッドシート）")
+    p.add_argument("--users", type=int, default=20, help="同時に操作する利用者の数")
+    p.add_argument("--admins", type=int, default=2, help="承認を続ける管理者の数")
+    p.add_argument("--rounds", type=int, default=1, help="利用者 1 人あたりの 貸出→返却 の回数")
+    p.add_argument("--items", type=int, default=20, help="在庫の機材数")
+    p.add_argument("--categories", type=int, default=3, help="カテゴリ数")
+    p.add_argument("--latency", type=float, default=0.2, help="Sheets 呼び出し 1 回あたりの平均遅延（秒）")
+    p.add_argument("--jitter", type=float, default=0.1, help="遅延のばらつき（標準偏差、秒）")
+    p.add_argument("--discord-latency", type=float, default=0.05, help="Discord への応答 1 回あたりの遅延（秒）")
+    p.add_argument("--think", type=float, default=0.5, help="利用者が操作の間に考える時間の上限（秒）")
+    p.add_argument("--quota", type=float, default=None, help="Sheets の読み取り/書き込みクォータ（回/分）")
+    p.add_argument("--workers", type=int, default=None, help="INTERACTION_WORKERS を上書き")
+    p.add_argument("--timeout", type=float, default=600.0, help="打ち切るまでの時間（秒）")
+    p.add_argument("--seed", type=int, default=None, help="乱数のシード")
+    p.add_argument("-v", "--verbose", action="store_true", help="エラーの最初のトレースバックも表示")
+    return p.parse_args(argv)
+
+# ========= 偽のスプレッドシート =========
+def col_number(letters: str) -> int:
+    n = 0
+    for ch in letters:
+        n = n * 26 + ord(ch) - 64
+    return n
+
+def col_letters(n: int) -> str:
+    s = ""
+    while n:
+        n, r = divmod(n - 1, 26)
+        s = chr(65 + r) + s
+    return s
+
+def parse_a1(a1: str) -> Tuple[int, int, int, int]:
+    """'A2:C10' / 'B5' / 'A:A' → (行1, 列1, 行2, 列2)。省略された端は無限大"""
+    m = re.fullmatch(r"([A-Z]*)(\d*)(?::([A-Z]*)(\d*))?", a1.split("!")[-1])
+    c1, r1, c2, r2 = m.groups()
+    top = int(r1) if r1 else 1
+    left = col_number(c1) if c1 else 1
+    if m.group(3) is None:
+        return top, left, (top if r1 else 10 ** 9), (left if c1 else 10 ** 6)
+    return top, left, (int(r2) if r2 else 10 ** 9), (col_number(c2) if c2 else 10 ** 6)
+
+class FakeWorksheet:
+    """gspread.Worksheet のうち bot が使うメソッドだけを、遅延付きで実装したもの"""
+
+    def __init__(self, book: "FakeSpreadsheet", title: str, sheet_id: int):
+        self.spreadsheet = book
+        self.title = title
+        self.id = sheet_id
+        self.rows: List[List[str]] = []
+
+    def _call(self, method: str):
+        self.spreadsheet.wait(method)
+
+    def _set(self, r: int, c: int, v):
+        while len(self.rows) < r:
+            self.rows.append([])
+        row = self.rows[r - 1]
+        while len(row) < c:
+            row.append("")
+        row[c - 1] = "" if v is None else str(v)
+
+    def _range(self, a1: str) -> List[List[str]]:
+        top, left, bottom, right = parse_a1(a1)
+        out = []
+        for r in self.rows[top - 1:min(bottom, len(self.rows))]:
+            cells = list(r[left - 1:right])
+            while cells and cells[-1] == "":
+                cells.pop()
+            out.append(cells)
+        while out and not out[-1]:
+            out.pop()
+        return out
+
+    def _write(self, a1: str, values: List[List]):
+        top, left, _, _ = parse_a1(a1)
+        for i, row in enumerate(values):
+            for j, v in enumerate(row):
+                self._set(top + i, left + j, v)
+
+    # --- 読み取り ---
+    def get_all_values(self, *args, **kwargs) -> List[List[str]]:
+        self._call("get_all_values")
+        with self.spreadsheet.lock:
+            width = max((len(r) for r in self.rows), default=0)
+            return [list(r) + [""] * (width - len(r)) for r in self.rows]
+
+    def row_values(self, row: int, **kwargs) -> List[str]:
+        self._call("row_values")
+        with self.spreadsheet.lock:
+            cells = list(self.rows[row - 1]) if row - 1 < len(self.rows) else []
+        while cells and cells[-1] == "":
+            cells.pop()
+        return cells
+
+    def col_values(self, col: int, **kwargs) -> List[str]:
+        self._call("col_values")
+        with self.spreadsheet.lock:
+            out = [r[col - 1] if col - 1 < len(r) else "" for r in self.rows]
+        while out and out[-1] == "":
+            out.pop()
+        return out
+
+    def get(self, range_name: str = None, **kwargs) -> List[List[str]]:
+        self._call("get")
+        with self.spreadsheet.lock:
+            return self._range(range_name or "A1:ZZ")
+
+    def batch_get(self, ranges: List[str], **kwargs) -> List[List[List[str]]]:
+        self._call("batch_get")
+        with self.spreadsheet.lock:
+            return [self._range(a1) for a1 in ranges]
+
+    # --- 書き込み ---
+    def update_cell(self, row: int, col: int, value):
+        self._call("update_cell")
+        with self.spreadsheet.lock:
+            self._set(row, col, value)
+
+    def update(self, values=None, range_name=None, **kwargs):
+        self._call("update")
+        if isinstance(values, str):  # 旧来の update(range, values) の並び
+            values, range_name = range_name, values
+        with self.spreadsheet.lock:
+            self._write(range_name or "A1", values)
+
+    def batch_update(self, data: List[dict], **kwargs):
+        self._call("batch_update")
+        with self.spreadsheet.lock:
+            for d in data:
+                self._write(d["range"], d["values"])
+
+    def append_row(self, values: List, **kwargs):
+        return self.append_rows([values], **kwargs)
+
+    def append_rows(self, values: List[List], **kwargs) -> dict:
+        self._call("append_rows")
+        with self.spreadsheet.lock:
+            start = len(self.rows) + 1
+            width = 1
+            for r in values:
+                self.rows.append(["" if v is None else str(v) for v in r])
+                width = max(width, len(r))
+            end = len(self.rows)
+        return {"updates": {"updatedRange": f"{self.title}!A{start}:{col_letters(width)}{end}"}}
+
+    def delete_rows(self, start: int, end: Optional[int] = None):
+        self._call("delete_rows")
+        with self.spreadsheet.lock:
+            del self.rows[start - 1:(end or start)]
+
+    def resize(self, *args, **kwargs):
+        pass
+
+class FakeSpreadsheet:
+    """スレッドセーフなメモリ上のスプレッドシート。API 呼び出しごとに遅延を入れて回数を数える"""
+
+    def __init__(self, key: str, latency: float, jitter: float):
+        self.id = key
+        self.latency = latency
+        self.jitter = jitter
+        self.lock = threading.Lock()
+        self.sheets: Dict[str, FakeWorksheet] = {}
+        self.calls: Counter = Counter()
+
+    def wait(self, method: str):
+        with self.lock:
+            self.calls[method] += 1
+        delay = random.gauss(self.latency, self.jitter) if self.jitter else self.latency
+        if delay > 0:
+            time.sleep(delay)
+
+    def worksheet(self, title: str) -> FakeWorksheet:
+        import gspread
+        self.wait("worksheet")
+        ws = self.sheets.get(title)
+        if ws is None:
+            raise gspread.WorksheetNotFound(title)
+        return ws
+
+    def worksheets(self) -> List[FakeWorksheet]:
+        self.wait("worksheets")
+        return list(self.sheets.values())
+
+    def add_worksheet(self, title: str, rows: int = 0, cols: int = 0) -> FakeWorksheet:
+        self.wait("add_worksheet")
+        return self.seed(title, [])
+
+    def batch_update(self, body: dict):
+        self.wait("batch_update")  # 書式設定（gspread_formatting）は中身を見ない
+        return {}
+
+    def seed(self, title: str, rows: List[List[str]]) -> FakeWorksheet:
+        """遅延なしでシートを作って中身を入れる（準備用）"""
+        with self.lock:
+            ws = self.sheets.get(title)
+            if ws is None:
+                ws = self.sheets[title] = FakeWorksheet(self, title, len(self.sheets) + 1)
+            ws.rows = [[str(v) for v in r] for r in rows]
+        return ws
+
+    def dump(self, title: str) -> List[List[str]]:
+        """遅延なしで中身を読む（集計用）"""
+        with self.lock:
+            ws = self.sheets.get(title)
+            return [list(r) for r in ws.rows] if ws else []
+
+class FakeSheetsClient:
+    def __init__(self, book: FakeSpreadsheet):
+        self.book = book
+
+    def open_by_key(self, key: str) -> FakeSpreadsheet:
+        return self.book
+
+# ========= 集計 =========
+class Stats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.finished: Optional[float] = None
+        self.timed_out = False
+        self.interactions = 0
+        self.first_response: List[float] = []   # 最初の応答までの秒数
+        self.unanswered = 0                     # 一度も応答しなかったインタラクション
+        self.errors: Counter = Counter()        # 例外の種類 → 件数
+        self.samples: Dict[str, str] = {}       # 例外の種類 → 最初のトレースバック
+        self.outcomes: Counter = Counter()      # フローの結果 → 件数
+        self.rejected = 0                       # MutationRejected（競合で断られた操作）
+
+    def record(self, itx: "FakeInteraction"):
+        self.interactions += 1
+        if itx.first_response is None:
+            self.unanswered += 1
+        else:
+            self.first_response.append(itx.first_response - itx.created)
+
+    def error(self, e: BaseException):
+        if isinstance(e, bot.MutationRejected):  # 処理済み・貸出中などの競合は利用者への正常な応答
+            self.rejected += 1
+            return
+        name = type(e).__name__
+        self.errors[name] += 1
+        self.samples.setdefault(name, "".join(traceback.format_exception(type(e), e, e.__traceback__)))
+
+    def outcome(self, kind: str):
+        self.outcomes[kind] += 1
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    vals = sorted(values)
+    return vals[min(len(vals) - 1, int(round(q * (len(vals) - 1))))]
+
+def double_bookings(rows: List[List[str]], headers: List[str]) -> List[Tuple[str, str, str]]:
+    """
+    requests を記録順に辿り、同じ機材に承認済みの返却を挟まず 2 件目の貸出（却下以外）が
+    入った箇所を (機材ID, 先の申請ID, 後の申請ID) で返す
+    """
+    pos = {h: i for i, h in enumerate(headers)}
+
+    def cell(r, name):
+        i = pos[name]
+        return r[i] if i < len(r) else ""
+
+    held: Dict[str, str] = {}
+    found = []
+    for r in rows[1:]:
+        op, iid, st, rid = cell(r, "操作"), cell(r, "機材ID"), cell(r, "申請ステータス"), cell(r, "申請ID")
+        if op == "貸出申請" and st != "rejected":
+            if iid in held:
+                found.append((iid, held[iid], rid))
+            held[iid] = rid
+        elif op == "返却申請" and st == "approved":
+            held.pop(iid, None)
+    return found
+
+# ========= 偽の Discord =========
+class FakeRole:
+    def __init__(self, name: str):
+        self.name = name
+
+class FakeUser:
+    def __init__(self, uid: int, name: str, admin: bool = False):
+        self.id = uid
+        self.name = name
+        self.display_name = name
+        self.mention = f"<@{uid}>"
+        self.bot = False
+        self.roles = [FakeRole("admin")] if admin else []
+        self.guild_permissions = SimpleNamespace(administrator=admin)
+
+class FakeChannel:
+    def __init__(self, cid: int, discord_latency: float):
+        self.id = cid
+        self.mention = f"<#{cid}>"
+        self.discord_latency = discord_latency
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs):
+        await asyncio.sleep(self.discord_latency)
+        self.sent += 1
+
+class FakeGuild:
+    def __init__(self, gid: int, channel: FakeChannel):
+        self.id = gid
+        self.name = "loadtest"
+        self.channel = channel
+        self.members: list = []
+        self.roles: list = []
+
+    def get_channel(self, cid: int):
+        return self.channel if cid == self.channel.id else None
+
+    def get_role(self, rid: int):
+        return None
+
+    def get_member(self, uid: int):
+        return None
+
+class FakeMessage:
+    _ids = itertools.count(1)
+
+    def __init__(self, content: Optional[str], view=None):
+        self.id = next(self._ids)
+        self.content = content or ""
+        self.view = view
+
+class FakeResponse:
+    """InteractionResponse の代わり。最初の応答の時刻を Interaction に記録する"""
+
+    def __init__(self, itx: "FakeInteraction"):
+        self.itx = itx
+        self.done = False
+
+    def is_done(self) -> bool:
+        return self.done
+
+    async def _respond(self):
+        if self.done:
+            raise RuntimeError("このインタラクションには既に応答しています。")
+        self.done = True
+        self.itx.first_response = time.perf_counter()
+        await asyncio.sleep(self.itx.session.discord_latency)
+
+    async def defer(self, *, ephemeral: bool = False, thinking: bool = False):
+        await self._respond()
+
+    async def send_message(self, content=None, *, view=None, ephemeral: bool = False, **kwargs):
+        await self._respond()
+        self.itx.session.show(content, view)
+
+    async def send_modal(self, modal):
+        await self._respond()
+        self.itx.session.modal = modal
+
+    async def edit_message(self, *, content=None, view=None, **kwargs):
+        await self._respond()
+        self.itx.session.show(content, view)
+
+class FakeFollowup:
+    def __init__(self, itx: "FakeInteraction"):
+        self.itx = itx
+
+    async def send(self, content=None, *, view=None, ephemeral: bool = False, **kwargs):
+        if not self.itx.response.is_done():
+            raise RuntimeError("followup の前に応答（defer）していません。")
+        await asyncio.sleep(self.itx.session.discord_latency)
+        return self.itx.session.show(content, view)
+
+def _make_interaction_class():
+    import discord
+
+    class FakeInteraction(discord.Interaction):
+        """
+        discord.Interaction の代わり。Gateway のペイロードが無いので __init__ は呼ばず、
+        bot が触る属性（user / guild / channel / message / response / followup）だけを用意する
+        """
+        _ids = itertools.count(10 ** 17)
+
+        def __init__(self, session: "Session", data: dict, message: Optional[FakeMessage] = None):
+            self.id = next(self._ids)
+            self.data = data
+            self.user = session.user
+            self.message = message
+            self.session = session
+            self.created = time.perf_counter()
+            self.first_response: Optional[float] = None
+            self._fake_response = FakeResponse(self)
+            self._fake_followup = FakeFollowup(self)
+
+        @property
+        def guild(self):
+            return self.session.guild
+
+        @property
+        def channel(self):
+            return self.session.guild.channel
+
+        @property
+        def response(self):
+            return self._fake_response
+
+        @property
+        def followup(self):
+            return self._fake_followup
+
+        async def edit_original_response(self, *, content=None, view=None, **kwargs):
+            await asyncio.sleep(self.session.discord_latency)
+            return self.session.show(content, view)
+
+    return FakeInteraction
+
+class Session:
+    """1 人ぶんの画面。直前に表示されたメッセージ（View 付き）とモーダルを覚えておく"""
+
+    def __init__(self, user: FakeUser, guild: FakeGuild, stats: Stats, discord_latency: float):
+        self.user = user
+        self.guild = guild
+        self.stats = stats
+        self.discord_latency = discord_latency
+        self.last: Optional[FakeMessage] = None
+        self.modal = None
+
+    def show(self, content, view) -> FakeMessage:
+        self.last = FakeMessage(content, view)
+        return self.last
+
+    def reset(self):
+        self.last = None
+        self.modal = None
+
+    def find(self, cls):
+        """直前のメッセージの View から cls の部品を探す（無ければ None）"""
+        view = self.last.view if self.last else None
+        if view is None:
+            return None, None
+        for item in view.children:
+            if isinstance(item, cls):
+                return view, item
+        return None, None
+
+    async def click(self, view, item, values: Optional[List[str]] = None, message: Optional[FakeMessage] = None):
+        """View._scheduled_task と同じ順で interaction_check → callback → (失敗時) on_error"""
+        self.reset()
+        itx = FakeInteraction(self, {"custom_id": item.custom_id}, message)
+        if values is not None:
+            item._values = list(values)
+        try:
+            if await item.interaction_check(itx) and await view.interaction_check(itx):
+                await item.callback(itx)
+        except Exception as e:
+            self.stats.error(e)
+            try:
+                await view.on_error(itx, e, item)
+            except Exception:
+                pass
+        self.stats.record(itx)
+        return itx
+
+    async def submit(self, modal, **fields):
+        """Modal._scheduled_task と同じ順で interaction_check → on_submit → (失敗時) on_error"""
+        self.reset()
+        for name, value in fields.items():
+            getattr(modal, name)._value = value
+        itx = FakeInteraction(self, {"custom_id": modal.custom_id, "components": []})
+        try:
+            if await modal.interaction_check(itx):
+                await modal.on_submit(itx)
+        except Exception as e:
+            self.stats.error(e)
+            try:
+                await modal.on_error(itx, e)
+            except Exception:
+                pass
+        self.stats.record(itx)
+        return itx
+
+    def text(self) -> str:
+        return self.last.content if self.last else ""
+
+# ========= シナリオ =========
+async def think(args):
+    await asyncio.sleep(random.uniform(0, args.think))
+
+async def borrow(s: Session, args) -> str:
+    """個人の貸出申請を 1 回。結果の種類を返す"""
+    view, button = s.find(bot.LoanByCategoryButton)
+    await s.click(view, button)
+    view, sel = s.find(bot.LoanTypeSelect)
+    if sel is None:
+        return "panel_refused"
+    await think(args)
+    await s.click(view, sel, ["individual"])
+    view, sel = s.find(bot.CampusFilterSelect)
+    if sel is None:
+        return "no_category"
+    await think(args)
+    await s.click(view, sel, [random.choice(sel.options).value])
+    view, sel = s.find(bot.CategorySelect)
+    if sel is None:
+        return "no_category"
+    await think(args)
+    await s.click(view, sel, [random.choice(sel.options).value])
+    view, sel = s.find(bot.ItemSelect)
+    if sel is None:
+        return "no_stock"
+    await think(args)
+    await s.click(view, sel, [random.choice(sel.options).value])
+    view, sel = s.find(bot.CampusSelectForLoan)
+    if sel is None:
+        return "error"
+    await s.click(view, sel, [random.choice(sel.options).value])
+    if s.modal is None:
+        return "error"
+    await think(args)
+    due = (bot.today_jst() + timedelta(days=7)).isoformat()
+    await s.submit(s.modal, date=due, note="負荷試験")
+    return "loan_submitted" if s.text().startswith("貸出申請を受け付けました") else "loan_refused"
+
+async def give_back(s: Session, args) -> str:
+    """承認済み（貸出中）の機材を 1 つ返却申請する。まだ無ければ 'waiting'"""
+    s.reset()
+    await s.click(bot.PublicPanelView(disabled_loan=False), bot.ReturnButton())
+    view, sel = s.find(bot.BorrowedItemSelect)
+    if sel is None:
+        return "waiting"
+    lent = [o.value for o in sel.options if "状態: 貸出中" in (o.description or "")]
+    if not lent:
+        return "waiting"
+    await think(args)
+    await s.click(view, sel, [random.choice(lent)])
+    if s.modal is None:
+        return "error"
+    await s.submit(s.modal, condition="良好", comment="")
+    return "return_submitted" if s.text().startswith("返却申請完了") else "return_refused"
+
+async def user_session(s: Session, args, deadline: float):
+    panel = bot.PublicPanelView(disabled_loan=False)
+    for _ in range(args.rounds):
+        result = ""
+        while result != "loan_submitted" and time.perf_counter() < deadline:
+            s.show(None, panel)
+            result = await borrow(s, args)
+            s.stats.outcome(result)
+            if result != "loan_submitted":
+                await asyncio.sleep(1 + random.uniform(0, args.think))
+        if result != "loan_submitted":
+            return
+        while time.perf_counter() < deadline:
+            result = await give_back(s, args)
+            if result != "waiting":
+                s.stats.outcome(result)
+                if result == "return_submitted":
+                    break
+            await asyncio.sleep(1 + random.uniform(0, args.think))
+
+async def approve_one(s: Session, button_cls, args) -> bool:
+    """承認待ちを 1 件選んで承認する。承認待ちが無ければ False"""
+    s.reset()
+    await s.click(bot.AdminPanelView(), button_cls())
+    view, sel = s.find(bot.PendingSelect)
+    if sel is None:
+        return False
+    await s.click(view, sel, [random.choice(sel.options).value])
+    view, button = s.find(bot.ApproveButton)
+    if button is None:
+        return True
+    await think(args)
+    await s.click(view, button, message=s.last)
+    s.stats.outcome("approved" if "✅ 承認しました" in s.text() else "approve_failed")
+    return True
+
+async def admin_session(s: Session, args, users_done: asyncio.Event, deadline: float):
+    idle = 0
+    while time.perf_counter() < deadline:
+        busy = await approve_one(s, bot.AdminApproveLoansButton, args)
+        busy = await approve_one(s, bot.AdminApproveReturnsButton, args) or busy
+        if busy:
+            idle = 0
+            continue
+        if users_done.is_set():
+            idle += 1
+            if idle >= 2:  # 利用者が全員終わり、承認待ちも 2 巡続けて無い
+                return
+        await asyncio.sleep(0.5)
+
+# ========= 実行 =========
+def seed_sheets(book: FakeSpreadsheet, args):
+    cats = [f"カテゴリ{c + 1}" for c in range(args.categories)]
+    items = []
+    for i in range(args.items):
+        campus = bot.CAMPUS_CHOICES[i % len(bot.CAMPUS_CHOICES)]
+        items.append([f"LT{i + 1:03d}", f"機材{i + 1}", cats[i % len(cats)], "", "貸出可", "", "", campus, campus])
+    book.seed("inventory", [bot.INV_HEADERS] + items)
+    book.seed("config", [bot.CFG_HEADERS, ["ANNOUNCE_CHANNEL_ID", "1"]])
+    for title, headers in bot.SHEET_SPECS.items():
+        if title not in book.sheets:
+            book.seed(title, [headers])
+
+async def run(args, book: FakeSpreadsheet) -> Stats:
+    stats = Stats()
+    guild = FakeGuild(1, FakeChannel(1, args.discord_latency))
+    t = bot.tenants.for_guild(guild.id)
+    with bot.tenant_scope(t):
+        await t.start()  # 起動時の全件読み込みは計測に含めない
+    deadline = time.perf_counter() + args.timeout
+    stats.started = time.perf_counter()
+
+    users = [Session(FakeUser(1000 + i, f"利用者{i + 1:03d}"), guild, stats, args.discord_latency)
+             for i in range(args.users)]
+    admins = [Session(FakeUser(10 + i, f"管理者{i + 1}", admin=True), guild, stats, args.discord_latency)
+              for i in range(args.admins)]
+    users_done = asyncio.Event()
+    admin_tasks = [asyncio.create_task(admin_session(s, args, users_done, deadline)) for s in admins]
+    await asyncio.gather(*(user_session(s, args, deadline) for s in users))
+    users_done.set()
+    await asyncio.gather(*admin_tasks)
+    stats.finished = time.perf_counter()
+    stats.timed_out = stats.finished >= deadline
+    return stats
+
+def report(args, stats: Stats, book: FakeSpreadsheet):
+    elapsed = (stats.finished or time.perf_counter()) - stats.started
+    o = stats.outcomes
+    flows = o["loan_submitted"] + o["return_submitted"] + o["approved"]
+    rt = stats.first_response
+    late = sum(1 for x in rt if x > DEADLINE_SEC)
+    booked = double_bookings(book.dump("requests"), bot.REQ_HEADERS)
+    reads = sum(n for m, n in book.calls.items() if m not in bot.WRITE_METHODS)
+    writes = sum(n for m, n in book.calls.items() if m in bot.WRITE_METHODS)
+
+    print(f"利用者 {args.users} 人 / 管理者 {args.admins} 人 / 機材 {args.items} 台 / "
+          f"Sheets 遅延 {args.latency:.2f}±{args.jitter:.2f} 秒 / {args.rounds} 回ずつ")
+    print(f"所要時間: {elapsed:.1f} 秒" + ("（--timeout で打ち切り）" if stats.timed_out else ""))
+    print(f"スループット: {flows / elapsed:.2f} フロー/秒（貸出 {o['loan_submitted']} / "
+          f"返却 {o['return_submitted']} / 承認 {o['approved']}）、"
+          f"{stats.interactions / elapsed:.2f} インタラクション/秒（計 {stats.interactions}）")
+    if rt:
+        print(f"最初の応答まで: p50 {percentile(rt, 0.50):.3f} / p95 {percentile(rt, 0.95):.3f} / "
+              f"p99 {percentile(rt, 0.99):.3f} / 最大 {max(rt):.3f} 秒（平均 {statistics.mean(rt):.3f}）")
+    print(f"{DEADLINE_SEC:.0f} 秒の期限超過: {late} 件 / 未応答: {stats.unanswered} 件")
+    print(f"競合で拒否: {stats.rejected} 件（" + ", ".join(
+        f"{k} {o[k]}" for k in ("no_stock", "loan_refused", "return_refused", "approve_failed")) + "）")
+    print("エラー: " + (", ".join(f"{k} {n}" for k, n in stats.errors.most_common()) or "なし"))
+    lim = bot.tenants.for_guild(None).limiter.stats
+    print(f"レート制限: 待機 {lim['delayed']} / 拒否 {lim['rejected']}"
+          f"（読み取り {lim['rejected_read']}・書き込み {lim['rejected_write']}）")
+    print(f"二重貸出: {len(booked)} 件")
+    for iid, first, second in booked[:10]:
+        print(f"  - {iid}: {first} → {second}")
+    print(f"Sheets 呼び出し: 読み取り {reads} / 書き込み {writes}（"
+          + ", ".join(f"{m} {n}" for m, n in book.calls.most_common()) + "）")
+    if args.verbose:
+        for name, tb in stats.samples.items():
+            print(f"\n--- {name} ---\n{tb}")
+
+def main(argv=None):
+    global bot, FakeInteraction
+    args = parse_args(argv)
+    if args.seed is not None:
+        random.seed(args.seed)
+    # bot は import 時に環境変数を読むので、先に設定しておく
+    state = tempfile.mkdtemp(prefix="loanlink-loadtest-")
+    os.environ["GOOGLE_SHEET_KEY"] = "loadtest"
+    os.environ.pop("GUILD_SHEET_KEYS", None)
+    os.environ["LOANLINK_STATE_DIR"] = state
+    os.environ["INVENTORY_CHECKPOINT_PATH"] = os.path.join(state, "inventory_checkpoint.json")
+    if args.quota is not None:
+        os.environ["SHEETS_READS_PER_MIN"] = os.environ["SHEETS_WRITES_PER_MIN"] = str(args.quota)
+    if args.workers is not None:
+        os.environ["INTERACTION_WORKERS"] = str(args.workers)
+    logging.getLogger("discord").setLevel(logging.CRITICAL)  # 例外は Stats で数える
+
+    import bot as loanlink
+    bot = loanlink
+    FakeInteraction = _make_interaction_class()
+    book = FakeSpreadsheet("loadtest", args.latency, args.jitter)
+    seed_sheets(book, args)
+    bot.create_app(FakeSheetsClient(book))
+    stats = asyncio.run(run(args, book))
+    report(args, stats, book)
+    return 1 if stats.unanswered or double_bookings(book.dump("requests"), bot.REQ_HEADERS) else 0
+
+bot = None
+FakeInteraction = None
+
+if __name__ == "__main__":
+    sys.exit(main())